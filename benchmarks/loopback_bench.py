@@ -0,0 +1,234 @@
+"""
+Load test over loopback: starts a Server and drives concurrent Clients through a matrix of
+transfer kind, payload size, serialization method and encryption.
+Reports throughput, latency percentiles and peak RSS as json and can compare them to a baseline
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from msg_transfer_package.client import Client
+from msg_transfer_package.example_data.example_data import DATA
+from msg_transfer_package.metrics import Histogram
+from msg_transfer_package.server import Server
+from msg_transfer_package.utils import serialize_object
+
+METHODS = ["json", "xml", "binary"]
+SIZES = [100, 10000, 1000000]
+# Always sent as a file: small files go out in one write with their header, a regression
+# there costs a delayed ACK of tens of milliseconds per file
+SMALL_FILE_SIZE = 100
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(output_option: str) -> int:
+    """
+    Runs a Server on a background thread and returns its port once it accepts connections
+    """
+
+    port = free_port()
+    server = Server("127.0.0.1", port, output_option,
+                    workers=64, queue_depth=64)
+    threading.Thread(target=server.run_server, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return port
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def make_object(size: int) -> dict:
+    """
+    Object whose json serialization is about size bytes
+    """
+
+    record = dict(DATA["data"])
+    record_size = len(json.dumps(record)) + 2
+    return {"records": [dict(record, id=i) for i in range(max(1, size // record_size))]}
+
+
+def peak_rss_mib() -> float:
+    """
+    Peak resident memory of this process so far, server and clients included
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def run_case(port: int, kind: str, method: str, size: int, encrypt: bool, clients: int,
+             messages: int, protocol_version: int, file_path: str = None) -> dict:
+    """
+    Sends messages from each of clients connections and measures every round trip
+    """
+
+    obj = make_object(size) if kind == "object" else None
+    payload_size = len(serialize_object(obj, method)
+                       ) if obj is not None else size
+    latencies = [Histogram() for _ in range(clients)]
+    errors = []
+    ready = threading.Barrier(clients + 1)
+
+    def worker(histogram: Histogram):
+        try:
+            with Client("127.0.0.1", port, protocol_version=protocol_version) as client:
+                client.connection()
+                ready.wait()
+                for _ in range(messages):
+                    started = time.perf_counter()
+                    if kind == "object":
+                        reply = client.transfer_object(method, obj, encrypt)
+                    else:
+                        reply = client.transfer_file(file_path, encrypt)
+                    histogram.record(time.perf_counter() - started)
+                    if b"successfully" not in reply:
+                        errors.append(reply)
+        except Exception as err:
+            errors.append(err)
+            ready.abort()
+
+    threads = [threading.Thread(target=worker, args=(histogram,))
+               for histogram in latencies]
+    for thread in threads:
+        thread.start()
+    try:
+        ready.wait()
+    except threading.BrokenBarrierError:
+        pass
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latency = Histogram()
+    for histogram in latencies:
+        latency.merge(histogram)
+    total = clients * messages
+    return {
+        "name": "{}-{}-{}-{}".format(kind, method if kind == "object" else "raw",
+                                     "enc" if encrypt else "plain", size),
+        "kind": kind,
+        "method": method if kind == "object" else None,
+        "size": size,
+        "payload_bytes": payload_size,
+        "encrypt": encrypt,
+        "messages": total,
+        "errors": len(errors),
+        "seconds": elapsed,
+        "msgs_per_s": total / elapsed,
+        "mb_per_s": total * payload_size / elapsed / 1e6,
+        "p50_ms": latency.percentile(0.5) * 1e3,
+        "p99_ms": latency.percentile(0.99) * 1e3,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Returns a line for every case that got slower than its baseline by more than tolerance
+    """
+
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        if result["msgs_per_s"] < before["msgs_per_s"] * (1 - tolerance):
+            regressions.append("{}: {:.1f} msgs/s, baseline {:.1f}".format(
+                result["name"], result["msgs_per_s"], before["msgs_per_s"]))
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append("{}: p99 {:.3f} ms, baseline {:.3f} ms".format(
+                result["name"], result["p99_ms"], before["p99_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Server and Client over loopback")
+    parser.add_argument("-c", dest="clients", type=int, default=4,
+                        help="concurrent client connections")
+    parser.add_argument("-n", dest="messages", type=int, default=100,
+                        help="messages sent by each client per case")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma separated payload sizes in bytes")
+    parser.add_argument("--methods", default=",".join(METHODS),
+                        help="comma separated serialization methods")
+    parser.add_argument("--kinds", default="object,file",
+                        help="comma separated transfer kinds, object and/or file")
+    parser.add_argument("--protocol", dest="protocol_version", type=int, default=2,
+                        help="protocol version of the clients")
+    parser.add_argument("-o", dest="output", help="write the json report to this file")
+    parser.add_argument("--baseline", help="json report to compare the results to")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown against the baseline reported as a regression")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    methods = args.methods.split(",")
+    port = start_server("print")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for kind in args.kinds.split(","):
+            for size in sorted(set(sizes) | {SMALL_FILE_SIZE}) if kind == "file" else sizes:
+                file_path = None
+                if kind == "file":
+                    file_path = os.path.join(tmp_dir, "payload.bin")
+                    with open(file_path, "wb") as file:
+                        file.write(os.urandom(size))
+                for method in methods if kind == "object" else [None]:
+                    for encrypt in (False, True):
+                        result = run_case(port, kind, method, size, encrypt, args.clients,
+                                          args.messages, args.protocol_version, file_path)
+                        results.append(result)
+                        print("{:<32}{:>10.1f} msgs/s{:>10.2f} MB/s{:>9.3f} ms p50{:>9.3f} ms p99"
+                              "{:>8.1f} MiB".format(
+                                  result["name"], result["msgs_per_s"], result["mb_per_s"],
+                                  result["p50_ms"], result["p99_ms"], result["peak_rss_mib"]),
+                              file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "clients": args.clients,
+        "messages": args.messages,
+        "protocol_version": args.protocol_version,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the speed and size of the serialization methods
+"""
+
+import argparse
+import json
+import logging
+import timeit
+from msg_transfer_package.example_data.example_data import DATA
+from msg_transfer_package.server import Server
+from msg_transfer_package.utils import serialize_object
+
+METHODS = ["json", "xml", "binary", "compact"]
+# xml needs a single root and columnar needs same-shaped records
+RECORD_METHODS = ["json", "binary", "compact", "columnar"]
+
+
+def bench(obj: any, method: str, number: int) -> dict:
+    """
+    Times serialize_object and Server.parse_object for one method, in microseconds per call
+    """
+
+    serialized = serialize_object(obj, method)
+    encode = timeit.timeit(lambda: serialize_object(
+        obj, method), number=number)
+    decode = timeit.timeit(lambda: Server.parse_object(
+        serialized, method), number=number)
+    return {
+        "size": len(serialized),
+        "encode_us": encode / number * 1e6,
+        "decode_us": decode / number * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the serialization methods on example data")
+    parser.add_argument("-n", dest="number", type=int, default=2000,
+                        help="calls timed per method")
+    parser.add_argument("-r", dest="records", type=int, default=100,
+                        help="copies of the example data in the large payload")
+    args = parser.parse_args()
+
+    # serialize_object logs every call
+    logging.disable(logging.CRITICAL)
+    # Distinct copies, pickle would only store a repeated object once
+    records = [json.loads(json.dumps(DATA)) for _ in range(args.records)]
+    # Flat records of the same shape, the case the columnar format is for
+    rows = [{"id": i, "score": i / 3, "active": i % 2 == 0, "year": 2020,
+             **DATA["data"]} for i in range(args.records)]
+    payloads = {"small": (DATA, METHODS),
+                "large": ({"records": records}, METHODS),
+                "records": (rows, RECORD_METHODS)}
+    print("{:<8}{:<10}{:>10}{:>14}{:>14}".format(
+        "payload", "method", "bytes", "encode us", "decode us"))
+    for name, (obj, methods) in payloads.items():
+        number = args.number if name == "small" else max(
+            1, args.number // args.records)
+        for method in methods:
+            result = bench(obj, method, number)
+            print("{:<8}{:<10}{:>10}{:>14.1f}{:>14.1f}".format(
+                name, method, result["size"], result["encode_us"], result["decode_us"]))
+
+
+if __name__ == "__main__":
+    main()
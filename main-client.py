@@ -3,6 +3,7 @@ Starts the client using cmd arguments
 """
 
 from msg_transfer_package.client import run_with_config
+from msg_transfer_package.logconfig import setup_logging
 import argparse
 
 CONFIG_FILE_PATH = ""
@@ -16,12 +17,16 @@ parser.add_argument('-c', dest='config_path', default='config_client.cfg',
                     help='the client config file path (required)')
 
 parser.add_argument('-i', dest='input_file', default='',
-                    help='the path of input file to send')
+                    help='the path of input file to send, a directory or a quoted glob pattern '
+                    'sends every file in it, - sends the files listed on stdin')
 
 parser.add_argument('-e', dest='do_encrypt', default=False, action='store_true',
                     help='if the transfer data should be encrypted')
 
 args = parser.parse_args()
 
-
-run_with_config(args.config_path, args.input_file, args.do_encrypt)
+listener = setup_logging("CLIENT", "client_log.log")
+try:
+    run_with_config(args.config_path, args.input_file, args.do_encrypt)
+finally:
+    listener.stop()
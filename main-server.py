@@ -2,8 +2,17 @@
 Starts the server part of network
 """
 import configparser
+import logging
 import os
-from msg_transfer_package.server import Server
+from msg_transfer_package.async_server import AsyncServer
+from msg_transfer_package.dedup import BlobStore
+from msg_transfer_package.limits import Limits
+from msg_transfer_package.logconfig import setup_logging
+from msg_transfer_package.metrics import MetricsAggregate, MetricsRegistry
+from msg_transfer_package.offload import DecodePool
+from msg_transfer_package.prefork import Supervisor
+from msg_transfer_package.server import OBJECT_FILENAME, Server
+from msg_transfer_package.sink import FSYNC_POLICIES, WriteBehindSink
 
 
 config_file_path = os.path.dirname(__file__) + "/config_server.cfg"
@@ -40,5 +49,206 @@ if OUTPUT_OPTION != "print" and OUTPUT_OPTION != "file":
     print('invalid parameter "output_option", allowed values are: print, file')
     exit(1)
 
-s = Server(SERVER_ADDR_HOST, SERVER_ADDR_PORT, OUTPUT_OPTION)
-s.run_server()
+ENGINE = config.get("SERVER_OPTIONS", "engine", fallback="threads")
+if ENGINE != "threads" and ENGINE != "asyncio":
+    print('invalid parameter "engine", allowed values are: threads, asyncio')
+    exit(1)
+
+try:
+    WORKERS = config.getint("SERVER_OPTIONS", "workers", fallback=16)
+    QUEUE_DEPTH = config.getint("SERVER_OPTIONS", "queue_depth", fallback=64)
+    BACKLOG = config.getint("SERVER_OPTIONS", "backlog", fallback=128)
+except ValueError:
+    print("SERVER_OPTIONS.workers, queue_depth and backlog must be integers")
+    exit(1)
+if WORKERS < 1 or QUEUE_DEPTH < 0 or BACKLOG < 1:
+    print('invalid worker pool options, "workers" and "backlog" must be positive and "queue_depth" not negative')
+    exit(1)
+
+try:
+    PROCESSES = config.getint("SERVER_OPTIONS", "processes", fallback=1)
+except ValueError:
+    print("SERVER_OPTIONS.processes must be an integer")
+    exit(1)
+if PROCESSES < 0:
+    print('invalid parameter "processes", it must not be negative')
+    exit(1)
+# 0 starts a worker process per core
+PROCESSES = PROCESSES or os.cpu_count()
+
+try:
+    DECODE_PROCESSES = config.getint(
+        "SERVER_OPTIONS", "decode_processes", fallback=0)
+    OFFLOAD_MIN_SIZE = config.getint(
+        "SERVER_OPTIONS", "offload_min_size", fallback=65536)
+except ValueError:
+    print("SERVER_OPTIONS.decode_processes and offload_min_size must be integers")
+    exit(1)
+if DECODE_PROCESSES < 0 or OFFLOAD_MIN_SIZE < 0:
+    print('invalid decode pool options, "decode_processes" and "offload_min_size" must not be negative')
+    exit(1)
+
+OUTPUT_PATH = config.get("SERVER_OPTIONS", "output_path",
+                         fallback=OBJECT_FILENAME)
+FSYNC = config.get("SERVER_OPTIONS", "fsync", fallback="none")
+if FSYNC not in FSYNC_POLICIES:
+    print('invalid parameter "fsync", allowed values are: ' +
+          ", ".join(FSYNC_POLICIES))
+    exit(1)
+try:
+    SINK_QUEUE = config.getint("SERVER_OPTIONS", "sink_queue", fallback=1024)
+    FSYNC_INTERVAL = config.getfloat(
+        "SERVER_OPTIONS", "fsync_interval", fallback=1.0)
+    ROTATE_BYTES = config.getint(
+        "SERVER_OPTIONS", "rotate_bytes", fallback=0)
+    ROTATE_SECONDS = config.getfloat(
+        "SERVER_OPTIONS", "rotate_seconds", fallback=0)
+except ValueError:
+    print("SERVER_OPTIONS.sink_queue, fsync_interval, rotate_bytes and rotate_seconds must be numbers")
+    exit(1)
+if SINK_QUEUE < 1 or FSYNC_INTERVAL <= 0 or ROTATE_BYTES < 0 or ROTATE_SECONDS < 0:
+    print('invalid output sink options, "sink_queue" and "fsync_interval" must be positive, '
+          '"rotate_bytes" and "rotate_seconds" not negative')
+    exit(1)
+
+LOG_FILE = config.get("SERVER_OPTIONS", "log_file", fallback="server_log.log")
+LOG_LEVEL = config.get("SERVER_OPTIONS", "log_level", fallback="INFO").upper()
+if LOG_LEVEL not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+    print('invalid parameter "log_level", allowed values are: DEBUG, INFO, WARNING, ERROR, CRITICAL')
+    exit(1)
+try:
+    LOG_PAYLOADS = config.getboolean(
+        "SERVER_OPTIONS", "log_payloads", fallback=False)
+except ValueError:
+    print("SERVER_OPTIONS.log_payloads must be true or false")
+    exit(1)
+
+METRICS_HOST = config.get("SERVER_OPTIONS", "metrics_host",
+                          fallback="127.0.0.1")
+try:
+    METRICS_PORT = config.getint(
+        "SERVER_OPTIONS", "metrics_port", fallback=0)
+    STATS_INTERVAL = config.getfloat(
+        "SERVER_OPTIONS", "stats_interval", fallback=0)
+except ValueError:
+    print("SERVER_OPTIONS.metrics_port and stats_interval must be numbers")
+    exit(1)
+if METRICS_PORT < 0 or STATS_INTERVAL < 0:
+    print('invalid metrics options, "metrics_port" and "stats_interval" must not be negative')
+    exit(1)
+
+try:
+    LIMITS = Limits(
+        max_frame_size=config.getint(
+            "SERVER_OPTIONS", "max_frame_size", fallback=16777216),
+        connection_budget=config.getint(
+            "SERVER_OPTIONS", "connection_budget", fallback=33554432),
+        global_budget=config.getint(
+            "SERVER_OPTIONS", "global_budget", fallback=268435456),
+        idle_timeout=config.getfloat(
+            "SERVER_OPTIONS", "idle_timeout", fallback=300),
+        read_timeout=config.getfloat(
+            "SERVER_OPTIONS", "read_timeout", fallback=30),
+        max_connections=config.getint(
+            "SERVER_OPTIONS", "max_connections", fallback=1024),
+        max_file_size=config.getint(
+            "SERVER_OPTIONS", "max_file_size", fallback=68719476736),
+        partial_ttl=config.getfloat(
+            "SERVER_OPTIONS", "partial_ttl", fallback=86400))
+except ValueError as err:
+    print("invalid limit options: {}".format(err))
+    exit(1)
+
+# Empty disables deduplication
+BLOB_DIR = config.get("SERVER_OPTIONS", "blob_dir", fallback="")
+try:
+    DEDUP_VERIFY = config.getboolean(
+        "SERVER_OPTIONS", "dedup_verify", fallback=True)
+except ValueError:
+    print("SERVER_OPTIONS.dedup_verify must be true or false")
+    exit(1)
+
+
+def serve(metrics=None, reuse_port=False, output_path=OUTPUT_PATH):
+    """
+    Runs one server with its decode pool and output sink until it is interrupted
+    """
+
+    decode_pool = None
+    sink = None
+    # Worker processes share the store, blobs are moved into place whole
+    blobs = BlobStore(BLOB_DIR, DEDUP_VERIFY) if BLOB_DIR else None
+    if DECODE_PROCESSES:
+        decode_pool = DecodePool(DECODE_PROCESSES, OFFLOAD_MIN_SIZE)
+    if OUTPUT_OPTION == "file":
+        sink = WriteBehindSink(output_path, queue_size=SINK_QUEUE, fsync=FSYNC,
+                               fsync_interval=FSYNC_INTERVAL, rotate_bytes=ROTATE_BYTES,
+                               rotate_seconds=ROTATE_SECONDS)
+    try:
+        if ENGINE == "asyncio":
+            s = AsyncServer(SERVER_ADDR_HOST, SERVER_ADDR_PORT, OUTPUT_OPTION,
+                            backlog=BACKLOG, decode_pool=decode_pool, sink=sink,
+                            metrics=metrics, limits=LIMITS, reuse_port=reuse_port,
+                            blobs=blobs)
+        else:
+            s = Server(SERVER_ADDR_HOST, SERVER_ADDR_PORT, OUTPUT_OPTION,
+                       workers=WORKERS, queue_depth=QUEUE_DEPTH, backlog=BACKLOG,
+                       decode_pool=decode_pool, sink=sink, metrics=metrics,
+                       limits=LIMITS, reuse_port=reuse_port, blobs=blobs)
+        s.run_server()
+    finally:
+        # Queued objects are written out before exiting
+        if sink is not None:
+            sink.close()
+        if decode_pool is not None:
+            decode_pool.close()
+
+
+def serve_worker(index: int, metrics):
+    """
+    Runs in each worker process of a pre-forked server
+    """
+
+    # The logging queue of the supervisor has no listener in this process
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    listener = setup_logging("SERVER-{}".format(index), LOG_FILE, getattr(logging, LOG_LEVEL),
+                             LOG_PAYLOADS)
+    try:
+        # Every process has its own output file, so rotation and fsync stay per process
+        serve(metrics, reuse_port=True,
+              output_path="{}.{}".format(OUTPUT_PATH, index))
+    finally:
+        listener.stop()
+
+
+def main():
+    listener = setup_logging("SERVER", LOG_FILE, getattr(logging, LOG_LEVEL),
+                             LOG_PAYLOADS)
+    metrics = None
+    metrics_server = None
+    stop_reporter = None
+    if METRICS_PORT or STATS_INTERVAL:
+        # The supervisor combines the metrics its workers report
+        metrics = MetricsAggregate() if PROCESSES > 1 else MetricsRegistry()
+    if METRICS_PORT:
+        metrics_server = metrics.serve(METRICS_HOST, METRICS_PORT)
+    if STATS_INTERVAL:
+        stop_reporter = metrics.start_reporter(STATS_INTERVAL)
+    try:
+        if PROCESSES > 1:
+            Supervisor(serve_worker, PROCESSES, metrics).run()
+        else:
+            serve(metrics)
+    finally:
+        if stop_reporter is not None:
+            stop_reporter.set()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        listener.stop()
+
+
+# Decode worker processes may import this module, only the parent runs the server
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Network server module built on asyncio streams
+"""
+
+import asyncio
+import logging
+import sys
+import time
+from .chunks import ChunkStore
+from .delta import DeltaStore
+from .limits import ByteBudget, Limits
+from .server import BUFFER_SIZE, HEADER_SIZE, MessageDispatch, create_response
+from .utils import (
+    V2_HEADER,
+    V2_MAGIC,
+    ProtocolError,
+    get_params,
+    get_params_v2,
+    set_header_trailer,
+)
+
+
+logger = logging.getLogger(__name__)
+# Seconds between checks for free space in the global receive budget
+BUDGET_POLL_INTERVAL = 0.01
+
+
+class AsyncServer(MessageDispatch):
+    """
+    Server that receives requests and data from clients on a single event loop,
+    using the same wire format as Server
+    """
+
+    def __init__(self, host_addr: str, addr_port: int, output_option="file", backlog=128,
+                 decode_pool=None, sink=None, metrics=None, limits=None, reuse_port=False,
+                 blobs=None):
+        """
+        host: ip address or hostname of the receiving server
+        port: The port of the receiving server
+        output_option: Output to terminal or save to file, allowed values: (file, print)
+        backlog: number of unaccepted incoming connections before refusing new connections
+        decode_pool: DecodePool that decrypts and parses large objects in worker processes
+        sink: WriteBehindSink that objects are written to when output_option is file
+        metrics: MetricsRegistry the connections and messages are counted in
+        limits: Limits on message sizes, buffered bytes, timeouts and connections,
+        the Limits defaults when not given
+        reuse_port: set SO_REUSEPORT so several processes can listen on the same address
+        blobs: BlobStore that lets clients skip sending contents the server already holds
+        """
+
+        self.host_addr = host_addr
+        self.addr_port = addr_port
+        self.output_option = output_option
+        self.backlog = backlog
+        self.decode_pool = decode_pool
+        self.sink = sink
+        self.metrics = metrics
+        self.limits = limits if limits is not None else Limits()
+        self.reuse_port = reuse_port
+        self.blobs = blobs
+        # Payload bytes all connections may still buffer. The read-ahead of a connection is
+        # bounded by the flow control of its StreamReader
+        self.budget = ByteBudget(self.limits.global_budget)
+        self._connections = 0
+        self.chunks = ChunkStore(limits=self.limits)
+        self.deltas = DeltaStore()
+
+    def run_server(self):
+        """
+        Bind and listen for new client connections until interrupted
+        """
+
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Server %s:%s shutdown.",
+                        self.host_addr, self.addr_port)
+            sys.exit()
+
+    async def start(self) -> asyncio.AbstractServer:
+        """
+        Bind the listening socket and start accepting connections
+        """
+
+        server = await asyncio.start_server(
+            self.handle_connection, self.host_addr, self.addr_port, backlog=self.backlog,
+            reuse_port=self.reuse_port)
+        logger.info("[*] Listening at %s:%s", self.host_addr, self.addr_port)
+        return server
+
+    async def serve(self):
+        """
+        Serve client connections forever
+        """
+
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def read_header(self, reader: asyncio.StreamReader) -> dict:
+        """
+        Reads a v1 or v2 header, telling them apart by the first byte.
+        Returns None if the connection stays idle for idle_timeout
+        """
+
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), self.limits.idle_timeout)
+        except asyncio.TimeoutError:
+            return None
+        try:
+            return await asyncio.wait_for(self._read_header_rest(reader, first),
+                                          self.limits.read_timeout)
+        except asyncio.TimeoutError:
+            raise ProtocolError("Timed out waiting for the rest of the header")
+
+    @staticmethod
+    async def _read_header_rest(reader: asyncio.StreamReader, first: bytes) -> dict:
+        if first == V2_MAGIC[:1]:
+            msg_params = get_params_v2(first + await reader.readexactly(V2_HEADER.size - 1))
+            set_header_trailer(msg_params, await reader.readexactly(msg_params["trailer_length"]))
+            return msg_params
+        return get_params(first + await reader.readexactly(4 * HEADER_SIZE - 1), HEADER_SIZE)
+
+    async def _read(self, reader: asyncio.StreamReader, msg_params: dict, size: int) -> bytes:
+        """
+        Reads up to size bytes of a payload, waiting at most read_timeout for them
+        """
+
+        try:
+            chunk = await asyncio.wait_for(reader.read(size), self.limits.read_timeout)
+        except asyncio.TimeoutError:
+            raise ProtocolError(
+                "Timed out waiting for the rest of the message", msg_params)
+        if not chunk:
+            raise asyncio.IncompleteReadError(b"", size)
+        return chunk
+
+    async def read_payload(self, reader: asyncio.StreamReader, msg_params: dict) -> bytearray:
+        """
+        Reads a payload that is held in memory, after checking it against the frame limit and
+        reserving it in the global budget
+        """
+
+        length = msg_params["length"]
+        if length > self.limits.max_frame_size:
+            raise ProtocolError("Frame of {} bytes exceeds the limit of {} bytes".format(
+                length, self.limits.max_frame_size), msg_params)
+        # Waits while other connections use up the budget, the client is not read meanwhile
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.limits.read_timeout
+        while not self.budget.try_acquire(length):
+            if loop.time() >= deadline:
+                raise ProtocolError(
+                    "Server is out of receive buffer space, retry later", msg_params)
+            await asyncio.sleep(BUDGET_POLL_INTERVAL)
+        try:
+            msg = bytearray()
+            while len(msg) < length:
+                msg += await self._read(reader, msg_params, min(length - len(msg), BUFFER_SIZE))
+            return msg
+        except BaseException:
+            self.budget.release(length)
+            raise
+
+    async def receive_stream(self, reader: asyncio.StreamReader, msg_params: dict) -> tuple:
+        """
+        Streams a payload into its stream receiver as it arrives.
+        Returns the reply and whether it reports an error
+        """
+
+        complete = False
+        try:
+            receiver = self.stream_receiver(msg_params).__enter__()
+            try:
+                remaining = msg_params["length"]
+                while remaining:
+                    chunk = await self._read(reader, msg_params, min(remaining, BUFFER_SIZE))
+                    receiver.write(chunk)
+                    remaining -= len(chunk)
+            except BaseException:
+                receiver.__exit__(*sys.exc_info())
+                raise
+            complete = True
+            # Finishing applies a delta or moves a file into place, work that grows with the
+            # size of the file and would stall the other connections on the loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, receiver.__exit__, None, None, None)
+        except ProtocolError:
+            raise
+        except Exception as err:
+            if not complete:
+                raise
+            # The payload was read completely, so the connection stays usable
+            return "Failed to process message: {}".format(err).encode(), True
+        return b"Received File successfully", False
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Loop for receiving and processing the requests of one client and sending responses
+        """
+
+        address = writer.get_extra_info("peername")
+        if self._connections >= self.limits.max_connections:
+            logger.warning("Refusing %s, %d connections are open",
+                           address, self.limits.max_connections)
+            if self.metrics is not None:
+                self.metrics.limit_violation()
+            writer.close()
+            return
+        self._connections += 1
+        logger.info("[+] %s is connected.", address)
+        loop = asyncio.get_running_loop()
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        try:
+            while True:
+                msg_params = None
+                try:
+                    msg_params = await self.read_header(reader)
+                    if msg_params is None:
+                        logger.info("Closing idle client %s.", address)
+                        break
+                    started = time.perf_counter()
+                    if msg_params["type"] in self.STREAMED_TYPES:
+                        streamed = await self.receive_stream(reader, msg_params)
+                        msg = None
+                    else:
+                        msg = await self.read_payload(reader, msg_params)
+                except asyncio.IncompleteReadError:
+                    break
+                except ProtocolError as err:
+                    # The stream cannot continue, the client is told why before it is closed
+                    logger.warning("Closing client %s: %s", address, err)
+                    if self.metrics is not None:
+                        self.metrics.limit_violation()
+                    if err.metadata or msg_params:
+                        writer.write(create_response(
+                            err.metadata or msg_params, str(err).encode(), True))
+                        await writer.drain()
+                    break
+                except ValueError as val:
+                    # The stream cannot be resynchronised after a bad header
+                    logger.info(val)
+                    break
+
+                logger.debug("Received message from %s", address)
+                process_time = None
+                error = False
+                if msg is None:
+                    send_msg, error = streamed
+                    if error:
+                        logger.warning(
+                            "Failed to process message from %s: %s", address, send_msg)
+                    reply = create_response(msg_params, send_msg, error)
+                else:
+                    # Decryption and parsing run off the event loop so other connections keep flowing
+                    processing = time.perf_counter()
+                    try:
+                        send_msg = await loop.run_in_executor(
+                            None, self.process_message, msg, msg_params)
+                        reply = create_response(msg_params, send_msg)
+                        process_time = time.perf_counter() - processing
+                    except Exception as err:
+                        logger.warning(
+                            "Failed to process message from %s: %s", address, err)
+                        reply = create_response(
+                            msg_params, "Failed to process message: {}".format(err).encode(), True)
+                        error = True
+                    finally:
+                        self.budget.release(len(msg))
+
+                writer.write(reply)
+                await writer.drain()
+                if self.metrics is not None:
+                    self.metrics.message_received(
+                        msg_params, process_time, error)
+                    self.metrics.reply_sent(time.perf_counter() - started)
+        except ConnectionResetError:
+            pass
+        finally:
+            self._connections -= 1
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+            logger.info("Client %s disconnected.", address)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionResetError:
+                pass
@@ -0,0 +1,187 @@
+"""
+Bulk transfers of many files, such as a directory tree, over a few persistent connections.
+
+The files are listed in a manifest sent first, then pipelined over a small pool of connections
+that take the next file from a shared list. The kernel is asked to read ahead the files a few
+places down the list, so the disk reads of the next files run while the current ones are sent.
+Every file is acknowledged on its own
+"""
+
+import glob
+import logging
+import os
+import threading
+from collections import namedtuple
+from .client import Client
+
+logger = logging.getLogger(__name__)
+
+# Files read ahead of the one being sent
+PREFETCH = 4
+
+# Outcome of one file of a bulk transfer
+FileResult = namedtuple("FileResult", ["name", "ok", "message"])
+
+
+def _walk(directory: str) -> list:
+    """
+    (path, name) of the files below a directory, named by their path relative to the parent
+    of the directory
+    """
+
+    root = os.path.dirname(os.path.abspath(directory))
+    files = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path):
+                files.append((path, os.path.relpath(os.path.abspath(path), root)))
+    return files
+
+
+def expand_inputs(inputs: list) -> list:
+    """
+    (path, name) of the files to send for a list of files, directories and glob patterns.
+    Directories are sent with everything below them, under their own name.
+    Names use / as separator whatever the platform
+    """
+
+    files = []
+    for item in inputs:
+        if glob.has_magic(item):
+            paths = sorted(glob.glob(item, recursive=True))
+            if not paths:
+                raise FileNotFoundError("No files match {}".format(item))
+        else:
+            paths = [item]
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(_walk(path))
+            elif os.path.isfile(path):
+                files.append((path, os.path.basename(path)))
+            elif path == item:
+                raise FileNotFoundError("Invalid input file path {}".format(path))
+
+    files = [(path, name.replace(os.sep, "/")) for path, name in files]
+    names = set()
+    for _, name in files:
+        if name in names:
+            raise ValueError("Two input files would be saved as {}".format(name))
+        names.add(name)
+    return files
+
+
+def read_file_list(stream) -> list:
+    """
+    Inputs listed one per line, blank lines are skipped
+    """
+
+    return [line.rstrip("\r\n") for line in stream if line.strip()]
+
+
+def _prefetch(path: str):
+    """
+    Asks the kernel to start reading a file into the page cache
+    """
+
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+class _FileQueue:
+    """
+    Files of a bulk transfer shared by the connections, in manifest order
+    """
+
+    def __init__(self, files: list):
+        self.files = files
+        self.position = 0
+        self.lock = threading.Lock()
+        for path, _ in files[:PREFETCH]:
+            _prefetch(path)
+
+    def next(self):
+        with self.lock:
+            if self.position >= len(self.files):
+                return None
+            index = self.position
+            self.position += 1
+        if index + PREFETCH < len(self.files):
+            _prefetch(self.files[index + PREFETCH][0])
+        return self.files[index]
+
+
+def _send_files(client: Client, queue: _FileQueue, encrypt: bool, results: dict):
+    """
+    Pipelines files from the queue over one connection until the queue is empty
+    """
+
+    names = {}
+    try:
+        while True:
+            item = queue.next()
+            if item is None:
+                break
+            path, name = item
+            try:
+                names[client.send_file(path, encrypt, name=name)] = name
+            except (FileNotFoundError, PermissionError) as err:
+                logger.warning("Skipping %s: %s", path, err)
+                results[name] = FileResult(name, False, str(err).encode())
+        for ack in client.flush():
+            results[names[ack.request_id]] = FileResult(names[ack.request_id], ack.ok,
+                                                        ack.message)
+    except OSError as err:
+        # The files of this connection that were not acknowledged are reported as failed
+        logger.warning("Connection to %s:%s failed: %s",
+                       client.host, client.host_port, err)
+
+
+def transfer_files(host: str, host_port: int, files: list, encrypt=True, connections=2,
+                   window=16) -> list:
+    """
+    Sends files over a pool of persistent connections, the manifest first.
+    Returns a FileResult of every file in the order of files
+    files: (path, name) of each file, see expand_inputs
+    connections: connections the files are spread over
+    window: files each connection sends ahead of their acknowledgements
+    """
+
+    if connections < 1:
+        raise ValueError("connections must be positive")
+    if not files:
+        return []
+    clients = []
+    try:
+        for _ in range(min(connections, len(files))):
+            client = Client(host, host_port, protocol_version=2, window=window)
+            clients.append(client)
+            client.connection()
+        reply = clients[0].transfer_manifest(
+            [(name, os.path.getsize(path)) for path, name in files], encrypt)
+        logger.info("Server reply: %s", reply.decode())
+
+        queue = _FileQueue(files)
+        results = {}
+        threads = [threading.Thread(target=_send_files, name="bulk-{}".format(index),
+                                    args=(client, queue, encrypt, results))
+                   for index, client in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for client in clients:
+            client.close()
+
+    return [results.get(name, FileResult(name, False, b"Not acknowledged"))
+            for _, name in files]
@@ -0,0 +1,301 @@
+"""
+Resumable chunked file transfers.
+
+A chunked transfer is identified by a 16 byte transfer id derived from the file. The client asks
+which ranges of the file the server is missing with a "resume" frame, then sends them as "chunk"
+frames that carry their offset and a CRC32 of their data. The server writes every chunk in place
+into a partial file and records it in a journal, so a transfer interrupted by a dropped connection
+continues from where it stopped. The file is moved into place once every range has arrived
+"""
+
+import bisect
+import hashlib
+import os
+import struct
+import threading
+import time
+import zlib
+from .limits import Limits
+from .utils import decrypt_message
+
+# Chunk payload: transfer id, file size, offset of the data, CRC32 of the data. The data follows
+CHUNK = struct.Struct("!16sQQI")
+# Resume query payload: transfer id, file size
+RESUME = struct.Struct("!16sQ")
+# Range of a file: offset, length. Journal records and resume replies are lists of them
+RANGE = struct.Struct("!QQ")
+CHUNK_SIZE = 1048576
+
+
+def file_transfer_id(path: str) -> bytes:
+    """
+    Transfer id of a file, the same as long as the file is not modified
+    """
+
+    stat = os.stat(path)
+    key = "{}|{}|{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha256(key.encode()).digest()[:16]
+
+
+def pack_ranges(ranges: list) -> bytes:
+    return b"".join(RANGE.pack(offset, length) for offset, length in ranges)
+
+
+def unpack_ranges(data: bytes) -> list:
+    if len(data) % RANGE.size:
+        raise ValueError("Invalid range list")
+    return [RANGE.unpack_from(data, offset) for offset in range(0, len(data), RANGE.size)]
+
+
+class PartialFile:
+    """
+    A file being received in chunks: the partial file the chunks are written into,
+    the journal of the ranges written so far and those ranges merged in memory
+    """
+
+    def __init__(self, directory: str, filename: str, transfer_id: bytes, size: int):
+        self.name = filename
+        self.filename = os.path.join(directory, "received_" + filename)
+        base = os.path.join(directory, ".received_{}.{}".format(
+            filename, transfer_id.hex()))
+        self.part_path = base + ".part"
+        self.journal_path = base + ".journal"
+        self.size = size
+        self.lock = threading.Lock()
+        # Sorted, non overlapping (start, end) ranges that have been written
+        self.ranges = []
+        # Bytes of the journal loaded into ranges
+        self._journal_size = 0
+        # Wall clock time of the last resume query or chunk, for expiring abandoned transfers
+        self.last_used = time.time()
+
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+                # The ranges journaled for another size do not describe this file
+                try:
+                    os.remove(self.journal_path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            os.close(fd)
+        try:
+            with open(self.journal_path, "r+b") as journal:
+                records = journal.read()
+                # A record cut short by a crash is dropped, its chunk is sent again
+                journal.truncate(len(records) - len(records) % RANGE.size)
+        except FileNotFoundError:
+            records = b""
+        self._load(records)
+
+    def _load(self, records: bytes):
+        for offset in range(0, len(records) - RANGE.size + 1, RANGE.size):
+            start, length = RANGE.unpack_from(records, offset)
+            self._add(start, start + length)
+        self._journal_size += len(records) - len(records) % RANGE.size
+
+    def refresh(self):
+        """
+        Loads the ranges other processes appended to the journal, a pre-forked server
+        receives the chunks of one file in several processes. Call with lock held
+        """
+
+        try:
+            with open(self.journal_path, "rb") as journal:
+                journal.seek(self._journal_size)
+                records = journal.read()
+        except FileNotFoundError:
+            return
+        self._load(records[:len(records) - len(records) % RANGE.size])
+
+    def _add(self, start: int, end: int):
+        index = bisect.bisect_left(self.ranges, (start, start))
+        # Merge with the ranges it overlaps or touches
+        if index and self.ranges[index - 1][1] >= start:
+            index -= 1
+        stop = index
+        while stop < len(self.ranges) and self.ranges[stop][0] <= end:
+            start = min(start, self.ranges[stop][0])
+            end = max(end, self.ranges[stop][1])
+            stop += 1
+        self.ranges[index:stop] = [(start, end)]
+
+    @property
+    def complete(self) -> bool:
+        return self.size == 0 or self.ranges == [(0, self.size)]
+
+    def missing(self) -> list:
+        """
+        The (offset, length) ranges that have not been written yet
+        """
+
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append((position, start - position))
+            position = end
+        if position < self.size:
+            missing.append((position, self.size - position))
+        return missing
+
+    def write(self, offset: int, data: bytes, sync=False):
+        """
+        Writes a chunk at its offset and records it in the journal
+        """
+
+        if offset + len(data) > self.size:
+            raise ValueError("Chunk ends past the end of the file")
+        self.last_used = time.time()
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            view = memoryview(data)
+            written = 0
+            while written < len(view):
+                written += os.pwrite(fd, view[written:], offset + written)
+            if sync:
+                # The journal must not list data that could still be lost
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self.lock:
+            # Records are appended with a single write, so appends of other processes never mix
+            with open(self.journal_path, "ab", buffering=0) as journal:
+                journal.write(RANGE.pack(offset, len(data)))
+            self._add(offset, offset + len(data))
+            self.refresh()
+
+    def finish(self) -> bool:
+        """
+        Moves the complete file into place and removes the journal.
+        Returns False if another process did it already
+        """
+
+        try:
+            os.replace(self.part_path, self.filename)
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def idle_since(self) -> float:
+        """
+        Wall clock time the transfer was last used, here or by another process writing
+        chunks of the same file
+        """
+
+        try:
+            return max(self.last_used, os.stat(self.part_path).st_mtime)
+        except FileNotFoundError:
+            return self.last_used
+
+    def discard(self):
+        """
+        Removes the partial file and the journal of an abandoned transfer
+        """
+
+        for path in (self.part_path, self.journal_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ChunkStore:
+    """
+    Partial files of the chunked transfers in progress, shared by all connections of a server
+    """
+
+    def __init__(self, directory=".", sync=False, limits=None):
+        """
+        directory: where partial files, journals and received files are kept
+        sync: fsync every chunk before it is recorded in the journal, so the journal
+        survives power loss and not only a crash of the server
+        limits: Limits whose max_file_size and partial_ttl apply, the Limits defaults when not given
+        """
+
+        self.directory = directory
+        self.sync = sync
+        self.limits = limits if limits is not None else Limits()
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _open(self, filename: str, transfer_id: bytes, size: int) -> PartialFile:
+        # Names are kept inside the directory
+        filename = os.path.basename(filename)
+        if not filename:
+            raise ValueError("Invalid file name")
+        if size > self.limits.max_file_size:
+            raise ValueError("File of {} bytes exceeds the limit of {} bytes".format(
+                size, self.limits.max_file_size))
+        with self._lock:
+            partial = self._files.get(transfer_id)
+            if partial is not None and partial.size == size and partial.name == filename:
+                partial.last_used = time.time()
+                return partial
+            if partial is not None:
+                partial.discard()
+            # Opening a transfer is rare enough to check all the others for expiry
+            self._expire()
+            partial = PartialFile(
+                self.directory, filename, transfer_id, size)
+            self._files[transfer_id] = partial
+            return partial
+
+    def _expire(self):
+        """
+        Forgets and removes the transfers that have gone without a chunk for partial_ttl.
+        Call with the lock held
+        """
+
+        deadline = time.time() - self.limits.partial_ttl
+        for transfer_id, partial in list(self._files.items()):
+            if partial.idle_since() < deadline:
+                del self._files[transfer_id]
+                partial.discard()
+
+    def _finish(self, transfer_id: bytes, partial: PartialFile) -> bool:
+        """
+        Moves a complete file into place, returns False if another connection or process already did
+        """
+
+        with self._lock:
+            if self._files.get(transfer_id) is not partial:
+                return False
+            del self._files[transfer_id]
+        return partial.finish()
+
+    def handle(self, msg: bytes, msg_params: dict) -> bytes:
+        """
+        Processes a resume or chunk frame and returns the reply message.
+        A resume reply lists the missing ranges
+        """
+
+        if msg_params["encrypt"]:
+            msg = decrypt_message(msg)
+
+        if msg_params["type"] == "resume":
+            transfer_id, size = RESUME.unpack_from(msg)
+            partial = self._open(msg_params["filename"], transfer_id, size)
+            with partial.lock:
+                partial.refresh()
+            if partial.complete:
+                self._finish(transfer_id, partial)
+            return pack_ranges(partial.missing())
+
+        transfer_id, size, offset, crc = CHUNK.unpack_from(msg)
+        data = memoryview(msg)[CHUNK.size:]
+        if zlib.crc32(data) != crc:
+            raise ValueError("Checksum mismatch in chunk at offset {}".format(offset))
+        partial = self._open(msg_params["filename"], transfer_id, size)
+        partial.write(offset, data, self.sync)
+        with partial.lock:
+            complete = partial.complete
+        # Chunks of a striped transfer arrive on several connections, only one gets the completion
+        if complete and self._finish(transfer_id, partial):
+            return b"Received File successfully"
+        return b"Received chunk"
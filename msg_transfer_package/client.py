@@ -2,22 +2,43 @@
 Network client module
 """
 
-import configparser
+import hashlib
+import itertools
 import logging
 import os
 import socket
-from .utils import encrypt_message, serialize_object, create_headers
+import sys
+import threading
+import zlib
+from collections import namedtuple
+from .chunks import CHUNK, CHUNK_SIZE, RESUME, file_transfer_id, unpack_ranges
+from .compression import COMPRESSION_METHODS, compress_payload
+from .dedup import HAVE_IT, PROBE, file_digest
+from .delta import SIGNATURE_QUERY, parse_signatures, write_delta
+from .manifest import pack_manifest
+from .utils import (
+    CODECS,
+    FLAG_STORE,
+    V2_HEADER,
+    create_headers,
+    create_headers_v2,
+    encrypt_message,
+    get_params_v2,
+    new_cipher,
+    pack_batch,
+    serialize_object,
+    set_header_trailer,
+)
 
 logger = logging.getLogger(__name__)
 
-logging.basicConfig(
-    format="CLIENT: %(asctime)s %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[logging.FileHandler("client_log.log"), logging.StreamHandler()],
-)
-
 BUFFER_SIZE = 8192
 HEADER_SIZE = 16
+# Holds back a write until the next one, where the platform supports it
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
+# Server reply to a pipelined message
+Ack = namedtuple("Ack", ["request_id", "ok", "message"])
 
 
 class Client(socket.socket):
@@ -25,15 +46,57 @@ class Client(socket.socket):
     Client class to send data to the receiving server
     """
 
-    def __init__(self, host: str, host_port: int, *args, **kwargs):
+    def __init__(self, host: str, host_port: int, *args, protocol_version=1, window=16,
+                 batch_linger=0.005, batch_bytes=65536, compression: str = None,
+                 compression_level: int = None, **kwargs):
         """
         host: ip address or hostname of the receiving server
         host_port: The port of the receiving server
+        protocol_version: 1 for the text headers every server understands, 2 for compact binary headers
+        window: number of pipelined messages that may wait for their reply
+        batch_linger: seconds batch_object waits for more objects before sending a batch
+        batch_bytes: serialized size at which a batch is sent without waiting
+        compression: zlib, bz2 or lzma to compress objects and batches that are worth it, needs protocol v2
+        compression_level: compression level of the method, None for its default
         """
 
+        if compression is not None:
+            if compression not in COMPRESSION_METHODS:
+                raise ValueError(
+                    "Unknown compression method {}".format(compression))
+            if protocol_version != 2:
+                raise ValueError("Compression needs protocol_version 2")
         super().__init__(*args, **kwargs)
         self.host = host
         self.host_port = host_port
+        self.protocol_version = protocol_version
+        self.window = window
+        self.batch_linger = batch_linger
+        self.batch_bytes = batch_bytes
+        self.compression = compression
+        self.compression_level = compression_level
+        self._request_ids = itertools.count(1)
+        # request ids of pipelined messages still waiting for their reply
+        self._in_flight = set()
+        self._acks = []
+        # The linger timer sends batches from its own thread
+        self._lock = threading.RLock()
+        self._batch = []
+        self._batch_size = 0
+        self._batch_format = None
+        self._batch_timer = None
+        self._batch_error = None
+        # Writes started on the connection. A transfer that failed before starting one
+        # sent nothing and can be retried on another connection
+        self.writes = 0
+
+    def sendall(self, data, flags=0):
+        self.writes += 1
+        return super().sendall(data, flags)
+
+    def sendfile(self, file, offset=0, count=None):
+        self.writes += 1
+        return super().sendfile(file, offset, count)
 
     def connection(self):
         """
@@ -41,84 +104,548 @@ class Client(socket.socket):
         """
 
         self.connect((self.host, self.host_port))
-        logger.info("Connected to Host: {}, Port: {}".format(
-            self.host, self.host_port))
+        # Every message is written whole, small ones must not wait for the previous ACK
+        self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.info("Connected to Host: %s, Port: %s",
+                    self.host, self.host_port)
+
+    def is_alive(self) -> bool:
+        """
+        Checks without blocking that the connection is still open and has no unread data
+        """
+
+        try:
+            data = self.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        # Either the server closed the connection or it sent something nobody asked for
+        return False
+
+    def _receive_reply(self):
+        """
+        Receives one reply, returns its v2 metadata (None for v1) and its message
+        """
 
-    def receive_data(self):
+        reply_params = None
+        if self.protocol_version == 2:
+            reply_params = get_params_v2(self._recv_exactly(V2_HEADER.size))
+            set_header_trailer(reply_params, self._recv_exactly(
+                reply_params["trailer_length"]))
+            message_length = reply_params["length"]
+        else:
+            message_header = self._recv_exactly(HEADER_SIZE)
+            message_length = int(message_header.decode("utf-8").strip())
+        return reply_params, self._recv_exactly(message_length)
+
+    def receive_data(self) -> bytes:
         """
         Received the reply from server
         """
 
-        message_header = self.recv(HEADER_SIZE)
-        # print(message_header.decode())
-        message_length = int(message_header.decode("utf-8").strip())
-        message = self.recv(message_length)
-        logger.info("Server reply: {}".format(message))
+        # Replies to pipelined messages come first
+        while self._in_flight:
+            self._receive_ack()
 
-    def transfer_object(self, serialization_method: str, obj: any, encrypt=True):
+        reply_params, message = self._receive_reply()
+        if reply_params and reply_params["error"]:
+            logger.warning("Server error: %s", message)
+        else:
+            logger.debug("Server reply: %s", message)
+        return message
+
+    def _receive_ack(self):
         """
-        Transfers a python object to the server
-        serialization_method: enum (binary, json or xml).
+        Receives the reply to one pipelined message
         """
 
-        converted_object = serialize_object(obj, serialization_method)
+        reply_params, message = self._receive_reply()
+        request_id = reply_params.get("request_id")
+        if request_id not in self._in_flight:
+            raise ValueError(
+                "Reply for unknown request id {}".format(request_id))
+        self._in_flight.remove(request_id)
+        ack = Ack(request_id, not reply_params["error"], message)
+        if not ack.ok:
+            logger.warning("Request %s failed: %s", request_id, message)
+        self._acks.append(ack)
+
+    def _next_request_id(self) -> int:
+        """
+        Waits until the window has room for another pipelined message and returns its request id
+        """
+
+        if self.protocol_version != 2:
+            raise ValueError("Pipelined transfers need protocol_version 2")
+        while len(self._in_flight) >= self.window:
+            self._receive_ack()
+        request_id = next(self._request_ids)
+        self._in_flight.add(request_id)
+        return request_id
+
+    def flush(self) -> list:
+        """
+        Sends the current batch and waits for the replies to all pipelined messages.
+        Returns the Acks received since the last flush, failed messages have ok set to False
+        """
+
+        with self._lock:
+            self._raise_batch_error()
+            if self._batch:
+                self._send_batch()
+            while self._in_flight:
+                self._receive_ack()
+            acks, self._acks = self._acks, []
+            return acks
+
+    def received_acks(self) -> list:
+        """
+        Returns the Acks received since the last flush or call, without waiting for the replies
+        to the messages still in flight
+        """
+
+        with self._lock:
+            acks, self._acks = self._acks, []
+            return acks
+
+    def _recv_exactly(self, size: int) -> bytes:
+        """
+        Receives exactly size bytes, however the server's reply is split by the network
+        """
+
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            nbytes = self.recv_into(view[received:])
+            if not nbytes:
+                raise ConnectionError("Server closed the connection")
+            received += nbytes
+        return bytes(data)
+
+    def _create_headers(self, data_type: str, encrypt: bool, param: str, length: int,
+                        request_id: int = None, compression: str = None, flags=0) -> bytes:
+        """
+        Creates the message header in the configured protocol version
+        """
+
+        if self.protocol_version == 2:
+            return create_headers_v2(data_type, encrypt, param, length, flags,
+                                     request_id=request_id, compression=compression)
+        return bytes(create_headers(HEADER_SIZE, data_type, encrypt, param, length), "utf-8")
+
+    def _send_object(self, serialization_method: str, obj: any, encrypt: bool, request_id: int = None):
+        """
+        Serializes and sends a python object
+        """
+
+        self._send_serialized(serialization_method, serialize_object(obj, serialization_method),
+                              encrypt, request_id)
+
+    def _send_serialized(self, serialization_method: str, converted_object: bytes, encrypt: bool,
+                         request_id: int = None, flags=0):
+        """
+        Sends an already serialized python object
+        """
+
+        # Compress before encrypting, ciphertext does not compress
+        compression, converted_object = compress_payload(
+            converted_object, self.compression, self.compression_level)
         if encrypt:
             converted_object = encrypt_message(converted_object)
 
-        metadata = create_headers(
-            HEADER_SIZE, "object", encrypt, serialization_method, len(
-                converted_object)
-        )
+        metadata = self._create_headers("object", encrypt, serialization_method,
+                                        len(converted_object), request_id, compression, flags)
         # send object:
-        self.sendall(bytes(metadata, "utf-8") + converted_object)
-        logger.info("Serialized object sent to server")
+        self.sendall(metadata + converted_object)
+        logger.debug("Serialized object sent to server")
+
+    def transfer_object(self, serialization_method: str, obj: any, encrypt=True, dedup=False):
+        """
+        Transfers a python object to the server
+        serialization_method: enum (binary, json or xml).
+        dedup: send the hash of the serialized object first and the object itself only if the
+        server does not hold it already. Needs protocol v2
+        """
 
-        self.receive_data()
+        with self._lock:
+            if not dedup:
+                self._send_object(serialization_method, obj, encrypt)
+                return self.receive_data()
+            converted_object = serialize_object(obj, serialization_method)
+            digest = hashlib.sha256(converted_object).digest()
+            if self._probe("", digest, len(converted_object),
+                           CODECS[serialization_method.lower()], encrypt):
+                return HAVE_IT
+            self._send_serialized(serialization_method, converted_object, encrypt,
+                                  flags=FLAG_STORE)
+            return self.receive_data()
+
+    def send_object(self, serialization_method: str, obj: any, encrypt=True) -> int:
+        """
+        Sends a python object without waiting for the reply, which is collected by flush.
+        Returns the request id of the message
+        """
+
+        with self._lock:
+            request_id = self._next_request_id()
+            self._send_object(serialization_method, obj, encrypt, request_id)
+            return request_id
 
-    def transfer_file(self, input_file_path: str, encrypt=True):
+    def batch_object(self, serialization_method: str, obj: any, encrypt=True):
+        """
+        Adds a python object to the current batch. The batch is sent as one message
+        once it reaches batch_bytes or batch_linger seconds after its first object,
+        flush sends it straight away. Each batch gets one Ack
+        """
+
+        if self.protocol_version != 2:
+            raise ValueError("Batching needs protocol_version 2")
+        converted_object = serialize_object(obj, serialization_method)
+        with self._lock:
+            self._raise_batch_error()
+            batch_format = (serialization_method, encrypt)
+            if self._batch and self._batch_format != batch_format:
+                self._send_batch()
+            if not self._batch:
+                self._batch_format = batch_format
+                self._batch_timer = threading.Timer(
+                    self.batch_linger, self._linger_expired, (self._batch,))
+                self._batch_timer.daemon = True
+                self._batch_timer.start()
+            self._batch.append(converted_object)
+            self._batch_size += len(converted_object)
+            if self._batch_size >= self.batch_bytes:
+                self._send_batch()
+
+    def _linger_expired(self, batch: list):
+        """
+        Sends the batch the timer was started for, unless it was sent already
+        """
+
+        with self._lock:
+            if batch is not self._batch:
+                return
+            try:
+                self._send_batch()
+            except Exception as err:
+                self._batch_error = err
+
+    def _raise_batch_error(self):
+        """
+        Raises the error the linger timer ran into while sending a batch
+        """
+
+        if self._batch_error is not None:
+            err, self._batch_error = self._batch_error, None
+            raise err
+
+    def _send_batch(self):
+        """
+        Sends the current batch as one pipelined message
+        """
+
+        batch, self._batch = self._batch, []
+        self._batch_size = 0
+        self._batch_timer.cancel()
+        serialization_method, encrypt = self._batch_format
+
+        compression, payload = compress_payload(
+            pack_batch(batch), self.compression, self.compression_level)
+        if encrypt:
+            payload = encrypt_message(payload)
+        request_id = self._next_request_id()
+        self.sendall(create_headers_v2("batch", encrypt, serialization_method, len(payload),
+                                       request_id=request_id, compression=compression) + payload)
+        logger.debug("Batch of %d objects sent to server", len(batch))
+
+    def transfer_file(self, input_file_path: str, encrypt=True, dedup=False):
         """
         Transfers a file to the server.
+        The file is streamed, so memory use does not depend on the file size.
+        dedup: send the hash of the file first and the file itself only if the server
+        does not hold its contents already. Needs protocol v2
+        """
+
+        with self._lock:
+            if dedup:
+                digest, filesize = file_digest(input_file_path)
+                if self._probe(os.path.basename(input_file_path), digest, filesize, 0, encrypt):
+                    logger.info("Server already holds %s", input_file_path)
+                    return HAVE_IT
+            self._send_file(input_file_path, encrypt,
+                            flags=FLAG_STORE if dedup else 0)
+            return self.receive_data()
+
+    def send_file(self, input_file_path: str, encrypt=True, name: str = None) -> int:
+        """
+        Sends a file without waiting for the reply, which is collected by flush.
+        Returns the request id of the message
+        name: relative path, with / as separator, the server saves the file under.
+        The base name of the file by default
+        """
+
+        with self._lock:
+            request_id = self._next_request_id()
+            try:
+                self._send_file(input_file_path, encrypt, request_id, name=name)
+            except (FileNotFoundError, PermissionError):
+                # The file could not be opened, nothing was sent
+                self._in_flight.discard(request_id)
+                raise
+            return request_id
+
+    def _send_file(self, input_file_path: str, encrypt: bool, request_id: int = None, flags=0,
+                   name: str = None):
+        """
+        Streams a file to the server
         """
 
         # get the file name and size
-        filename = os.path.basename(input_file_path)
+        filename = name or os.path.basename(input_file_path)
         filesize = os.path.getsize(input_file_path)
 
-        metadata = create_headers(
-            HEADER_SIZE, "file", encrypt, filename, filesize)
-
-        file_data = b""
+        metadata = self._create_headers(
+            "file", encrypt, filename, filesize, request_id, flags=flags)
 
         # start sending the file
-        logger.info("Sending file {} to server ...".format(filename))
+        logger.info("Sending file %s to server ...", filename)
 
         with open(input_file_path, "rb") as file:
-            while True:
-                # read the buffer size of bytes from the file
-                bytes_read = file.read(BUFFER_SIZE)
-                if not bytes_read:
-                    # file transfer is complete
-                    break
-                file_data += bytes_read
-
-        # Encrypt the file data bytes
+            sent = self._send_stream(metadata, file, filesize, encrypt)
+
+        if sent != filesize:
+            raise OSError("{} changed size while being sent".format(filename))
+        logger.info("%s transfer complete", filename)
+
+    def transfer_file_resumable(self, input_file_path: str, encrypt=True, chunk_size=CHUNK_SIZE,
+                                attempts=3) -> bytes:
+        """
+        Transfers a file in checksummed chunks that the server writes as they arrive.
+        The server is first asked which ranges it is missing, so calling this again
+        on a new connection after the previous one dropped only sends the rest of the file.
+        Needs protocol v2
+        attempts: times the missing ranges are sent before giving up on chunks the server rejected
+        """
+
+        if self.protocol_version != 2:
+            raise ValueError("Resumable transfers need protocol_version 2")
+        filename = os.path.basename(input_file_path)
+        transfer_id = file_transfer_id(input_file_path)
+        filesize = os.path.getsize(input_file_path)
+
+        with self._lock, open(input_file_path, "rb") as file:
+            for _ in range(attempts):
+                missing = self.query_missing(
+                    filename, transfer_id, filesize, encrypt)
+                if not missing:
+                    return b"Received File successfully"
+                logger.info("Sending %d missing bytes of %s to server ...",
+                            sum(length for _, length in missing), filename)
+                request_ids = set()
+                for offset, length in missing:
+                    end = offset + length
+                    while offset < end:
+                        request_ids.add(self.send_chunk(
+                            file, filename, transfer_id, filesize, offset,
+                            min(chunk_size, end - offset), encrypt))
+                        offset += chunk_size
+                while self._in_flight:
+                    self._receive_ack()
+
+                # Chunk replies are not left for flush
+                acks = [ack for ack in self._acks if ack.request_id in request_ids]
+                self._acks = [
+                    ack for ack in self._acks if ack.request_id not in request_ids]
+                completed = [ack for ack in acks if ack.ok and ack.message ==
+                             b"Received File successfully"]
+                if completed:
+                    logger.info("%s transfer complete", filename)
+                    return completed[0].message
+            raise OSError("{} could not be transferred after {} attempts".format(
+                filename, attempts))
+
+    def transfer_file_delta(self, input_file_path: str, encrypt=True, block_size=0) -> bytes:
+        """
+        Transfers a new version of a file the server already received, sending only the parts
+        that changed. The server sends the signatures of the blocks of its copy and rebuilds
+        the file from those it holds and the literal data in between.
+        The whole file is sent when the server has no copy or the delta would not be smaller.
+        Needs protocol v2
+        block_size: size of the compared blocks, 0 lets the server pick one for the file size
+        """
+
+        if self.protocol_version != 2:
+            raise ValueError("Delta transfers need protocol_version 2")
+        import tempfile
+
+        filename = os.path.basename(input_file_path)
+
+        with self._lock:
+            basis_size, block_size, blocks = parse_signatures(
+                self._query_signatures(filename, block_size, encrypt))
+            if not blocks:
+                logger.info("Server has no copy of %s, sending all of it", filename)
+                self._send_file(input_file_path, encrypt)
+                return self.receive_data()
+
+            with tempfile.TemporaryFile() as delta:
+                literal_bytes = write_delta(
+                    input_file_path, basis_size, block_size, blocks, delta)
+                size = delta.tell()
+                if size >= os.path.getsize(input_file_path):
+                    logger.info("%s changed too much for a delta, sending all of it", filename)
+                    self._send_file(input_file_path, encrypt)
+                    return self.receive_data()
+
+                logger.info("Sending delta of %s to server: %d bytes, %d of them literal ...",
+                            filename, size, literal_bytes)
+                delta.seek(0)
+                sent = self._send_stream(
+                    create_headers_v2("delta", encrypt, filename, size), delta, size, encrypt)
+            if sent != size:
+                raise OSError("Delta of {} could not be sent".format(filename))
+            return self.receive_data()
+
+    def transfer_manifest(self, entries: list, encrypt=True) -> bytes:
+        """
+        Sends the manifest of a bulk transfer, the (name, size) of every file that follows.
+        The server checks the names and creates their directories, an invalid name raises
+        OSError before any file is sent. Needs protocol v2
+        """
+
+        if self.protocol_version != 2:
+            raise ValueError("Manifests need protocol_version 2")
+        with self._lock:
+            return self._request("manifest", "", pack_manifest(entries), encrypt)
+
+    def _request(self, frame_type: str, name: str, payload: bytes, encrypt: bool) -> bytes:
+        """
+        Sends a request after the replies to all pipelined messages and returns the message
+        of its reply, a reply that reports an error raises OSError
+        """
+
         if encrypt:
-            file_data = encrypt_message(file_data)
+            payload = encrypt_message(payload)
+        while self._in_flight:
+            self._receive_ack()
+        self.sendall(create_headers_v2(
+            frame_type, encrypt, name, len(payload)) + payload)
+        reply_params, message = self._receive_reply()
+        if reply_params["error"]:
+            raise OSError("Server error: {}".format(message.decode()))
+        return message
+
+    def _query_signatures(self, filename: str, block_size: int, encrypt: bool) -> bytes:
+        """
+        Asks the server for the block signatures of its copy of a file
+        """
 
-        self.sendall(bytes(metadata, "utf-8") + file_data)
-        logger.info("{} transfer complete".format(filename))
-        self.receive_data()
+        return self._request("signature", filename, SIGNATURE_QUERY.pack(block_size), encrypt)
+
+    def query_missing(self, filename: str, transfer_id: bytes, filesize: int,
+                      encrypt=True) -> list:
+        """
+        Asks the server which (offset, length) ranges of a chunked transfer it has not received,
+        after the replies to all pipelined messages. Needs protocol v2
+        """
+
+        with self._lock:
+            return unpack_ranges(self._request(
+                "resume", filename, RESUME.pack(transfer_id, filesize), encrypt))
+
+    def _probe(self, filename: str, digest: bytes, size: int, codec_id: int, encrypt: bool) -> bool:
+        """
+        Asks the server whether it holds content with this sha256, which it then uses
+        in place of the payload. codec_id is 0 for a file
+        """
+
+        if self.protocol_version != 2:
+            raise ValueError("Deduplication needs protocol_version 2")
+        return self._request(
+            "probe", filename, PROBE.pack(digest, size, codec_id), encrypt) == HAVE_IT
+
+    def send_chunk(self, file, filename: str, transfer_id: bytes, filesize: int, offset: int,
+                   length: int, encrypt=True) -> int:
+        """
+        Reads and sends one chunk of a file as a pipelined message, returns its request id.
+        The reply is collected by flush or received_acks
+        file: the open file, read from offset
+        transfer_id: file_transfer_id of the file
+        """
+
+        file.seek(offset)
+        data = file.read(length)
+        if len(data) != length:
+            raise OSError("{} changed size while being sent".format(filename))
+        payload = CHUNK.pack(transfer_id, filesize, offset,
+                             zlib.crc32(data)) + data
+        if encrypt:
+            payload = encrypt_message(payload)
+        with self._lock:
+            request_id = self._next_request_id()
+            self.sendall(create_headers_v2("chunk", encrypt, filename, len(payload),
+                                           request_id=request_id) + payload)
+            return request_id
+
+    def _send_stream(self, metadata: bytes, file, count: int, encrypt: bool) -> int:
+        """
+        Sends a header followed by up to count bytes of file, returns the bytes of file sent.
+        A file that fits in one buffer goes out in the same write as its header,
+        the header of a longer one is held back until the first buffer follows
+        """
+
+        if count <= BUFFER_SIZE:
+            data = file.read(count)
+            if encrypt:
+                data = encrypt_message(data)
+            self.sendall(metadata + data)
+            return len(data)
+        self.sendall(metadata, MSG_MORE)
+        if encrypt:
+            return self._send_encrypted(file, count)
+        # The kernel copies the file straight to the socket
+        return self.sendfile(file, 0, count)
+
+    def _send_encrypted(self, file, count: int) -> int:
+        """
+        Reads, encrypts and sends up to count bytes of file one buffer at a time
+        """
+
+        cipher = new_cipher()
+        plain = bytearray(BUFFER_SIZE)
+        encrypted = bytearray(BUFFER_SIZE)
+        plain_view = memoryview(plain)
+        encrypted_view = memoryview(encrypted)
+        sent = 0
+        while sent < count:
+            bytes_read = file.readinto(
+                plain_view[:min(BUFFER_SIZE, count - sent)])
+            if not bytes_read:
+                # file transfer is complete
+                break
+            cipher.encrypt(plain_view[:bytes_read],
+                           output=encrypted_view[:bytes_read])
+            self.sendall(encrypted_view[:bytes_read])
+            sent += bytes_read
+        return sent
 
 
 def run_with_config(config_file_path="", input_file: str = None, do_encryot: bool = False):
     """
     Starts running the client using provided config file, server hostname/ip address and server port
+    input_file: file to send. A directory or a glob pattern sends every file it matches,
+    - sends the files listed on stdin. Without one the object in the config file is sent
     """
 
     if not os.path.isfile(config_file_path):
         print("Invalid config file path")
         return
 
+    import configparser
+    import glob
+
     config = configparser.ConfigParser()
     config.read(config_file_path)
 
@@ -141,6 +668,63 @@ def run_with_config(config_file_path="", input_file: str = None, do_encryot: boo
         print("Missing a valid SERVER_OPTIONS.host_port in config file")
         return
 
+    # Parse protocol version, v1 is understood by every server
+    try:
+        protocol_version = config.getint(
+            "SERVER_OPTIONS", "protocol_version", fallback=1)
+    except ValueError:
+        protocol_version = 0
+    if protocol_version not in (1, 2):
+        print("SERVER_OPTIONS.protocol_version must be 1 or 2")
+        return
+
+    # Parse compression, only protocol v2 can signal it
+    compression = config.get("SERVER_OPTIONS", "compression", fallback="none")
+    if compression == "none":
+        compression = None
+    elif compression not in COMPRESSION_METHODS or protocol_version != 2:
+        print("SERVER_OPTIONS.compression must be none, zlib, bz2 or lzma and needs protocol_version 2")
+        return
+    try:
+        compression_level = config.getint(
+            "SERVER_OPTIONS", "compression_level", fallback=None)
+    except ValueError:
+        print("SERVER_OPTIONS.compression_level must be an integer")
+        return
+
+    try:
+        connections = config.getint("SERVER_OPTIONS", "connections", fallback=2)
+    except ValueError:
+        connections = 0
+    if connections < 1:
+        print("SERVER_OPTIONS.connections must be a positive integer")
+        return
+
+    # Several files are sent in bulk over a pool of connections
+    if input_file and (input_file == "-" or os.path.isdir(input_file) or
+                       glob.has_magic(input_file)):
+        from .bulk import expand_inputs, read_file_list, transfer_files
+
+        if protocol_version != 2:
+            print("Sending several files needs SERVER_OPTIONS.protocol_version 2")
+            return
+        try:
+            inputs = read_file_list(sys.stdin) if input_file == "-" else [input_file]
+            files = expand_inputs(inputs)
+        except (OSError, ValueError) as err:
+            print(err)
+            return
+        try:
+            results = transfer_files(host, host_port, files, do_encryot, connections)
+        except OSError as err:
+            print(f"Could not send files to {host}:{host_port}: {err}")
+            return
+        failed = [result for result in results if not result.ok]
+        for result in failed:
+            print("Failed to send {}: {}".format(result.name, result.message.decode()))
+        logger.info("Sent %d of %d files", len(results) - len(failed), len(results))
+        return
+
     # If input file is specified
     if input_file != "":
         if not os.path.isfile(input_file):
@@ -158,12 +742,13 @@ def run_with_config(config_file_path="", input_file: str = None, do_encryot: boo
     try:
         host = config["SERVER_OPTIONS"]["host"]
         host_port = int(config["SERVER_OPTIONS"]["host_port"])
-        client = Client(host, host_port)
-        client.connection()
-        if input_file != "":
-            client.transfer_file(input_file, do_encryot)
-        else:
-            client.transfer_object(ser_method, obj, do_encryot)
+        with Client(host, host_port, protocol_version=protocol_version, compression=compression,
+                    compression_level=compression_level) as client:
+            client.connection()
+            if input_file != "":
+                client.transfer_file(input_file, do_encryot)
+            else:
+                client.transfer_object(ser_method, obj, do_encryot)
 
     except OSError:
         print(f"Could not connect to {host}{host_port}")
@@ -0,0 +1,441 @@
+"""
+Compact schema-less binary serialization, safe to decode from the network.
+
+Every value starts with a one byte tag. Integers are zigzag varints, strings and
+bytes are varint length prefixed, lists and dicts are varint counts of the values
+that follow. Only None, bool, int, float, str, bytes, list, tuple and dict are supported,
+so decoding cannot run code the way pickle can.
+
+Lists whose items all have the same type are packed so they decode in a few calls instead of
+one per item: numbers and bools as arrays, strings as one utf-8 blob of the distinct strings
+and an array of indices into them, lists as their lengths and one packed list of all their
+items, and dicts that all have the same keys as a table of the keys and one packed list per key
+"""
+
+import gc
+import struct
+import sys
+from array import array
+from itertools import accumulate
+from operator import itemgetter
+
+NONE = 0x00
+FALSE = 0x01
+TRUE = 0x02
+INT = 0x03
+FLOAT = 0x04
+STR = 0x05
+BYTES = 0x06
+LIST = 0x07
+DICT = 0x08
+# Packed lists: INTS and INDEX arrays are a typecode byte, then the array
+INTS = 0x09
+FLOATS = 0x0a
+BOOLS = 0x0b
+STRS = 0x0c
+TABLE = 0x0d
+LISTS = 0x0e
+# Integers 0 to 127 are stored in the tag itself
+FIXINT = 0x80
+
+FLOAT_FORMAT = struct.Struct("!d")
+# Deepest nesting of lists and dicts accepted when decoding
+MAX_DEPTH = 100
+# Shorter lists are not worth packing
+MIN_PACKED = 4
+# Arrays are sent little endian
+SWAP_BYTES = sys.byteorder != "little"
+# Smallest array typecode holding a range of integers, signed then unsigned
+SIGNED_TYPECODES = (("b", 1 << 7), ("h", 1 << 15), ("i", 1 << 31), ("q", 1 << 63))
+UNSIGNED_TYPECODES = (("B", 1 << 8), ("H", 1 << 16), ("I", 1 << 32), ("Q", 1 << 64))
+TYPECODES = {ord(typecode): array(typecode).itemsize for typecode in "bhiqBHIQ"}
+
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_array(out: bytearray, values, low: int, high: int, typecodes=SIGNED_TYPECODES):
+    """
+    Writes integers between low and high as an array of the smallest typecode that holds them
+    """
+
+    for typecode, limit in typecodes:
+        if high < limit and (low >= -limit if typecode.islower() else low >= 0):
+            break
+    packed = array(typecode, values)
+    if SWAP_BYTES:
+        packed.byteswap()
+    out.append(ord(typecode))
+    out += packed.tobytes()
+
+
+def _encode_strs(out: bytearray, values):
+    distinct = dict.fromkeys(values)
+    text = "".join(distinct)
+    data = text.encode()
+    out.append(STRS)
+    _write_varint(out, len(values))
+    _write_varint(out, len(distinct))
+    lengths = list(map(len, distinct))
+    _write_array(out, lengths, 0, max(lengths), UNSIGNED_TYPECODES)
+    _write_varint(out, len(data))
+    out += data
+    if len(distinct) != len(values):
+        for index, value in enumerate(distinct):
+            distinct[value] = index
+        _write_array(out, list(map(distinct.__getitem__, values)),
+                     0, len(distinct) - 1, UNSIGNED_TYPECODES)
+
+
+def _encode_list(out: bytearray, obj):
+    """
+    Writes a list or tuple, packed when its items allow it
+    """
+
+    if len(obj) >= MIN_PACKED:
+        types = set(map(type, obj))
+        if len(types) == 1:
+            item_type = types.pop()
+            if item_type is int:
+                low, high = min(obj), max(obj)
+                if -1 << 63 <= low and high < 1 << 63:
+                    out.append(INTS)
+                    _write_varint(out, len(obj))
+                    _write_array(out, obj, low, high)
+                    return
+            elif item_type is str:
+                _encode_strs(out, obj)
+                return
+            elif item_type is float:
+                packed = array("d", obj)
+                if SWAP_BYTES:
+                    packed.byteswap()
+                out.append(FLOATS)
+                _write_varint(out, len(obj))
+                out += packed.tobytes()
+                return
+            elif item_type is bool:
+                out.append(BOOLS)
+                _write_varint(out, len(obj))
+                out += bytes(obj)
+                return
+            elif item_type is list or item_type is tuple:
+                lengths = list(map(len, obj))
+                out.append(LISTS)
+                _write_varint(out, len(obj))
+                _write_array(out, lengths, 0, max(lengths), UNSIGNED_TYPECODES)
+                _encode_list(out, [value for items in obj for value in items])
+                return
+            elif item_type is dict:
+                keys = tuple(obj[0])
+                if keys and all(map(len(keys).__eq__, map(len, obj))):
+                    # Dicts of the same size that all hold the keys have no other keys
+                    try:
+                        rows = list(map(itemgetter(*keys), obj))
+                    except KeyError:
+                        rows = None
+                    if rows is not None:
+                        out.append(TABLE)
+                        _write_varint(out, len(obj))
+                        _encode_list(out, keys)
+                        if len(keys) == 1:
+                            _encode_list(out, rows)
+                        else:
+                            for column in zip(*rows):
+                                _encode_list(out, column)
+                        return
+
+    out.append(LIST)
+    _write_varint(out, len(obj))
+    for value in obj:
+        _encode(out, value)
+
+
+def _encode(out: bytearray, obj):
+    # Exact type checks first, they are the common and the fast case.
+    # bool is checked before int, it is a subclass of it
+    obj_type = type(obj)
+    if obj_type is str:
+        data = obj.encode()
+        out.append(STR)
+        _write_varint(out, len(data))
+        out += data
+    elif obj_type is int:
+        if 0 <= obj < 0x80:
+            out.append(FIXINT | obj)
+        else:
+            out.append(INT)
+            _write_varint(out, obj << 1 if obj >= 0 else ((-obj) << 1) - 1)
+    elif obj_type is dict:
+        out.append(DICT)
+        _write_varint(out, len(obj))
+        for key, value in obj.items():
+            _encode(out, key)
+            _encode(out, value)
+    elif obj_type is list or obj_type is tuple:
+        _encode_list(out, obj)
+    elif obj is None:
+        out.append(NONE)
+    elif obj is True:
+        out.append(TRUE)
+    elif obj is False:
+        out.append(FALSE)
+    elif obj_type is float:
+        out.append(FLOAT)
+        out += FLOAT_FORMAT.pack(obj)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        out.append(BYTES)
+        _write_varint(out, len(obj))
+        out += obj
+    elif isinstance(obj, (str, int, float, dict, list, tuple)):
+        # Subclasses are encoded as their base type
+        for base in (str, int, float, dict, list):
+            if isinstance(obj, base):
+                _encode(out, base(obj))
+                break
+        else:
+            _encode(out, list(obj))
+    else:
+        raise TypeError(
+            "Type {} cannot be serialized".format(type(obj).__name__))
+
+
+def _pause_gc() -> bool:
+    """
+    Stops the cyclic garbage collector while a large value is encoded or decoded, returns
+    whether it has to be started again. The values cannot form cycles, but each of the
+    collections the new containers would trigger scans every object alive
+    """
+
+    collect = gc.isenabled()
+    if collect:
+        gc.disable()
+    return collect
+
+
+def dumps(obj) -> bytes:
+    """
+    Serializes the python object
+    """
+
+    out = bytearray()
+    collect = _pause_gc()
+    try:
+        _encode(out, obj)
+    finally:
+        if collect:
+            gc.enable()
+    return bytes(out)
+
+
+def _read_varint(buf, pos: int):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _read_array(buf, pos: int, count: int):
+    """
+    Reads an array of count integers written by _write_array, returns it as a list
+    and the position after it
+    """
+
+    itemsize = TYPECODES.get(buf[pos])
+    if itemsize is None:
+        raise ValueError("Unknown array typecode {:#x}".format(buf[pos]))
+    values = array(chr(buf[pos]))
+    pos += 1
+    end = pos + count * itemsize
+    if end > len(buf):
+        raise ValueError("Truncated value")
+    values.frombytes(buf[pos:end])
+    if SWAP_BYTES:
+        values.byteswap()
+    return values.tolist(), end
+
+
+def _decode_strs(buf, pos: int):
+    count, pos = _read_varint(buf, pos)
+    distinct, pos = _read_varint(buf, pos)
+    lengths, pos = _read_array(buf, pos, distinct)
+    size, pos = _read_varint(buf, pos)
+    end = pos + size
+    if end > len(buf):
+        raise ValueError("Truncated value")
+    text = str(buf[pos:end], "utf-8")
+    ends = list(accumulate(lengths))
+    if (ends[-1] if ends else 0) != len(text):
+        raise ValueError("String lengths do not match their data")
+    values = list(map(text.__getitem__, map(slice, [0] + ends, ends)))
+    if distinct == count:
+        return values, end
+    indices, end = _read_array(buf, end, count)
+    return list(map(values.__getitem__, indices)), end
+
+
+def _decode(buf, view: memoryview, pos: int, depth: int):
+    """
+    Decodes the value starting at pos, returns it and the position after it.
+    view is set when bytes values are returned as memoryviews
+    """
+
+    tag = buf[pos]
+    pos += 1
+    if tag >= FIXINT:
+        return tag & 0x7f, pos
+
+    if tag == STR or tag == BYTES:
+        length = buf[pos]
+        if length < 0x80:
+            pos += 1
+        else:
+            length, pos = _read_varint(buf, pos)
+        end = pos + length
+        if end > len(buf):
+            raise ValueError("Truncated value")
+        if tag == STR:
+            return str(buf[pos:end], "utf-8"), end
+        return (view[pos:end] if view is not None else bytes(buf[pos:end])), end
+
+    if tag == DICT or tag == LIST:
+        if depth >= MAX_DEPTH:
+            raise ValueError("Nesting deeper than {}".format(MAX_DEPTH))
+        count, pos = _read_varint(buf, pos)
+        depth += 1
+        if tag == LIST:
+            items = []
+            append = items.append
+            for _ in range(count):
+                # Small integers and short strings are decoded inline. A string cut short
+                # leaves pos past the end, which loads reports
+                tag = buf[pos]
+                if tag >= FIXINT:
+                    append(tag & 0x7f)
+                    pos += 1
+                elif tag == STR and buf[pos + 1] < 0x80:
+                    end = pos + 2 + buf[pos + 1]
+                    append(str(buf[pos + 2:end], "utf-8"))
+                    pos = end
+                else:
+                    value, pos = _decode(buf, view, pos, depth)
+                    append(value)
+            return items, pos
+        obj = {}
+        for _ in range(count):
+            if buf[pos] == STR and buf[pos + 1] < 0x80:
+                end = pos + 2 + buf[pos + 1]
+                key = str(buf[pos + 2:end], "utf-8")
+                pos = end
+            else:
+                key, pos = _decode(buf, view, pos, depth)
+            tag = buf[pos]
+            if tag >= FIXINT:
+                obj[key] = tag & 0x7f
+                pos += 1
+            elif tag == STR and buf[pos + 1] < 0x80:
+                end = pos + 2 + buf[pos + 1]
+                obj[key] = str(buf[pos + 2:end], "utf-8")
+                pos = end
+            else:
+                obj[key], pos = _decode(buf, view, pos, depth)
+        return obj, pos
+
+    if tag == INTS:
+        count, pos = _read_varint(buf, pos)
+        return _read_array(buf, pos, count)
+    if tag == STRS:
+        return _decode_strs(buf, pos)
+    if tag == TABLE:
+        if depth >= MAX_DEPTH:
+            raise ValueError("Nesting deeper than {}".format(MAX_DEPTH))
+        count, pos = _read_varint(buf, pos)
+        keys, pos = _decode(buf, view, pos, depth + 1)
+        if type(keys) is not list or not keys:
+            raise ValueError("Invalid table keys")
+        columns = []
+        for _ in keys:
+            column, pos = _decode(buf, view, pos, depth + 1)
+            if type(column) is not list or len(column) != count:
+                raise ValueError("Table column does not match the row count")
+            columns.append(column)
+        # Copies of a dict that holds the keys already share its key table, filling them in
+        # column by column is about twice as fast as building every row from its values
+        template = dict.fromkeys(keys)
+        rows = [template.copy() for _ in range(count)]
+        for key, column in zip(keys, columns):
+            for row, value in zip(rows, column):
+                row[key] = value
+        return rows, pos
+    if tag == LISTS:
+        if depth >= MAX_DEPTH:
+            raise ValueError("Nesting deeper than {}".format(MAX_DEPTH))
+        count, pos = _read_varint(buf, pos)
+        lengths, pos = _read_array(buf, pos, count)
+        values, pos = _decode(buf, view, pos, depth + 1)
+        ends = list(accumulate(lengths))
+        if type(values) is not list or (ends[-1] if ends else 0) != len(values):
+            raise ValueError("List lengths do not match their values")
+        return list(map(values.__getitem__, map(slice, [0] + ends, ends))), pos
+    if tag == FLOATS or tag == BOOLS:
+        count, pos = _read_varint(buf, pos)
+        end = pos + (count * 8 if tag == FLOATS else count)
+        if end > len(buf):
+            raise ValueError("Truncated value")
+        if tag == BOOLS:
+            return list(map(bool, buf[pos:end])), end
+        values = array("d")
+        values.frombytes(buf[pos:end])
+        if SWAP_BYTES:
+            values.byteswap()
+        return values.tolist(), end
+
+    if tag == INT:
+        value, pos = _read_varint(buf, pos)
+        return (value >> 1 if not value & 1 else -((value + 1) >> 1)), pos
+    if tag == NONE:
+        return None, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == FLOAT:
+        end = pos + FLOAT_FORMAT.size
+        if end > len(buf):
+            raise ValueError("Truncated value")
+        return FLOAT_FORMAT.unpack_from(buf, pos)[0], end
+    raise ValueError("Unknown tag {:#x}".format(tag))
+
+
+def loads(data, zero_copy=False):
+    """
+    Deserializes a python object.
+    zero_copy: bytes values are returned as memoryviews into data instead of copies
+    """
+
+    view = memoryview(data).cast("B") if zero_copy else None
+    buf = data if isinstance(data, (bytes, bytearray)) else memoryview(data).cast("B")
+    collect = _pause_gc()
+    try:
+        obj, pos = _decode(buf, view, 0, 0)
+    except IndexError:
+        raise ValueError("Truncated value") from None
+    except TypeError as err:
+        # A list decoded where a dict key was expected
+        raise ValueError("Invalid dict key: {}".format(err)) from None
+    finally:
+        if collect:
+            gc.enable()
+    if pos > len(buf):
+        raise ValueError("Truncated value")
+    if pos < len(buf):
+        raise ValueError("Trailing data after value")
+    return obj
@@ -0,0 +1,207 @@
+"""
+Columnar encoding for lists of records (dicts) that all have the same fields.
+
+Field names are sent once. Integer, float and bool columns are packed arrays,
+string columns are end offsets into one utf-8 blob, any other column falls back
+to the compact codec. Decoding returns a RecordBatch that exposes the columns
+directly and builds row dicts only when they are accessed
+"""
+
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+from . import codec
+
+INT64 = 1
+FLOAT64 = 2
+BOOL = 3
+STRING = 4
+OTHER = 5
+
+# Column arrays are sent little endian
+SWAP_BYTES = sys.byteorder != "little"
+BATCH_HEADER = struct.Struct("<IH")
+COLUMN_HEADER = struct.Struct("<HBQ")
+INT64_RANGE = range(-2 ** 63, 2 ** 63)
+
+
+def _column_type(values: list) -> int:
+    """
+    Picks the most compact column type that can hold every value
+    """
+
+    types = set(map(type, values))
+    if types == {bool}:
+        return BOOL
+    if types == {int} and all(value in INT64_RANGE for value in values):
+        return INT64
+    if types == {float}:
+        return FLOAT64
+    if types == {str}:
+        return STRING
+    return OTHER
+
+
+def _packed(values: array) -> bytes:
+    if SWAP_BYTES:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpacked(typecode: str, data) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if SWAP_BYTES:
+        values.byteswap()
+    return values
+
+
+def _encode_column(column_type: int, values: list) -> bytes:
+    if column_type == INT64:
+        return _packed(array("q", values))
+    if column_type == FLOAT64:
+        return _packed(array("d", values))
+    if column_type == BOOL:
+        return _packed(array("b", values))
+    if column_type == STRING:
+        encoded = [value.encode() for value in values]
+        offsets = array("Q")
+        end = 0
+        for value in encoded:
+            end += len(value)
+            offsets.append(end)
+        return _packed(offsets) + b"".join(encoded)
+    return codec.dumps(values)
+
+
+def encode_records(records: list) -> bytes:
+    """
+    Serializes a list of dicts that all have the same keys
+    """
+
+    if not isinstance(records, (list, tuple)) or not all(isinstance(record, dict) for record in records):
+        raise ValueError("Columnar encoding needs a list of dicts")
+    fields = list(records[0]) if records else []
+    field_set = set(fields)
+    if any(record.keys() != field_set for record in records):
+        raise ValueError("Columnar encoding needs records with the same fields")
+
+    out = [BATCH_HEADER.pack(len(records), len(fields))]
+    for field in fields:
+        if not isinstance(field, str):
+            raise ValueError("Columnar field names must be strings")
+        values = [record[field] for record in records]
+        column_type = _column_type(values)
+        data = _encode_column(column_type, values)
+        name = field.encode()
+        out.append(COLUMN_HEADER.pack(len(name), column_type, len(data)))
+        out.append(name)
+        out.append(data)
+    return b"".join(out)
+
+
+class StringColumn(Sequence):
+    """
+    String column that decodes a value only when it is accessed
+    """
+
+    def __init__(self, offsets: array, blob: bytes):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start = self.offsets[index - 1] if index else 0
+        return self.blob[start:self.offsets[index]].decode()
+
+
+class RecordBatch(Sequence):
+    """
+    Decoded record batch. columns maps each field name to its column,
+    indexing or iterating builds the row dicts on demand
+    """
+
+    def __init__(self, columns: dict, num_rows: int):
+        self.columns = columns
+        self.num_rows = num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.num_rows))]
+        if index < 0:
+            index += self.num_rows
+        if not 0 <= index < self.num_rows:
+            raise IndexError("Record index out of range")
+        return {field: column[index] for field, column in self.columns.items()}
+
+    def to_rows(self) -> list:
+        """
+        Builds every row dict
+        """
+
+        if not self.columns:
+            return [{} for _ in range(self.num_rows)]
+        fields = list(self.columns)
+        return [dict(zip(fields, values)) for values in zip(*self.columns.values())]
+
+
+def _decode_column(column_type: int, data, num_rows: int):
+    if column_type == INT64:
+        values = _unpacked("q", data)
+    elif column_type == FLOAT64:
+        values = _unpacked("d", data)
+    elif column_type == BOOL:
+        values = [bool(value) for value in _unpacked("b", data)]
+    elif column_type == STRING:
+        offsets_size = num_rows * 8
+        offsets = _unpacked("Q", data[:offsets_size])
+        blob = bytes(data[offsets_size:])
+        if len(offsets) != num_rows or (num_rows and offsets[-1] != len(blob)):
+            raise ValueError("Invalid string column")
+        return StringColumn(offsets, blob)
+    elif column_type == OTHER:
+        values = codec.loads(data)
+    else:
+        raise ValueError("Unknown column type {}".format(column_type))
+    if len(values) != num_rows:
+        raise ValueError("Column length does not match the row count")
+    return values
+
+
+def decode(data) -> RecordBatch:
+    """
+    Deserializes a record batch
+    """
+
+    view = memoryview(data).cast("B")
+    try:
+        num_rows, num_fields = BATCH_HEADER.unpack_from(view)
+        offset = BATCH_HEADER.size
+        columns = {}
+        for _ in range(num_fields):
+            name_length, column_type, data_length = COLUMN_HEADER.unpack_from(
+                view, offset)
+            offset += COLUMN_HEADER.size
+            name = str(view[offset:offset + name_length], "utf-8")
+            offset += name_length
+            end = offset + data_length
+            if end > len(view):
+                raise ValueError("Truncated column")
+            columns[name] = _decode_column(
+                column_type, view[offset:end], num_rows)
+            offset = end
+    except struct.error:
+        raise ValueError("Truncated record batch") from None
+    if offset != len(view):
+        raise ValueError("Trailing data after record batch")
+    return RecordBatch(columns, num_rows)
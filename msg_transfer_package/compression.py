@@ -0,0 +1,92 @@
+"""
+Payload compression applied between serialization and encryption.
+bz2 and lzma are imported when a payload is first compressed with them
+"""
+
+import math
+import zlib
+from collections import Counter
+
+# Compression method ids sent in protocol v2 headers
+COMPRESSION_METHODS = {"zlib": 1, "bz2": 2, "lzma": 3}
+COMPRESSION_NAMES = {method_id: name for name,
+                     method_id in COMPRESSION_METHODS.items()}
+
+# Payloads smaller than this are sent as they are
+MIN_SIZE = 512
+# Bytes looked at to estimate if a payload compresses
+SAMPLE_SIZE = 4096
+# Samples with more bits of entropy per byte are treated as already compressed or random
+MAX_ENTROPY = 7.5
+
+
+def entropy(sample: bytes) -> float:
+    """
+    Shannon entropy of the sample in bits per byte
+    """
+
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(sample).values())
+
+
+def compress_payload(data: bytes, method: str, level: int = None, min_size=MIN_SIZE):
+    """
+    Compresses the payload if it is worth it.
+    Returns the method used, None if the payload was left as it is, and the payload
+    """
+
+    if method is None or len(data) < min_size:
+        return None, data
+    if entropy(data[:SAMPLE_SIZE]) > MAX_ENTROPY:
+        return None, data
+
+    if method == "zlib":
+        compressed = zlib.compress(data, -1 if level is None else level)
+    elif method == "bz2":
+        import bz2
+
+        compressed = bz2.compress(data, 9 if level is None else level)
+    elif method == "lzma":
+        import lzma
+
+        compressed = lzma.compress(data, preset=level)
+    else:
+        raise ValueError("Unknown compression method {}".format(method))
+
+    if len(compressed) >= len(data):
+        return None, data
+    return method, compressed
+
+
+def decompress_payload(data: bytes, method: str, max_size=0) -> bytes:
+    """
+    Reverses compress_payload
+    max_size: largest decompressed size accepted, a payload expanding past it raises ValueError
+    without being decompressed any further. 0 for no limit
+    """
+
+    if method == "zlib":
+        decompressor = zlib.decompressobj()
+    elif method == "bz2":
+        import bz2
+
+        decompressor = bz2.BZ2Decompressor()
+    elif method == "lzma":
+        import lzma
+
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError("Unknown compression method {}".format(method))
+
+    # One byte more than the limit tells a payload of exactly max_size from a larger one
+    if method == "zlib":
+        decompressed = decompressor.decompress(data, max_size + 1 if max_size else 0)
+    else:
+        decompressed = decompressor.decompress(data, max_size + 1 if max_size else -1)
+    if max_size and len(decompressed) > max_size:
+        raise ValueError("Decompressed payload exceeds the limit of {} bytes".format(max_size))
+    if not decompressor.eof:
+        raise ValueError("Compressed payload is incomplete")
+    return decompressed
@@ -0,0 +1,149 @@
+"""
+Content-addressed deduplication. Before sending a payload the client sends a "probe" frame with
+the sha256 of its content. If the server holds that content in its BlobStore it answers HAVE_IT
+and uses its copy, otherwise it answers SEND_IT and the client sends the payload flagged to be
+added to the store
+"""
+
+import hashlib
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+# Probe payload: sha256 of the content, its size and its codec id, 0 for a file
+PROBE = struct.Struct("!32sQB")
+HAVE_IT = b"Have it"
+SEND_IT = b"Send it"
+HASH_BUFFER_SIZE = 1048576
+
+
+def file_digest(path: str):
+    """
+    sha256 and size of a file, read one buffer at a time
+    """
+
+    digest = hashlib.sha256()
+    size = 0
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb") as file:
+        while True:
+            nbytes = file.readinto(buffer)
+            if not nbytes:
+                break
+            digest.update(view[:nbytes])
+            size += nbytes
+    return digest.digest(), size
+
+
+class BlobStore:
+    """
+    Directory of received contents named by their sha256
+    """
+
+    def __init__(self, directory: str, verify=True):
+        """
+        directory: where the blobs are kept, on the same file system as the received files
+        so they can be hard linked instead of copied
+        verify: hash a blob again before reusing it. Received files share their blob's storage,
+        so a file edited in place changes the blob too
+        """
+
+        self.directory = directory
+        self.verify = verify
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest: bytes) -> str:
+        name = digest.hex()
+        return os.path.join(self.directory, name[:2], name)
+
+    def has(self, digest: bytes, size: int) -> bool:
+        """
+        Whether the store holds intact content with this digest and size
+        """
+
+        path = self.path(digest)
+        try:
+            if os.stat(path).st_size != size:
+                return False
+        except FileNotFoundError:
+            return False
+        if self.verify and file_digest(path)[0] != digest:
+            logger.warning("Blob %s was modified, dropping it", digest.hex())
+            self._discard(path)
+            return False
+        return True
+
+    def _discard(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _temp_path(self, directory: str) -> str:
+        """
+        Unused name in directory for a file that is moved into place once complete
+        """
+
+        import tempfile
+
+        fd, path = tempfile.mkstemp(prefix=".blob_", suffix=".tmp", dir=directory)
+        os.close(fd)
+        os.remove(path)
+        return path
+
+    def _place(self, source: str, target: str):
+        """
+        Hard links source to target, replacing it, or copies it where links are not possible
+        """
+
+        temp_path = self._temp_path(os.path.dirname(os.path.abspath(target)))
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            import shutil
+
+            shutil.copyfile(source, temp_path)
+        os.replace(temp_path, target)
+
+    def add_file(self, path: str, digest: bytes):
+        """
+        Adds a received file to the store, it keeps sharing its storage with the blob
+        """
+
+        target = self.path(digest)
+        if os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        self._place(path, target)
+        logger.debug("Stored blob %s", digest.hex())
+
+    def add_bytes(self, data: bytes, digest: bytes = None):
+        """
+        Adds content held in memory to the store
+        """
+
+        if digest is None:
+            digest = hashlib.sha256(data).digest()
+        target = self.path(digest)
+        if os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = self._temp_path(os.path.dirname(target))
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, target)
+        logger.debug("Stored blob %s", digest.hex())
+
+    def link(self, digest: bytes, filename: str):
+        """
+        Makes filename a hard link to, or where that fails a copy of, a stored blob
+        """
+
+        self._place(self.path(digest), filename)
+
+    def read(self, digest: bytes) -> bytes:
+        with open(self.path(digest), "rb") as file:
+            return file.read()
@@ -0,0 +1,354 @@
+"""
+rsync-style delta transfers of files the server holds an older copy of.
+
+The client asks for the signatures of the server's copy of received_<name> with a "signature"
+frame. The server splits its copy into blocks and answers with a weak checksum and a strong hash
+of each block. The client slides a window over the new version of the file, rolling the weak
+checksum one byte at a time, and looks it up among the signatures. Blocks the server already holds
+are sent as references to them, everything in between as literal data, in one "delta" frame.
+The server rebuilds the new version from its copy and the delta and checks it against the sha256
+the client computed, so the bytes crossing the network scale with the change, not the file size.
+The server writes a delta to a temporary file as it arrives and applies it from there
+"""
+
+import hashlib
+import io
+import math
+import os
+import struct
+import zlib
+from .utils import decrypt_message, new_cipher
+
+# Signature query payload: block size, 0 lets the server pick one for the size of its copy
+SIGNATURE_QUERY = struct.Struct("!I")
+# Signature reply: size of the server's copy and block size. A BLOCK_SIGNATURE of each
+# complete block follows, the shorter last block is always sent as literal data
+SIGNATURE_HEADER = struct.Struct("!QI")
+BLOCK_SIGNATURE = struct.Struct("!I16s")
+# Delta payload: size of the copy the delta applies to, block size, size and sha256 of the
+# new version. The operations follow
+DELTA_HEADER = struct.Struct("!QIQ32s")
+# Copy operation: first block, number of consecutive blocks
+COPY = struct.Struct("!BQI")
+# Literal operation: length of the data that follows
+LITERAL = struct.Struct("!BI")
+OP_LITERAL = 0
+OP_COPY = 1
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 131072
+# Bytes of the new version read at a time, longer literal data is split at about this size
+READ_SIZE = 1048576
+# Modulus of the Adler-32 weak checksum
+ADLER_MOD = 65521
+
+
+def block_size_for(size: int) -> int:
+    """
+    Block size for a file, the square root of its size like rsync. Larger blocks mean fewer
+    signatures but more literal data around every change
+    """
+
+    block_size = (math.isqrt(size) + 7) // 8 * 8
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def weak_checksum(data: bytes) -> int:
+    return zlib.adler32(data)
+
+
+def roll(checksum: int, removed: int, added: int, block_size: int) -> int:
+    """
+    Moves the window of an Adler-32 checksum one byte forward
+    """
+
+    a = (checksum & 0xFFFF) - removed + added
+    b = (checksum >> 16) - block_size * removed + a - 1
+    return (b % ADLER_MOD) << 16 | a % ADLER_MOD
+
+
+def strong_hash(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_signatures(path: str, block_size=0) -> bytes:
+    """
+    Signature reply for a file, with no blocks if the file does not exist
+    """
+
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return SIGNATURE_HEADER.pack(0, block_size or MIN_BLOCK_SIZE)
+    with file:
+        size = os.fstat(file.fileno()).st_size
+        block_size = block_size or block_size_for(size)
+        signatures = [SIGNATURE_HEADER.pack(size, block_size)]
+        for _ in range(size // block_size):
+            block = file.read(block_size)
+            if len(block) != block_size:
+                raise OSError("{} changed size while being read".format(path))
+            signatures.append(BLOCK_SIGNATURE.pack(
+                weak_checksum(block), strong_hash(block)))
+    return b"".join(signatures)
+
+
+def parse_signatures(payload: bytes):
+    """
+    Size of the server's copy, the block size and a dict of the blocks by weak checksum,
+    then by strong hash
+    """
+
+    size, block_size = SIGNATURE_HEADER.unpack_from(payload)
+    if not block_size or (len(payload) - SIGNATURE_HEADER.size) % BLOCK_SIGNATURE.size:
+        raise ValueError("Invalid signature reply")
+    blocks = {}
+    for index, (weak, strong) in enumerate(BLOCK_SIGNATURE.iter_unpack(
+            memoryview(payload)[SIGNATURE_HEADER.size:])):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    return size, block_size, blocks
+
+
+class DeltaWriter:
+    """
+    Writes the operations of a delta, merging references to consecutive blocks into one
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.run_start = None
+        self.run_length = 0
+        self.literal_bytes = 0
+
+    def literal(self, data):
+        if not len(data):
+            return
+        self.flush()
+        self.out.write(LITERAL.pack(OP_LITERAL, len(data)))
+        self.out.write(data)
+        self.literal_bytes += len(data)
+
+    def copy(self, index: int):
+        if self.run_start is not None and index == self.run_start + self.run_length:
+            self.run_length += 1
+            return
+        self.flush()
+        self.run_start, self.run_length = index, 1
+
+    def flush(self):
+        if self.run_start is not None:
+            self.out.write(COPY.pack(OP_COPY, self.run_start, self.run_length))
+            self.run_start = None
+
+
+def write_delta(path: str, basis_size: int, block_size: int, blocks: dict, out) -> int:
+    """
+    Writes the delta turning the server's copy into the file at path to the seekable out.
+    Returns the number of literal bytes in it
+    """
+
+    digest = hashlib.sha256()
+    writer = DeltaWriter(out)
+    header_offset = out.tell()
+    out.write(bytes(DELTA_HEADER.size))
+
+    with open(path, "rb") as file:
+        buffer = b""
+        # Start of the window and of the data not matched to a block yet
+        start = 0
+        literal_start = 0
+        checksum = None
+        eof = False
+        while True:
+            if len(buffer) - start <= block_size and not eof:
+                # Unmatched data before the window is sent before the buffer is refilled
+                writer.literal(memoryview(buffer)[literal_start:start])
+                data = file.read(READ_SIZE)
+                digest.update(data)
+                eof = not data
+                buffer = buffer[start:] + data
+                start = literal_start = 0
+                continue
+            if len(buffer) - start < block_size:
+                break
+
+            window = memoryview(buffer)[start:start + block_size]
+            if checksum is None:
+                checksum = weak_checksum(window)
+            candidates = blocks.get(checksum)
+            index = candidates.get(strong_hash(window)) if candidates else None
+            if index is not None:
+                writer.literal(memoryview(buffer)[literal_start:start])
+                writer.copy(index)
+                start += block_size
+                literal_start = start
+                checksum = None
+            elif start + block_size < len(buffer):
+                checksum = roll(checksum, buffer[start], buffer[start + block_size], block_size)
+                start += 1
+            else:
+                break
+        writer.literal(memoryview(buffer)[literal_start:])
+        writer.flush()
+        size = file.tell()
+
+    end = out.tell()
+    out.seek(header_offset)
+    out.write(DELTA_HEADER.pack(basis_size, block_size, size, digest.digest()))
+    out.seek(end)
+    return writer.literal_bytes
+
+
+def _copy_exactly(source, target, length: int, digest, error: str):
+    """
+    Copies length bytes from source to target a buffer at a time, raises ValueError with
+    error if source ends first
+    """
+
+    while length:
+        data = source.read(min(length, READ_SIZE))
+        if not data:
+            raise ValueError(error)
+        digest.update(data)
+        target.write(data)
+        length -= len(data)
+
+
+def _read_op(delta, op: struct.Struct, first: bytes) -> tuple:
+    rest = delta.read(op.size - 1)
+    if len(rest) != op.size - 1:
+        raise ValueError("Delta is cut short")
+    return op.unpack(first + rest)
+
+
+def apply_delta(basis_path: str, delta, target_path: str):
+    """
+    Rebuilds the new version of a file from the server's copy and a delta, and moves it
+    to target_path once it matches the sha256 the client sent
+    delta: binary file the delta is read from, from its current position
+    """
+
+    import tempfile
+
+    header = delta.read(DELTA_HEADER.size)
+    if len(header) != DELTA_HEADER.size:
+        raise ValueError("Delta is cut short")
+    basis_size, block_size, size, expected = DELTA_HEADER.unpack(header)
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(target_path))
+    fd, temp_path = tempfile.mkstemp(prefix=".delta_", suffix=".tmp", dir=directory)
+    try:
+        with open(basis_path, "rb") as basis, os.fdopen(fd, "wb") as target:
+            if os.fstat(basis.fileno()).st_size != basis_size:
+                raise ValueError("{} changed since its signatures were sent".format(basis_path))
+            while True:
+                op = delta.read(1)
+                if not op:
+                    break
+                if op[0] == OP_COPY:
+                    _, first, count = _read_op(delta, COPY, op)
+                    if (first + count) * block_size > basis_size:
+                        raise ValueError("Delta refers to blocks past the end of the file")
+                    basis.seek(first * block_size)
+                    _copy_exactly(basis, target, count * block_size, digest,
+                                  "{} changed while being read".format(basis_path))
+                elif op[0] == OP_LITERAL:
+                    _, length = _read_op(delta, LITERAL, op)
+                    _copy_exactly(delta, target, length, digest, "Delta is cut short")
+                else:
+                    raise ValueError("Unknown delta operation {}".format(op[0]))
+            if target.tell() != size or digest.digest() != expected:
+                raise ValueError("Rebuilt file does not match the sent checksum")
+        os.replace(temp_path, target_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class DeltaReceiver:
+    """
+    Writes a delta to a temporary file as it arrives, decrypting it incrementally,
+    and applies it once it is complete, so a delta is not limited by max_frame_size
+    """
+
+    def __init__(self, path: str, metadata: dict):
+        """
+        path: received file the delta applies to
+        """
+
+        import tempfile
+
+        self.path = path
+        self.cipher = new_cipher() if metadata["encrypt"] else None
+        self.file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.file:
+            if exc_type is None:
+                self.file.seek(0)
+                apply_delta(self.path, self.file, self.path)
+
+    def write(self, chunk):
+        """
+        Decrypts and writes the next part of the delta, a writable chunk is decrypted in place
+        """
+
+        if self.cipher is not None:
+            if isinstance(chunk, bytes):
+                chunk = self.cipher.decrypt(chunk)
+            else:
+                self.cipher.decrypt(chunk, output=chunk)
+        self.file.write(chunk)
+
+
+class DeltaStore:
+    """
+    Answers signature queries about received files and applies the deltas sent for them
+    """
+
+    def __init__(self, directory="."):
+        """
+        directory: where the received files are kept
+        """
+
+        self.directory = directory
+
+    def _path(self, filename: str) -> str:
+        # Names are kept inside the directory
+        filename = os.path.basename(filename)
+        if not filename:
+            raise ValueError("Invalid file name")
+        return os.path.join(self.directory, "received_" + filename)
+
+    def handle(self, msg: bytes, msg_params: dict) -> bytes:
+        """
+        Processes a signature or delta frame and returns the reply message.
+        A signature reply holds the signatures of the file
+        """
+
+        if msg_params["encrypt"]:
+            msg = decrypt_message(msg)
+        path = self._path(msg_params["filename"])
+
+        if msg_params["type"] == "signature":
+            block_size, = SIGNATURE_QUERY.unpack_from(msg)
+            if block_size and not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+                raise ValueError("Block size must be between {} and {}".format(
+                    MIN_BLOCK_SIZE, MAX_BLOCK_SIZE))
+            return file_signatures(path, block_size)
+
+        apply_delta(path, io.BytesIO(msg), path)
+        return b"Received File successfully"
+
+    def receiver(self, msg_params: dict) -> DeltaReceiver:
+        """
+        Receiver a delta frame is streamed to instead of being held in memory
+        """
+
+        return DeltaReceiver(self._path(msg_params["filename"]), msg_params)
@@ -0,0 +1,95 @@
+"""
+Limits that protect a server from clients that send too much, too slowly or too often
+"""
+
+import threading
+from .utils import MAX_HEADER_SIZE
+
+
+class Limits:
+    """
+    Resource limits of a server, shared by all of its connections
+    """
+
+    def __init__(self, max_frame_size=16777216, connection_budget=33554432,
+                 global_budget=268435456, idle_timeout=300.0, read_timeout=30.0,
+                 max_connections=1024, max_file_size=68719476736, partial_ttl=86400.0):
+        """
+        max_frame_size: largest message payload held in memory, files written to disk as they
+        arrive are not limited
+        connection_budget: received bytes one connection may hold in memory, the message being
+        assembled and the start of the next ones. It stops reading when the budget is used up
+        global_budget: received bytes all connections together may hold in memory,
+        connections stop reading while it is used up
+        idle_timeout: seconds a connection may stay open between messages without sending anything
+        read_timeout: seconds a partly received message may wait for more data,
+        and for a header to arrive completely
+        max_connections: open connections, further connections are closed right after accepting
+        max_file_size: largest file a resumable transfer may announce, its partial file is
+        created at full size before any chunk arrives
+        partial_ttl: seconds a resumable transfer may go without a chunk before its partial file
+        and journal are removed
+        """
+
+        if max_frame_size < 1:
+            raise ValueError("max_frame_size must be positive")
+        if connection_budget < max_frame_size + MAX_HEADER_SIZE:
+            raise ValueError(
+                "connection_budget must hold a frame of max_frame_size and its header")
+        if global_budget < connection_budget:
+            raise ValueError("global_budget must be at least connection_budget")
+        if idle_timeout <= 0 or read_timeout <= 0 or max_connections < 1:
+            raise ValueError(
+                "Timeouts and max_connections must be positive")
+        if max_file_size < 1 or partial_ttl <= 0:
+            raise ValueError("max_file_size and partial_ttl must be positive")
+        self.max_frame_size = max_frame_size
+        self.connection_budget = connection_budget
+        self.global_budget = global_budget
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.max_file_size = max_file_size
+        self.partial_ttl = partial_ttl
+
+
+class ByteBudget:
+    """
+    Thread safe count of the bytes that may still be taken out of a fixed budget
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.available = capacity
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int, timeout: float = None) -> int:
+        """
+        Takes up to nbytes, waiting until at least one byte is available.
+        Returns the number of bytes taken, 0 if the timeout expired first
+        """
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.available, timeout):
+                return 0
+            taken = min(nbytes, self.available)
+            self.available -= taken
+            return taken
+
+    def try_acquire(self, nbytes: int) -> bool:
+        """
+        Takes exactly nbytes if they are available, without waiting
+        """
+
+        with self._condition:
+            if nbytes > self.available:
+                return False
+            self.available -= nbytes
+            return True
+
+    def release(self, nbytes: int):
+        if not nbytes:
+            return
+        with self._condition:
+            self.available += nbytes
+            self._condition.notify_all()
@@ -0,0 +1,41 @@
+"""
+Logging setup for the applications using the package.
+The package modules only create loggers, handlers are added by the host application
+"""
+
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Logger of received payloads, it stays quiet unless explicitly enabled
+PAYLOAD_LOGGER = "msg_transfer_package.payload"
+
+
+def setup_logging(prefix: str, log_file=None, level=logging.INFO, log_payloads=False) -> QueueListener:
+    """
+    Sends log records through a queue to a listener thread that writes them to stderr
+    and log_file, so threads that log never wait on the console or the disk.
+    Returns the started listener, stop it before exiting to write the remaining records
+    prefix: label at the start of every line, e.g. SERVER
+    log_file: file the records are also appended to
+    level: level of the root logger
+    log_payloads: log the contents of received data, very large and slow, for debugging only
+    """
+
+    formatter = logging.Formatter(
+        prefix + ": %(asctime)s %(levelname)s %(message)s")
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    logging.getLogger(PAYLOAD_LOGGER).setLevel(
+        logging.DEBUG if log_payloads else logging.WARNING)
+    listener.start()
+    return listener
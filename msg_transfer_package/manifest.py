@@ -0,0 +1,78 @@
+"""
+Manifests of bulk transfers and the paths received files are saved under.
+
+A bulk transfer starts with a "manifest" frame listing the relative path and size of every file
+it is going to send. The server checks all the paths and creates their directories before the
+files arrive as ordinary file frames named by their relative paths, each acknowledged on its own
+"""
+
+import os
+import struct
+from .utils import decrypt_message
+
+# Manifest entry: file size, length of the path. The utf-8 path follows
+MANIFEST_ENTRY = struct.Struct("!QH")
+
+
+def pack_manifest(entries: list) -> bytes:
+    """
+    Manifest payload of a list of (relative path, size)
+    """
+
+    payload = []
+    for name, size in entries:
+        encoded = name.encode()
+        payload.append(MANIFEST_ENTRY.pack(size, len(encoded)) + encoded)
+    return b"".join(payload)
+
+
+def unpack_manifest(payload: bytes) -> list:
+    entries = []
+    offset = 0
+    while offset < len(payload):
+        size, length = MANIFEST_ENTRY.unpack_from(payload, offset)
+        offset += MANIFEST_ENTRY.size
+        if offset + length > len(payload):
+            raise ValueError("Truncated manifest")
+        entries.append((payload[offset:offset + length].decode(), size))
+        offset += length
+    return entries
+
+
+def received_path(name: str, directory="", create=False) -> str:
+    """
+    Path a received file is saved under: received_ followed by the relative path the client
+    sent, with / as separator. Paths that could leave the directory are refused
+    create: make the directories leading to the path
+    """
+
+    parts = name.split("/")
+    if any(part in ("", ".", "..") for part in parts) or "\\" in name or "\0" in name:
+        raise ValueError("Invalid file name {!r}".format(name))
+    path = os.path.join(directory, "received_" + os.path.join(*parts))
+    # A symbolic link on the way must not lead outside either
+    base = os.path.realpath(directory)
+    if os.path.commonpath([base, os.path.realpath(path)]) != base:
+        raise ValueError("Invalid file name {!r}".format(name))
+    if create and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def receive_manifest(received: bytes, metadata: dict, directory="", create=True) -> bytes:
+    """
+    Checks the paths of a manifest and creates their directories. A manifest with any
+    invalid path is refused as a whole, before any of its files is sent
+    create: make the directories, a server that prints what it receives only checks the paths
+    """
+
+    if metadata["encrypt"]:
+        received = decrypt_message(received)
+    entries = unpack_manifest(received)
+    for name, _ in entries:
+        received_path(name, directory)
+    if create:
+        for name, _ in entries:
+            received_path(name, directory, create=True)
+    return "Accepted manifest of {} files, {} bytes".format(
+        len(entries), sum(size for _, size in entries)).encode()
@@ -0,0 +1,433 @@
+"""
+In-process server metrics: message and byte counters, connection gauges and latency histograms.
+They are exposed as Prometheus text and json over http and as a periodic log summary
+"""
+
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .utils import CODECS
+
+logger = logging.getLogger(__name__)
+
+# Histogram values are recorded in whole microseconds. Each power of two is split into
+# SUB_BUCKETS linear buckets, so any value is off by at most 1/SUB_BUCKETS of itself
+SUB_BUCKETS = 16
+SUB_BITS = SUB_BUCKETS.bit_length() - 1
+# Values up to 2**MAX_BITS microseconds, about 12 days, larger ones are clamped
+MAX_BITS = 40
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+    """
+    HDR style histogram of durations with fixed memory and bounded relative error
+    """
+
+    def __init__(self):
+        self.counts = [0] * (SUB_BUCKETS * (MAX_BITS - SUB_BITS + 1))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(micros: int) -> int:
+        if micros < SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - SUB_BITS - 1
+        return SUB_BUCKETS * (shift + 1) + (micros >> shift) - SUB_BUCKETS
+
+    @staticmethod
+    def _bounds(index: int):
+        """
+        Lowest and highest value, in microseconds, of a bucket
+        """
+
+        if index < SUB_BUCKETS:
+            return index, index
+        shift, sub = divmod(index - SUB_BUCKETS, SUB_BUCKETS)
+        low = (SUB_BUCKETS + sub) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, seconds: float):
+        """
+        Adds one duration
+        """
+
+        micros = min(max(int(seconds * 1e6), 0), (1 << MAX_BITS) - 1)
+        self.counts[self._index(micros)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.counts = self.counts[:]
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        return histogram
+
+    def to_dict(self) -> dict:
+        """
+        The histogram in a json serializable form, only buckets with values are listed
+        """
+
+        return {"counts": {index: count for index, count in enumerate(self.counts) if count},
+                "count": self.count, "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        histogram = cls()
+        for index, count in data["counts"].items():
+            # json turns the bucket indexes into strings
+            histogram.counts[int(index)] = count
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+    def merge(self, other):
+        """
+        Adds the durations recorded in another histogram
+        """
+
+        self.counts = [mine + theirs for mine,
+                       theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def since(self, previous):
+        """
+        Histogram of the durations recorded after the previous copy was taken.
+        Its max is the max since the start
+        """
+
+        histogram = self.copy()
+        histogram.counts = [now - before for now,
+                            before in zip(self.counts, previous.counts)]
+        histogram.count -= previous.count
+        histogram.total -= previous.total
+        return histogram
+
+    def percentile(self, quantile: float) -> float:
+        """
+        Duration in seconds that quantile of the recorded durations do not exceed
+        """
+
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                low, high = self._bounds(index)
+                return min((low + high) / 2e6, self.max)
+        return self.max
+
+
+class MetricsRegistry:
+    """
+    Thread safe collection of the server metrics
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        # (type, codec, encrypt) -> count
+        self.messages = {}
+        self.bytes = {}
+        self.errors = 0
+        # Connections closed or refused for breaking a server limit
+        self.limit_violations = 0
+        self.connections = 0
+        self.active_connections = 0
+        self.decode_time = Histogram()
+        self.latency = Histogram()
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+            self.active_connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+    def limit_violation(self):
+        with self._lock:
+            self.limit_violations += 1
+
+    def message_received(self, metadata: dict, decode_time: float = None, error=False):
+        """
+        Counts a processed message and the time it took to decrypt, decompress and parse it
+        """
+
+        # v1 clients can send any serialization name, unknown ones share a label
+        codec = metadata.get("serialize", "-").lower()
+        if codec not in CODECS and codec != "-":
+            codec = "other"
+        key = (metadata["type"], codec,
+               "true" if metadata["encrypt"] else "false")
+        with self._lock:
+            self.messages[key] = self.messages.get(key, 0) + 1
+            self.bytes[key] = self.bytes.get(key, 0) + metadata["length"]
+            if error:
+                self.errors += 1
+            if decode_time is not None:
+                self.decode_time.record(decode_time)
+
+    def reply_sent(self, latency: float):
+        """
+        Records the time from the first byte of a message arriving to its reply being sent
+        """
+
+        with self._lock:
+            self.latency.record(latency)
+
+    def snapshot(self) -> dict:
+        """
+        Copies the current values so they can be reported without holding the lock
+        """
+
+        with self._lock:
+            return {
+                "time": time.time(),
+                "messages": dict(self.messages),
+                "bytes": dict(self.bytes),
+                "errors": self.errors,
+                "limit_violations": self.limit_violations,
+                "connections": self.connections,
+                "active_connections": self.active_connections,
+                "decode_time": self.decode_time.copy(),
+                "latency": self.latency.copy(),
+            }
+
+    def export(self) -> dict:
+        """
+        The current values in a json serializable form that add_export can combine
+        """
+
+        snapshot = self.snapshot()
+        return {
+            "messages": [[key[0], key[1], key[2], count, snapshot["bytes"][key]]
+                         for key, count in snapshot["messages"].items()],
+            "errors": snapshot["errors"],
+            "limit_violations": snapshot["limit_violations"],
+            "connections": snapshot["connections"],
+            "active_connections": snapshot["active_connections"],
+            "decode_time": snapshot["decode_time"].to_dict(),
+            "latency": snapshot["latency"].to_dict(),
+        }
+
+    def add_export(self, exported: dict):
+        """
+        Adds the values exported by another registry, e.g. the one of another process
+        """
+
+        with self._lock:
+            for msg_type, codec, encrypt, count, nbytes in exported["messages"]:
+                key = (msg_type, codec, encrypt)
+                self.messages[key] = self.messages.get(key, 0) + count
+                self.bytes[key] = self.bytes.get(key, 0) + nbytes
+            self.errors += exported["errors"]
+            self.limit_violations += exported["limit_violations"]
+            self.connections += exported["connections"]
+            self.active_connections += exported["active_connections"]
+            self.decode_time.merge(
+                Histogram.from_dict(exported["decode_time"]))
+            self.latency.merge(Histogram.from_dict(exported["latency"]))
+
+    def to_json(self) -> dict:
+        """
+        The current values in a json serializable form
+        """
+
+        snapshot = self.snapshot()
+        return {
+            "uptime_seconds": snapshot["time"] - self.started,
+            "messages": [{"type": key[0], "codec": key[1], "encrypt": key[2],
+                          "count": count, "bytes": snapshot["bytes"][key]}
+                         for key, count in snapshot["messages"].items()],
+            "errors": snapshot["errors"],
+            "limit_violations": snapshot["limit_violations"],
+            "connections": snapshot["connections"],
+            "active_connections": snapshot["active_connections"],
+            "decode_seconds": _histogram_json(snapshot["decode_time"]),
+            "latency_seconds": _histogram_json(snapshot["latency"]),
+        }
+
+    def prometheus_text(self) -> str:
+        """
+        The current values in the Prometheus text exposition format
+        """
+
+        snapshot = self.snapshot()
+        lines = ["# TYPE msg_transfer_messages_total counter"]
+        for (msg_type, codec, encrypt), count in sorted(snapshot["messages"].items()):
+            lines.append('msg_transfer_messages_total{{type="{}",codec="{}",encrypt="{}"}} {}'.format(
+                msg_type, codec, encrypt, count))
+        lines.append("# TYPE msg_transfer_bytes_total counter")
+        for (msg_type, codec, encrypt), count in sorted(snapshot["bytes"].items()):
+            lines.append('msg_transfer_bytes_total{{type="{}",codec="{}",encrypt="{}"}} {}'.format(
+                msg_type, codec, encrypt, count))
+        lines.extend([
+            "# TYPE msg_transfer_errors_total counter",
+            "msg_transfer_errors_total {}".format(snapshot["errors"]),
+            "# TYPE msg_transfer_limit_violations_total counter",
+            "msg_transfer_limit_violations_total {}".format(
+                snapshot["limit_violations"]),
+            "# TYPE msg_transfer_connections_total counter",
+            "msg_transfer_connections_total {}".format(
+                snapshot["connections"]),
+            "# TYPE msg_transfer_active_connections gauge",
+            "msg_transfer_active_connections {}".format(
+                snapshot["active_connections"]),
+        ])
+        for name, histogram in (("msg_transfer_decode_seconds", snapshot["decode_time"]),
+                                ("msg_transfer_latency_seconds", snapshot["latency"])):
+            lines.append("# TYPE {} summary".format(name))
+            for quantile in QUANTILES:
+                lines.append('{}{{quantile="{}"}} {:.6f}'.format(
+                    name, quantile, histogram.percentile(quantile)))
+            lines.append("{}_sum {:.6f}".format(name, histogram.total))
+            lines.append("{}_count {}".format(name, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self, previous: dict) -> dict:
+        """
+        Logs the rates and latencies since the previous snapshot and returns the new snapshot
+        """
+
+        current = self.snapshot()
+        interval = max(current["time"] - previous["time"], 1e-9)
+        messages = sum(current["messages"].values()) - \
+            sum(previous["messages"].values())
+        nbytes = sum(current["bytes"].values()) - \
+            sum(previous["bytes"].values())
+        decode_time = current["decode_time"].since(previous["decode_time"])
+        latency = current["latency"].since(previous["latency"])
+        logger.info("Stats: %.1f msg/s, %.1f KiB/s, %d errors, %d active connections, "
+                    "decode p50 %.3f ms p99 %.3f ms, latency p50 %.3f ms p99 %.3f ms",
+                    messages / interval, nbytes / interval / 1024,
+                    current["errors"] - previous["errors"], current["active_connections"],
+                    decode_time.percentile(0.5) * 1e3, decode_time.percentile(0.99) * 1e3,
+                    latency.percentile(0.5) * 1e3, latency.percentile(0.99) * 1e3)
+        return current
+
+    def start_reporter(self, interval: float) -> threading.Event:
+        """
+        Logs a summary every interval seconds from a background thread.
+        Returns an event that stops the reporter when set
+        """
+
+        stop = threading.Event()
+
+        def report():
+            previous = self.snapshot()
+            while not stop.wait(interval):
+                previous = self.log_summary(previous)
+
+        threading.Thread(target=report, name="metrics-reporter",
+                         daemon=True).start()
+        return stop
+
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        """
+        Serves /metrics in the Prometheus text format and /stats as json from a background thread.
+        Returns the http server, call its shutdown method to stop it
+        """
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = registry.prometheus_text().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/stats":
+                    body = json.dumps(registry.to_json()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http",
+                         daemon=True).start()
+        logger.info("Metrics served at http://%s:%s/metrics",
+                    host, server.server_address[1])
+        return server
+
+
+class MetricsAggregate(MetricsRegistry):
+    """
+    Metrics of the worker processes of a pre-forked server, combined from the exports
+    they report. Serving and logging work as for a single registry
+    """
+
+    def __init__(self):
+        super().__init__()
+        # pid -> latest export of a running worker
+        self.reports = {}
+        # Totals of the workers that exited, so restarts do not reset the counters
+        self._retired = MetricsRegistry()
+
+    def update(self, pid: int, exported: dict):
+        """
+        Replaces the values of a worker with its latest export
+        """
+
+        with self._lock:
+            self.reports[pid] = exported
+
+    def worker_exited(self, pid: int):
+        """
+        Keeps the counters of an exited worker, its connections are gone
+        """
+
+        with self._lock:
+            exported = self.reports.pop(pid, None)
+        if exported is not None:
+            exported["active_connections"] = 0
+            self._retired.add_export(exported)
+
+    def snapshot(self) -> dict:
+        combined = MetricsRegistry()
+        combined.add_export(self._retired.export())
+        with self._lock:
+            reports = list(self.reports.values())
+        for exported in reports:
+            combined.add_export(exported)
+        return combined.snapshot()
+
+    def to_json(self) -> dict:
+        result = super().to_json()
+        with self._lock:
+            result["workers"] = [{"pid": pid,
+                                  "messages": sum(message[3] for message in exported["messages"]),
+                                  "active_connections": exported["active_connections"]}
+                                 for pid, exported in sorted(self.reports.items())]
+        return result
+
+
+def _histogram_json(histogram: Histogram) -> dict:
+    result = {"count": histogram.count, "sum": histogram.total,
+              "max": histogram.max}
+    for quantile in QUANTILES:
+        result["p{:g}".format(quantile * 100)] = histogram.percentile(quantile)
+    return result
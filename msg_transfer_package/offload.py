@@ -0,0 +1,93 @@
+"""
+Process pool that decrypts and deserializes large objects off the connection threads
+"""
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from .server import Server
+
+logger = logging.getLogger(__name__)
+
+# Smaller payloads are decoded on the calling thread, handing them over costs more than it saves
+MIN_SIZE = 65536
+# Workers are started on demand by connection threads, forking the threaded server there could
+# copy locks other threads hold. The fork server is a separate single threaded process
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def _decode_shared(name: str, length: int, metadata: dict, max_size=0):
+    """
+    Runs in a worker process, decodes the payload the server placed in shared memory
+    """
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        view = shm.buf[:length]
+        try:
+            # Decryption and decompression read the shared block directly,
+            # the text parsers need bytes
+            if metadata["encrypt"] or metadata.get("compression"):
+                received = view
+            else:
+                received = bytes(view)
+            return Server.decode_object(received, metadata, max_size)
+        finally:
+            received = None
+            view.release()
+    finally:
+        shm.close()
+
+
+class DecodePool:
+    """
+    Decodes large objects in worker processes so parsing uses more than one core
+    and does not hold the GIL of the connection threads.
+    The raw payload is copied once into shared memory instead of being pickled to the worker
+    """
+
+    def __init__(self, processes=None, min_size=MIN_SIZE):
+        """
+        processes: number of worker processes, defaults to the number of CPUs
+        min_size: payloads smaller than this are decoded on the calling thread
+        """
+
+        self.processes = processes or os.cpu_count() or 1
+        self.min_size = min_size
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes, mp_context=multiprocessing.get_context(START_METHOD))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def decode(self, received: bytes, metadata: dict, max_size=0):
+        """
+        Decrypts, decompresses and deserializes an object like Server.decode_object.
+        Blocks the calling thread, without holding the GIL, until a worker is done
+        max_size: largest decompressed size accepted, 0 for no limit
+        """
+
+        length = len(received)
+        if length < self.min_size:
+            return Server.decode_object(received, metadata, max_size)
+
+        shm = shared_memory.SharedMemory(create=True, size=length)
+        try:
+            shm.buf[:length] = received
+            return self._executor.submit(
+                _decode_shared, shm.name, length, metadata, max_size).result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        """
+        Waits for running decodes and stops the worker processes
+        """
+
+        self._executor.shutdown()
@@ -0,0 +1,144 @@
+"""
+Pool of persistent client connections
+"""
+
+import logging
+import threading
+import time
+from .client import Client
+
+logger = logging.getLogger(__name__)
+
+
+class ClientPool:
+    """
+    Keeps warm connections to servers, keyed by (host, port), and reuses them for transfers
+    """
+
+    def __init__(self, max_idle=4, idle_ttl=60.0, protocol_version=1):
+        """
+        max_idle: idle connections kept open per server
+        idle_ttl: seconds an idle connection is kept before it is closed
+        protocol_version: protocol version of the pooled clients
+        """
+
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        self.protocol_version = protocol_version
+        # (host, port) -> list of (client, time it was returned to the pool)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def acquire(self, host: str, host_port: int):
+        """
+        Takes a healthy idle connection to the server out of the pool or opens a new one.
+        Returns the client and whether it was reused
+        """
+
+        self.evict_idle()
+        key = (host, host_port)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                client, _ = idle.pop()
+            if client.is_alive():
+                return client, True
+            logger.info("Dropping dead connection to %s:%s", *key)
+            client.close()
+
+        client = Client(host, host_port,
+                        protocol_version=self.protocol_version)
+        try:
+            client.connection()
+        except OSError:
+            client.close()
+            raise
+        return client, False
+
+    def release(self, client: Client):
+        """
+        Returns a connection to the pool, closing it if enough are idle already
+        """
+
+        with self._lock:
+            idle = self._idle.setdefault((client.host, client.host_port), [])
+            if len(idle) < self.max_idle:
+                idle.append((client, time.monotonic()))
+                return
+        client.close()
+
+    def evict_idle(self):
+        """
+        Closes connections that have been idle for longer than idle_ttl
+        """
+
+        deadline = time.monotonic() - self.idle_ttl
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                expired.extend(client for client,
+                               last_used in idle if last_used < deadline)
+                idle[:] = [(client, last_used)
+                           for client, last_used in idle if last_used >= deadline]
+        for client in expired:
+            client.close()
+
+    def close(self):
+        """
+        Closes every idle connection
+        """
+
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for client, _ in connections:
+                client.close()
+
+    def _transfer(self, host: str, host_port: int, send):
+        """
+        Runs send on a pooled connection. If a reused connection turns out to be broken
+        before anything was sent on it, the transfer is retried on a fresh connection.
+        Once the request was sent the server may have processed it, so the error is raised
+        """
+
+        while True:
+            client, reused = self.acquire(host, host_port)
+            writes = client.writes
+            try:
+                reply = send(client)
+            except OSError:
+                client.close()
+                if not reused or client.writes != writes:
+                    raise
+                logger.info("Reconnecting to %s:%s", host, host_port)
+                continue
+            except BaseException:
+                client.close()
+                raise
+            self.release(client)
+            return reply
+
+    def transfer_object(self, host: str, host_port: int, serialization_method: str, obj: any,
+                        encrypt=True) -> bytes:
+        """
+        Transfers a python object over a pooled connection and returns the server reply
+        """
+
+        return self._transfer(host, host_port, lambda client: client.transfer_object(
+            serialization_method, obj, encrypt))
+
+    def transfer_file(self, host: str, host_port: int, input_file_path: str, encrypt=True) -> bytes:
+        """
+        Transfers a file over a pooled connection and returns the server reply
+        """
+
+        return self._transfer(host, host_port, lambda client: client.transfer_file(
+            input_file_path, encrypt))
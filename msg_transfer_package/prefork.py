@@ -0,0 +1,302 @@
+"""
+Pre-forked multi-process serving. A supervisor forks worker processes that each run their own
+server bound to the same address with SO_REUSEPORT, so the kernel spreads the connections
+between them and decoding runs on as many cores as there are workers.
+The supervisor restarts workers that exit and combines the metrics they report
+"""
+
+import json
+import logging
+import os
+import selectors
+import signal
+import threading
+import time
+from .metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+# Seconds between metrics reports of a worker and between checks that its supervisor is alive
+REPORT_INTERVAL = 1.0
+# A worker that exits sooner than this after starting doubles the delay before its restart
+MIN_UPTIME = 5.0
+MAX_RESTART_DELAY = 60.0
+
+
+def _terminate(signum, frame):
+    # Only the first signal interrupts the server, the next ones must not cut its draining short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+class Worker:
+    """
+    A worker process as seen by the supervisor
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.pid = None
+        self.started = 0.0
+        self.restart_delay = None
+        self.restart_at = None
+        self.restarts = 0
+        # Read end of the pipe the worker reports its metrics on
+        self.reports = None
+        self.partial = b""
+
+
+class Supervisor:
+    """
+    Forks and supervises the worker processes of a server
+    """
+
+    def __init__(self, target, processes: int, metrics=None, restart_delay=1.0,
+                 shutdown_timeout=30.0, report_interval=REPORT_INTERVAL):
+        """
+        target: function run in each worker with its index and its MetricsRegistry, None when
+        metrics are not collected. It serves until KeyboardInterrupt, which workers receive
+        when the supervisor stops
+        processes: number of workers
+        metrics: MetricsAggregate the reports of the workers are combined in
+        restart_delay: seconds before a worker that exited is started again
+        shutdown_timeout: seconds the workers get to drain their connections when stopping
+        report_interval: seconds between the metrics reports of a worker
+        """
+
+        if processes < 1:
+            raise ValueError("processes must be positive")
+        self.target = target
+        self.processes = processes
+        self.metrics = metrics
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.report_interval = report_interval
+        self.workers = [Worker(index) for index in range(processes)]
+        self._selector = selectors.DefaultSelector()
+        self._stopping = False
+
+    def run(self):
+        """
+        Starts the workers and keeps them running until SIGINT or SIGTERM
+        """
+
+        previous = signal.signal(signal.SIGTERM, _terminate)
+        try:
+            for worker in self.workers:
+                self._spawn(worker)
+            logger.info("Supervisor %s started %d workers",
+                        os.getpid(), self.processes)
+            while True:
+                self._read_reports(self.report_interval)
+                self._reap()
+                self._restart_due()
+        except KeyboardInterrupt:
+            logger.info("Supervisor stopping %d workers", self.processes)
+            self._stop()
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self._selector.close()
+
+    def _spawn(self, worker: Worker):
+        read_fd = write_fd = None
+        if self.metrics is not None:
+            read_fd, write_fd = os.pipe()
+        supervisor = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            if read_fd is not None:
+                os.close(read_fd)
+            self._run_worker(worker.index, supervisor, write_fd)
+
+        worker.pid = pid
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        if read_fd is not None:
+            os.close(write_fd)
+            os.set_blocking(read_fd, False)
+            worker.reports = read_fd
+            worker.partial = b""
+            self._selector.register(read_fd, selectors.EVENT_READ, worker)
+        logger.info("Worker %d started with pid %d", worker.index, pid)
+
+    def _run_worker(self, index: int, supervisor: int, write_fd: int):
+        """
+        Body of a worker process, it never returns to the caller of fork
+        """
+
+        code = 0
+        try:
+            # Ctrl+C reaches the whole process group, only the supervisor reacts to it
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, _terminate)
+            # Pipes of the other workers stay with the supervisor
+            self._selector.close()
+            for other in self.workers:
+                if other.reports is not None:
+                    os.close(other.reports)
+            metrics = MetricsRegistry() if write_fd is not None else None
+            stop = threading.Event()
+            reporter = threading.Thread(target=self._report, name="worker-report", daemon=True,
+                                        args=(supervisor, metrics, write_fd, stop))
+            reporter.start()
+            try:
+                self.target(index, metrics)
+            finally:
+                stop.set()
+                reporter.join()
+                if metrics is not None:
+                    self._send_report(metrics, write_fd)
+        except KeyboardInterrupt:
+            pass
+        except SystemExit as exit:
+            code = exit.code if isinstance(exit.code, int) else 0
+        except BaseException:
+            logger.exception("Worker %d failed", index)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _report(self, supervisor: int, metrics, write_fd: int, stop: threading.Event):
+        """
+        Sends the worker's metrics to the supervisor and stops the worker if the supervisor died
+        """
+
+        while not stop.wait(self.report_interval):
+            if os.getppid() != supervisor:
+                logger.warning("Supervisor %s is gone, stopping", supervisor)
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            if metrics is not None:
+                try:
+                    self._send_report(metrics, write_fd)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _send_report(metrics: MetricsRegistry, write_fd: int):
+        data = json.dumps(metrics.export()).encode() + b"\n"
+        view = memoryview(data)
+        while view:
+            view = view[os.write(write_fd, view):]
+
+    def _read_reports(self, timeout: float):
+        """
+        Waits up to timeout for metrics reports and keeps the latest one of every worker
+        """
+
+        if not self._selector.get_map():
+            time.sleep(timeout)
+            return
+        for key, _ in self._selector.select(timeout):
+            worker = key.data
+            try:
+                data = os.read(worker.reports, 1048576)
+            except BlockingIOError:
+                continue
+            if not data:
+                self._close_reports(worker)
+                continue
+            lines = (worker.partial + data).split(b"\n")
+            worker.partial = lines.pop()
+            if lines:
+                self.metrics.update(worker.pid, json.loads(lines[-1]))
+
+    def _close_reports(self, worker: Worker):
+        if worker.reports is not None:
+            self._selector.unregister(worker.reports)
+            os.close(worker.reports)
+            worker.reports = None
+
+    def _reap(self):
+        """
+        Collects exited workers and schedules their restart
+        """
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            worker = next(
+                (worker for worker in self.workers if worker.pid == pid), None)
+            if worker is None:
+                continue
+            # The last report may still be in the pipe
+            if worker.reports is not None:
+                self._read_final_report(worker)
+            if self.metrics is not None:
+                self.metrics.worker_exited(pid)
+            worker.pid = None
+            if self._stopping:
+                logger.info("Worker %d (pid %d) exited", worker.index, pid)
+                continue
+
+            uptime = time.monotonic() - worker.started
+            if worker.restart_delay is None or uptime >= MIN_UPTIME:
+                worker.restart_delay = self.restart_delay
+            else:
+                # A worker that keeps failing at start is not restarted in a tight loop
+                worker.restart_delay = min(
+                    worker.restart_delay * 2, MAX_RESTART_DELAY)
+            worker.restart_at = time.monotonic() + worker.restart_delay
+            logger.warning("Worker %d (pid %d) exited with status %d, restarting in %.1f s",
+                           worker.index, pid, os.waitstatus_to_exitcode(status),
+                           worker.restart_delay)
+
+    def _read_final_report(self, worker: Worker):
+        data = worker.partial
+        while True:
+            try:
+                chunk = os.read(worker.reports, 1048576)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        lines = [line for line in data.split(b"\n") if line]
+        if lines:
+            try:
+                self.metrics.update(worker.pid, json.loads(lines[-1]))
+            except ValueError:
+                # Cut short by a crash
+                pass
+        self._close_reports(worker)
+
+    def _restart_due(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.pid is None and worker.restart_at is not None and worker.restart_at <= now:
+                worker.restarts += 1
+                self._spawn(worker)
+
+    def _stop(self):
+        """
+        Asks every worker to drain its connections and exit, kills those that take too long
+        """
+
+        self._stopping = True
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        deadline = time.monotonic() + self.shutdown_timeout
+        while any(worker.pid is not None for worker in self.workers):
+            if time.monotonic() >= deadline:
+                for worker in self.workers:
+                    if worker.pid is not None:
+                        logger.warning("Killing worker %d (pid %d)",
+                                       worker.index, worker.pid)
+                        try:
+                            os.kill(worker.pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                deadline = float("inf")
+            self._read_reports(0.05)
+            self._reap()
+        logger.info("Supervisor %s stopped", os.getpid())
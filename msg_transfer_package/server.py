@@ -2,176 +2,706 @@
 Network server module
 """
 
+import hashlib
+import os
 import socket
 import sys
 import json
 import pickle
 import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import xmltodict
-from .utils import decrypt_message, get_params
+from . import codec, columnar
+from .chunks import ChunkStore
+from .delta import DeltaStore
+from .compression import decompress_payload
+from .dedup import HAVE_IT, PROBE, SEND_IT
+from .limits import ByteBudget, Limits
+from .manifest import receive_manifest, received_path
+from .logconfig import PAYLOAD_LOGGER
+from .sink import encode_record
+from .utils import (
+    CODEC_NAMES,
+    FLAG_STORE,
+    FrameDecoder,
+    ProtocolError,
+    create_reply,
+    decrypt_message,
+    new_cipher,
+    unpack_batch,
+)
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    format="SERVER: %(asctime)s %(levelname)s %(message)s",
-    level=logging.INFO,
-    handlers=[logging.FileHandler("server_log.log"), logging.StreamHandler()],
-)
+# Received payloads are only logged when this logger is set to DEBUG, see logconfig
+payload_logger = logging.getLogger(PAYLOAD_LOGGER)
 HEADER_SIZE = 16
+# Size of the reusable receive buffer of each connection
+BUFFER_SIZE = 65536
+# Seconds an idle connection waits on recv before re-checking for shutdown
+POLL_INTERVAL = 1.0
+# File received objects are appended to when the server has no output sink
+OBJECT_FILENAME = "received_file.txt"
+
+
+def create_response(msg_params: dict, message: bytes, error=False) -> bytes:
+    """
+    Creates the reply to a message, echoing its protocol version and request id
+    """
+
+    return create_reply(message, HEADER_SIZE, msg_params.get("version", 1),
+                        msg_params.get("request_id"), error)
+
+
+class FileReceiver:
+    """
+    Writes a received file to disk as it arrives, decrypting it incrementally,
+    and moves it into place only once it is complete
+    """
+
+    def __init__(self, metadata: dict, blobs=None):
+        """
+        blobs: BlobStore the file is added to when the client flagged it for storing
+        """
+
+        self.filename = received_path(metadata["filename"], create=True)
+        self.cipher = new_cipher() if metadata["encrypt"] else None
+        self.blobs = blobs if metadata.get("flags", 0) & FLAG_STORE else None
+        self.digest = hashlib.sha256() if self.blobs is not None else None
+        fd, self.temp_path = tempfile.mkstemp(
+            prefix=".received_", suffix=".part",
+            dir=os.path.dirname(os.path.abspath(self.filename)))
+        self.file = os.fdopen(fd, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.temp_path, self.filename)
+            logger.info("Recevied data saved to file: %s", self.filename)
+            if self.blobs is not None:
+                self.blobs.add_file(self.filename, self.digest.digest())
+        else:
+            os.remove(self.temp_path)
+
+    def write(self, chunk):
+        """
+        Decrypts and writes the next part of the file, a writable chunk is decrypted in place
+        """
+
+        if self.cipher is not None:
+            if isinstance(chunk, bytes):
+                chunk = self.cipher.decrypt(chunk)
+            else:
+                self.cipher.decrypt(chunk, output=chunk)
+        if self.digest is not None:
+            self.digest.update(chunk)
+        self.file.write(chunk)
+
+
+class FilePrinter:
+    """
+    Receives a file for the print output as it arrives, counting its bytes instead of
+    keeping them. They are only buffered when payload logging is switched on, and written
+    to a temporary file when the client flagged the file for storing
+    """
+
+    def __init__(self, metadata: dict, blobs=None):
+        """
+        blobs: BlobStore the file is added to when the client flagged it for storing
+        """
+
+        self.metadata = metadata
+        self.size = 0
+        self.payload = bytearray() if payload_logger.isEnabledFor(logging.DEBUG) else None
+        self.blobs = blobs if metadata.get("flags", 0) & FLAG_STORE else None
+        self.digest = None
+        self.file = None
+        if self.blobs is not None:
+            self.digest = hashlib.sha256()
+            fd, self.temp_path = tempfile.mkstemp(
+                prefix=".received_", suffix=".part", dir=self.blobs.directory)
+            self.file = os.fdopen(fd, "wb")
+        # The contents are only needed in the clear to be logged or stored
+        needed = self.payload is not None or self.file is not None
+        self.cipher = new_cipher() if metadata["encrypt"] and needed else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is not None:
+            self.file.close()
+            try:
+                if exc_type is None:
+                    self.blobs.add_file(self.temp_path, self.digest.digest())
+            finally:
+                os.remove(self.temp_path)
+        if exc_type is None:
+            logger.info("Received file: %s, %d bytes", self.metadata["filename"], self.size)
+            if self.payload is not None:
+                payload_logger.debug("Recevied data:\n%s", bytes(self.payload))
+
+    def write(self, chunk):
+        """
+        Counts the next part of the file, a writable chunk is decrypted in place
+        """
+
+        self.size += len(chunk)
+        if self.cipher is not None:
+            if isinstance(chunk, bytes):
+                chunk = self.cipher.decrypt(chunk)
+            else:
+                self.cipher.decrypt(chunk, output=chunk)
+        if self.payload is not None:
+            self.payload += chunk
+        if self.file is not None:
+            self.digest.update(chunk)
+            self.file.write(chunk)
+
+
+class MessageDispatch:
+    """
+    Message handling shared by Server and AsyncServer, which only differ in how they read
+    the messages. Uses their output_option, decode_pool, sink, limits, blobs, chunks and deltas
+    """
+
+    # Frames whose payload is handed to a stream receiver as it arrives, rather than
+    # held in memory, so they are exempt from max_frame_size. Both are files being received
+    STREAMED_TYPES = ("file", "delta")
+
+    def stream_receiver(self, msg_params: dict):
+        """
+        Receiver a streamed payload is written to as it arrives. Raises ProtocolError when the
+        frame is refused, as the payload that follows cannot be skipped
+        """
+
+        try:
+            if msg_params["type"] == "delta":
+                return self.deltas.receiver(msg_params)
+            if self.output_option == "file":
+                return FileReceiver(msg_params, self.blobs)
+            return FilePrinter(msg_params, self.blobs)
+        except ValueError as err:
+            raise ProtocolError(str(err), msg_params) from err
+
+    def process_message(self, msg: bytearray, msg_params: dict) -> bytes:
+        """
+        Hands a complete message to the matching receive function and returns the reply.
+        Runs on a connection thread, or an executor thread for AsyncServer
+        """
+
+        if msg_params["type"] == "file":
+            if self.output_option == "file":
+                with FileReceiver(msg_params, self.blobs) as receiver:
+                    receiver.write(msg)
+            else:
+                Server.receive_file(msg, msg_params, self.output_option, self.blobs)
+            return b"Received File successfully"
+        if msg_params["type"] == "object":
+            msg, msg_params = Server.store_object(
+                msg, msg_params, self.blobs, self.limits.max_frame_size)
+            Server.receive_object(msg, msg_params, self.output_option,
+                                  self.decode_pool, self.sink, self.limits.max_frame_size)
+            return b"Received Object successfully"
+        if msg_params["type"] == "batch":
+            objects = Server.receive_object(
+                msg, msg_params, self.output_option, self.decode_pool, self.sink,
+                self.limits.max_frame_size)
+            return "Received Batch of {} objects successfully".format(len(objects)).encode()
+        if msg_params["type"] in ("chunk", "resume"):
+            return self.chunks.handle(msg, msg_params)
+        if msg_params["type"] in ("signature", "delta"):
+            return self.deltas.handle(msg, msg_params)
+        if msg_params["type"] == "manifest":
+            return receive_manifest(msg, msg_params, create=self.output_option == "file")
+        if msg_params["type"] == "probe":
+            return Server.receive_probe(msg, msg_params, self.output_option, self.blobs,
+                                        self.decode_pool, self.sink, self.limits.max_frame_size)
+        raise ValueError("Unknown message type {}".format(msg_params["type"]))
 
 
-class Server(socket.socket):
+class Server(MessageDispatch, socket.socket):
     """
     Server class to receive requests and data from client
     """
 
-    def __init__(self, host_addr: str, addr_port: int, output_option="file", *args, **kwargs):
+    def __init__(self, host_addr: str, addr_port: int, output_option="file", *args,
+                 workers=16, queue_depth=64, backlog=128, decode_pool=None, sink=None,
+                 metrics=None, limits=None, reuse_port=False, blobs=None, **kwargs):
         """
         host: ip address or hostname of the receiving server
         port: The port of the receiving server
         output_option: Output to terminal or save to file, allowed values: (file, print)
+        workers: number of connections served concurrently
+        queue_depth: accepted connections allowed to wait for a free worker
+        backlog: number of unaccepted incoming connections before refusing new connections
+        decode_pool: DecodePool that decrypts and parses large objects in worker processes,
+        by default objects are decoded on the connection thread
+        sink: WriteBehindSink that objects are written to when output_option is file
+        metrics: MetricsRegistry the connections and messages are counted in
+        limits: Limits on message sizes, buffered bytes, timeouts and connections,
+        the Limits defaults when not given
+        reuse_port: set SO_REUSEPORT so several processes can listen on the same address
+        and the kernel spreads the connections between them
+        blobs: BlobStore that lets clients skip sending contents the server already holds,
+        without one every probe is answered with SEND_IT
         """
 
         super().__init__(*args, **kwargs)
         self.host_addr = host_addr
         self.addr_port = addr_port
         self.output_option = output_option
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.backlog = backlog
+        self.decode_pool = decode_pool
+        self.sink = sink
+        self.metrics = metrics
+        self.limits = limits if limits is not None else Limits()
+        self.reuse_port = reuse_port
+        self.blobs = blobs
+        # Received bytes all connections may still buffer
+        self.budget = ByteBudget(self.limits.global_budget)
+        self._connections = 0
+        self._connections_lock = threading.Lock()
+        # Partial files of resumable transfers, shared by all connections
+        self.chunks = ChunkStore(limits=self.limits)
+        self.deltas = DeltaStore()
+        self.shutdown_event = threading.Event()
 
     def run_server(self):
         """
-        Bind and listen for new client connections
+        Bind and listen for new client connections, serving them from a bounded worker pool
         """
 
+        if self.reuse_port:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.bind((self.host_addr, self.addr_port))
+        self.listen(self.backlog)
+        logger.info("[*] Listening at %s:%s", self.host_addr, self.addr_port)
 
-        # number of unaccepted incoming connections before refusing new connections
-        self.listen(5)
-        logger.info(
-            "[*] Listening at {}:{}".format(self.host_addr, self.addr_port))
+        # Stop accepting while every worker is busy and the queue is full,
+        # leaving further clients in the kernel backlog
+        slots = threading.BoundedSemaphore(self.workers + self.queue_depth)
 
-        while True:
+        def connection_done(_):
+            with self._connections_lock:
+                self._connections -= 1
+            slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix="connection") as pool:
             try:
-                client_socket, address = self.accept()
+                while True:
+                    slots.acquire()
+                    client_socket, address = self.accept()
+                    if not self._admit_connection():
+                        logger.warning("Refusing %s, %d connections are open",
+                                       address, self.limits.max_connections)
+                        client_socket.close()
+                        slots.release()
+                        continue
+                    logger.info("[+] %s is connected.", address)
+                    future = pool.submit(
+                        self.handle_connection, client_socket, address)
+                    future.add_done_callback(connection_done)
             except KeyboardInterrupt:
-                logger.info("Server {}:{} shutdown.".format(
-                    self.host_addr, self.addr_port))
-                sys.exit()
-            logger.info("[+] {} is connected.".format(address))
-            # receive using client socket, not server socket
-            self.receive_data(client_socket, address)
+                logger.info("Server %s:%s shutting down, draining connections.",
+                            self.host_addr, self.addr_port)
+                self.shutdown_event.set()
+                self.close()
 
-    @staticmethod
-    def receive_object(received: bytes, metadata: dict, output_option: str):
+        logger.info("Server %s:%s shutdown.", self.host_addr, self.addr_port)
+        sys.exit()
+
+    def _admit_connection(self) -> bool:
         """
-        Receive the bytes and deserializes according to the received metadata
+        Counts a new connection unless max_connections are already open
         """
 
-        if metadata["encrypt"]:
-            received = decrypt_message(received)
+        with self._connections_lock:
+            if self._connections >= self.limits.max_connections:
+                admitted = False
+            else:
+                self._connections += 1
+                admitted = True
+        if not admitted and self.metrics is not None:
+            self.metrics.limit_violation()
+        return admitted
+
+    def handle_connection(self, sock: socket.socket, address: str):
+        """
+        Serves one accepted client connection until it disconnects or the server shuts down
+        """
+
+        # The timeout lets idle connections notice a shutdown request
+        sock.settimeout(POLL_INTERVAL)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        with sock:
+            try:
+                # receive using client socket, not server socket
+                self.receive_data(sock, address)
+            except Exception:
+                logger.exception("Error serving client %s", address)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.connection_closed()
+
+    @staticmethod
+    def parse_object(received: bytes, serialization_method: str):
+        """
+        Deserializes one object
+        """
 
-        if metadata["serialize"].lower() == "binary":
+        if serialization_method.lower() == "binary":
             received_parse = pickle.loads(received)
-        elif metadata["serialize"].lower() == "xml":
+        elif serialization_method.lower() == "xml":
             received_parse = xmltodict.parse(received)
             if "msg" in received_parse:
                 received_parse = received_parse["msg"]
-        elif metadata["serialize"].lower() == "json":
+        elif serialization_method.lower() == "json":
             received_parse = json.loads(received)
+        elif serialization_method.lower() == "compact":
+            received_parse = codec.loads(received)
+        elif serialization_method.lower() == "columnar":
+            # A RecordBatch, its columns are used as they are and rows are built on access
+            received_parse = columnar.decode(received)
         else:
             logger.warning("Incorrect serialization method provided")
             raise ValueError("Incorrect serialization method provided")
+        return received_parse
+
+    @staticmethod
+    def decode_object(received: bytes, metadata: dict, max_size=0):
+        """
+        Decrypts, decompresses and deserializes a received object.
+        A batch is returned as the list of its objects
+        max_size: largest decompressed size accepted, 0 for no limit
+        """
+
+        if metadata["encrypt"]:
+            received = decrypt_message(received)
+        if metadata.get("compression"):
+            received = decompress_payload(received, metadata["compression"], max_size)
+
+        if metadata.get("type") == "batch":
+            return [Server.parse_object(item, metadata["serialize"])
+                    for item in unpack_batch(received)]
+        return Server.parse_object(received, metadata["serialize"])
+
+    @staticmethod
+    def receive_object(received: bytes, metadata: dict, output_option: str, decode_pool=None,
+                       sink=None, max_size=0):
+        """
+        Receive the bytes and deserializes according to the received metadata.
+        A batch is returned as the list of its objects
+        decode_pool: DecodePool that decodes large objects in worker processes
+        sink: WriteBehindSink that writes file output in the background,
+        without one the objects are appended to OBJECT_FILENAME before returning
+        max_size: largest decompressed size accepted, 0 for no limit
+        """
+
+        if decode_pool is not None:
+            received_parse = decode_pool.decode(received, metadata, max_size)
+        else:
+            received_parse = Server.decode_object(received, metadata, max_size)
 
         if output_option == "print":
-            logger.info("Received object: serialization: {}, encrypted: {}, type={}".format(
-                metadata["serialize"].lower(), metadata["encrypt"], type(received_parse)))
+            logger.info("Received object: serialization: %s, encrypted: %s, type=%s",
+                        metadata["serialize"], metadata["encrypt"], type(received_parse))
         else:
-            # The default file name if an object is sent
-            filename = "received_file.txt"
-            # Saves the recevied data to file
-            with open(filename, "wb") as file:
-                file.write(json.dumps(received_parse))
-            logger.info("Received object saved to file: {}, serialization: {}, encrypted: {}, type={}".format(
-                filename,  metadata["serialize"].lower(), metadata["encrypt"], type(received_parse)))
+            # One json line per object, the objects of a batch get a line each
+            objects = received_parse if metadata.get(
+                "type") == "batch" else [received_parse]
+            records = b"".join(encode_record(obj) for obj in objects)
+            if sink is not None:
+                sink.write(records)
+                filename = sink.path
+            else:
+                filename = OBJECT_FILENAME
+                with open(filename, "ab") as file:
+                    file.write(records)
+            logger.debug("Received object saved to file: %s, serialization: %s, encrypted: %s, type=%s",
+                         filename, metadata["serialize"], metadata["encrypt"], type(received_parse))
 
         return received_parse
 
     @staticmethod
-    def receive_file(received: bytes, metadata: dict, output_option: str):
+    def receive_file(received: bytes, metadata: dict, output_option: str, blobs=None):
         """
         Receive the file bytes and deserializes according to the received metadata
+        blobs: BlobStore the file is added to when the client flagged it for storing
         """
-        logger.info("Received File, encrypted: {}".format(metadata["encrypt"]))
+        logger.debug("Received File, encrypted: %s", metadata["encrypt"])
 
         if metadata["encrypt"]:
             received = decrypt_message(received)
+        if blobs is not None and metadata.get("flags", 0) & FLAG_STORE:
+            blobs.add_bytes(received)
         if output_option == "print":
-            logger.info("Recevied data:\n{}".format(received))
+            # The payload itself is only formatted when payload logging is switched on
+            logger.info("Received file: %s, %d bytes",
+                        metadata["filename"], len(received))
+            if payload_logger.isEnabledFor(logging.DEBUG):
+                payload_logger.debug("Recevied data:\n%s", received)
         else:
             # The default file name if an object is sent
-            filename = "received_"+metadata["filename"]
+            filename = received_path(metadata["filename"], create=True)
             # Saves the recevied data to file
             with open(filename, "wb") as file:
                 file.write(received)
-            logger.info("Recevied data saved to file: {}".format(filename))
+            logger.info("Recevied data saved to file: %s", filename)
 
         return received
 
+    @staticmethod
+    def store_object(received: bytes, metadata: dict, blobs=None, max_size=0):
+        """
+        Adds an object the client flagged for storing to the BlobStore. The store holds the
+        serialized object, so it is decrypted and decompressed here and returned with
+        metadata saying so
+        max_size: largest decompressed size accepted, 0 for no limit
+        """
+
+        if blobs is None or not metadata.get("flags", 0) & FLAG_STORE:
+            return received, metadata
+        if metadata["encrypt"]:
+            received = decrypt_message(received)
+        if metadata.get("compression"):
+            received = decompress_payload(received, metadata["compression"], max_size)
+        blobs.add_bytes(received)
+        return received, dict(metadata, encrypt=False, compression=None)
+
+    @staticmethod
+    def receive_probe(received: bytes, metadata: dict, output_option: str, blobs=None,
+                      decode_pool=None, sink=None, max_size=0) -> bytes:
+        """
+        Answers a probe with HAVE_IT when the store holds the content, which is then used as if
+        it had been received: a file is linked to its new name, an object is processed.
+        Answers SEND_IT otherwise
+        max_size: largest decompressed size accepted, 0 for no limit
+        """
+
+        if metadata["encrypt"]:
+            received = decrypt_message(received)
+        digest, size, codec_id = PROBE.unpack(received)
+        if blobs is None or not blobs.has(digest, size):
+            return SEND_IT
+
+        if not codec_id:
+            if output_option == "print":
+                logger.info("Received file: %s, %d bytes, already stored",
+                            metadata["filename"], size)
+            else:
+                filename = received_path(metadata["filename"], create=True)
+                blobs.link(digest, filename)
+                logger.info("Recevied data linked to file: %s", filename)
+            return HAVE_IT
+
+        if codec_id not in CODEC_NAMES:
+            raise ValueError("Unknown codec {}".format(codec_id))
+        object_params = {"type": "object", "serialize": CODEC_NAMES[codec_id],
+                         "encrypt": False, "compression": None}
+        Server.receive_object(blobs.read(digest), object_params, output_option,
+                              decode_pool, sink, max_size)
+        return HAVE_IT
+
+    def _recv(self, sock: socket.socket, view: memoryview, idle=False, deadline: float = None) -> int:
+        """
+        Receives whatever the client has sent so far into view and returns the number of bytes.
+        Returns 0 when the connection is idle and the server is shutting down or the deadline
+        passed, raises ProtocolError when a message is waiting to be completed past the deadline
+        and ConnectionError when the client disconnects
+        idle: no part of a message is waiting to be completed
+        deadline: time.monotonic() by which data must arrive
+        """
+
+        while True:
+            try:
+                nbytes = sock.recv_into(view)
+            except socket.timeout:
+                # Only stop between messages so in-flight data is drained
+                if idle and self.shutdown_event.is_set():
+                    return 0
+                if deadline is not None and time.monotonic() >= deadline:
+                    if idle:
+                        return 0
+                    raise ProtocolError(
+                        "Timed out waiting for the rest of the message")
+                continue
+            if not nbytes:
+                raise ConnectionError("Client disconnected")
+            return nbytes
+
+    def _receive_stream(self, sock: socket.socket, msg_params: dict, received: bytearray,
+                        view: memoryview) -> tuple:
+        """
+        Streams a payload into its stream receiver as it arrives.
+        Returns the reply and whether it reports an error
+        received: the start of the payload that already arrived with the header
+        """
+
+        complete = False
+        try:
+            with self.stream_receiver(msg_params) as receiver:
+                receiver.write(received)
+                remaining = msg_params["length"] - len(received)
+                while remaining:
+                    nbytes = self._recv(sock, view[:min(remaining, len(view))],
+                                        deadline=time.monotonic() + self.limits.read_timeout)
+                    receiver.write(view[:nbytes])
+                    remaining -= nbytes
+                complete = True
+        except ProtocolError as err:
+            err.metadata = msg_params
+            raise
+        except Exception as err:
+            if not complete:
+                raise
+            # The payload was read completely, so the connection stays usable
+            return "Failed to process message: {}".format(err).encode(), True
+        return b"Received File successfully", False
+
+    def _record_message(self, msg_params: dict, started: float, process_time: float = None,
+                        error=False):
+        """
+        Adds a replied message to the metrics, if the server collects them
+        process_time: seconds spent decoding and handing an object to the output
+        """
+
+        if self.metrics is not None:
+            self.metrics.message_received(msg_params, process_time, error)
+            self.metrics.reply_sent(time.perf_counter() - started)
+
+    def _reserve(self, nbytes: int, idle: bool, metadata: dict) -> int:
+        """
+        Takes up to nbytes out of the global budget before reading them, waiting while other
+        connections use it up. Returns 0 when the connection is idle and the server shuts down
+        metadata: header of the message being received, if it arrived
+        """
+
+        deadline = time.monotonic() + self.limits.read_timeout
+        while True:
+            taken = self.budget.acquire(nbytes, POLL_INTERVAL)
+            if taken:
+                return taken
+            if idle and self.shutdown_event.is_set():
+                return 0
+            # A connection holding part of a message gives its bytes back rather than
+            # waiting forever for connections that may be waiting for it
+            if not idle and time.monotonic() >= deadline:
+                raise ProtocolError(
+                    "Server is out of receive buffer space, retry later", metadata)
+
+    def _read_deadline(self, decoder: FrameDecoder, last_read: float, header_started: float) -> float:
+        """
+        time.monotonic() by which the connection must send more data
+        """
+
+        if decoder.idle:
+            return last_read + self.limits.idle_timeout
+        if decoder.header is None:
+            # A header trickling in byte by byte must still arrive within read_timeout
+            return header_started + self.limits.read_timeout
+        return last_read + self.limits.read_timeout
+
     def receive_data(self, sock: socket.socket, address: str):
         """
         While loop for receiving and processing the requests and sending responses
         """
 
-        while True:
-            full_msg = b""
-            new_msg = True
-            close_connection = False
+        decoder = FrameDecoder(HEADER_SIZE, self.limits.max_frame_size, self.STREAMED_TYPES)
+        buffer = memoryview(bytearray(BUFFER_SIZE))
+        # When the read that brought the first bytes of the current message arrived
+        started = time.perf_counter()
+        last_read = header_started = time.monotonic()
+        # Bytes of the global budget held for the data buffered in the decoder
+        held = 0
+        try:
             while True:
                 try:
-                    msg = sock.recv(8192)
-                    if not msg:
-                        close_connection = True
-                        logger.info("Client {} disconnected.".format(address))
+                    idle = decoder.idle
+                    # Stops reading while the connection's budget is used up
+                    room = min(len(buffer), self.limits.connection_budget - decoder.buffered)
+                    taken = self._reserve(room, idle, decoder.header)
+                    if not taken:
+                        logger.info("Closing idle client %s for shutdown.", address)
                         break
-                except ConnectionResetError:
-                    close_connection = True
-                    logger.info("Client {} disconnected.".format(address))
-                    break
-                if new_msg:
-                    try:
-                        msg_params = get_params(msg, HEADER_SIZE)
-                    except ValueError as val:
-                        logger.info(val)
-                        continue
-                    new_msg = False
-
-                full_msg += msg
-
-                if len(full_msg) - 4 * HEADER_SIZE == msg_params["length"]:
-                    logger.info("Received message from {}".format(address))
-                    if not msg_params:
-                        continue
-                    msg = full_msg[4 * HEADER_SIZE:]
-
-                    # logger.info("Metadata: {}".format(msg_params))
+                    held += taken
+                    nbytes = self._recv(sock, buffer[:taken], idle=idle,
+                                        deadline=self._read_deadline(decoder, last_read, header_started))
+                    if not nbytes:
+                        logger.info("Closing idle client %s.", address)
+                        break
+                    received_at = time.perf_counter()
+                    last_read = time.monotonic()
+                    if idle:
+                        started = received_at
+                        header_started = last_read
+                    decoder.feed(buffer[:nbytes])
 
-                    if msg_params["type"] == "file":
-                        full_msg = self.receive_file(
-                            msg, msg_params, self.output_option)
-                        send_msg = b"Received File successfully"
-                    elif msg_params["type"] == "object":
+                    # A single read may complete several messages
+                    for msg_params, msg in decoder:
+                        logger.debug("Received message from %s", address)
+                        processing = time.perf_counter()
                         try:
-                            full_msg = self.receive_object(
-                                msg, msg_params, self.output_option)
-                            send_msg = b"Received Object successfully"
-                        except ValueError:
+                            send_msg = self.process_message(msg, msg_params)
+                        except Exception as err:
+                            # The message was read completely, so the connection stays usable
+                            logger.warning(
+                                "Failed to process message from %s: %s", address, err)
+                            sock.sendall(create_response(
+                                msg_params, "Failed to process message: {}".format(err).encode(), True))
+                            self._record_message(msg_params, started, error=True)
+                            started = received_at
                             continue
+                        processed = time.perf_counter()
+                        # Sends reply back to client
+                        sock.sendall(create_response(msg_params, send_msg))
+                        self._record_message(
+                            msg_params, started, processed - processing)
+                        # The next message in the buffer started with this read
+                        started = received_at
+                        header_started = last_read
 
-                    # Sends reply back to client
-                    sock.sendall(
-                        bytes(f"{len(send_msg):<{HEADER_SIZE}}",
-                              "utf-8") + send_msg
-                    )
-                    full_msg = b""
-                    new_msg = True
-            if close_connection:
-                break
+                    msg_params = decoder.header
+                    if msg_params and msg_params["type"] in self.STREAMED_TYPES:
+                        # Files and deltas are handled as they arrive instead of being held in memory
+                        send_msg, error = self._receive_stream(
+                            sock, msg_params, decoder.take_payload(), buffer)
+                        logger.debug("Received message from %s", address)
+                        if error:
+                            logger.warning(
+                                "Failed to process message from %s: %s", address, send_msg)
+                        sock.sendall(create_response(msg_params, send_msg, error))
+                        self._record_message(msg_params, started, error=error)
+                        last_read = time.monotonic()
+                finally:
+                    # Bytes that were not received or were consumed go back to the budget
+                    self.budget.release(held - decoder.buffered)
+                    held = decoder.buffered
+        except ProtocolError as err:
+            # The stream cannot continue, the client is told why before it is closed
+            logger.warning("Closing client %s: %s", address, err)
+            if self.metrics is not None:
+                self.metrics.limit_violation()
+            metadata = err.metadata or decoder.header
+            if metadata is not None:
+                try:
+                    sock.sendall(create_response(metadata, str(err).encode(), True))
+                except OSError:
+                    pass
+        except ValueError as val:
+            # The stream cannot be resynchronised after a bad header
+            logger.info(val)
+        except ConnectionError:
+            logger.info("Client %s disconnected.", address)
+        finally:
+            self.budget.release(held)
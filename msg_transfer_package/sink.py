@@ -0,0 +1,218 @@
+"""
+Output sinks for received objects
+"""
+
+import base64
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from array import array
+from collections.abc import Sequence
+from .columnar import RecordBatch
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("none", "interval", "batch")
+# Marks the end of the queue for the writer thread
+_STOP = object()
+
+
+def _json_default(obj):
+    """
+    Converts values json cannot serialize, such as the results of the binary and columnar methods
+    """
+
+    if isinstance(obj, RecordBatch):
+        return obj.to_rows()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode()
+    if isinstance(obj, (Sequence, array, set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+def encode_record(obj) -> bytes:
+    """
+    Encodes a received object as one line of json
+    """
+
+    return json.dumps(obj, default=_json_default).encode() + b"\n"
+
+
+class WriteBehindSink:
+    """
+    Appends records to a file from a background thread, so disk latency does not stall
+    the threads receiving from the network.
+    Records wait in a bounded queue, when it is full write blocks until the writer catches up.
+    Queued records are written together, up to batch_bytes per write
+    """
+
+    def __init__(self, path: str, queue_size=1024, batch_bytes=1048576, fsync="none",
+                 fsync_interval=1.0, rotate_bytes=0, rotate_seconds=0):
+        """
+        path: file the records are appended to
+        queue_size: records waiting to be written before write blocks
+        batch_bytes: bytes gathered from the queue into one write
+        fsync: when written data is flushed to the disk, allowed values: (none, interval, batch)
+        none leaves it to the OS, interval syncs at most every fsync_interval seconds,
+        batch syncs after every write
+        rotate_bytes: the file is rotated before it grows past this size, 0 disables
+        rotate_seconds: the file is rotated once it has been open this long, 0 disables
+        """
+
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy {}, allowed values are: {}".format(
+                fsync, ", ".join(FSYNC_POLICIES)))
+        self.path = path
+        self.batch_bytes = batch_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._closed = False
+        self._dirty = False
+        self._last_sync = time.monotonic()
+        self._open()
+        self._thread = threading.Thread(
+            target=self._run, name="sink-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, record: bytes):
+        """
+        Queues a record to be written.
+        Raises OSError if the writer thread failed
+        """
+
+        if self._error is not None:
+            raise OSError("Output sink failed: {}".format(self._error))
+        if self._closed:
+            raise ValueError("Output sink is closed")
+        self._queue.put(record)
+
+    def flush(self):
+        """
+        Waits until every queued record has been written
+        """
+
+        self._queue.join()
+
+    def close(self):
+        """
+        Writes the queued records, syncs them to disk unless fsync is none and stops the writer
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _open(self):
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+        self._opened_at = time.monotonic()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def _rotate(self):
+        """
+        Closes the current file, moves it aside with a timestamp suffix and starts a new one
+        """
+
+        if self.fsync != "none":
+            self._sync()
+        self._file.close()
+        rotated = "{}.{}".format(self.path, time.strftime("%Y%m%d-%H%M%S"))
+        suffix = 1
+        while os.path.exists(rotated):
+            rotated = "{}.{}.{}".format(
+                self.path, time.strftime("%Y%m%d-%H%M%S"), suffix)
+            suffix += 1
+        os.replace(self.path, rotated)
+        logger.info("Rotated output file to %s", rotated)
+        self._open()
+
+    def _should_rotate(self, length: int) -> bool:
+        if not self._size:
+            return False
+        if self.rotate_bytes and self._size + length > self.rotate_bytes:
+            return True
+        return bool(self.rotate_seconds) and time.monotonic() - self._opened_at >= self.rotate_seconds
+
+    def _write(self, data: bytes):
+        if self._should_rotate(len(data)):
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self._dirty = True
+        if self.fsync == "batch" or (
+                self.fsync == "interval" and time.monotonic() - self._last_sync >= self.fsync_interval):
+            self._sync()
+
+    def _next_batch(self):
+        """
+        Waits for records and returns the ones queued so far, up to batch_bytes,
+        and whether close was called. Returns None when a pending interval sync is due
+        """
+
+        timeout = None
+        if self._dirty and self.fsync == "interval" and self._error is None:
+            timeout = max(0.0, self._last_sync +
+                          self.fsync_interval - time.monotonic())
+        try:
+            record = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        batch = []
+        size = 0
+        while record is not _STOP:
+            batch.append(record)
+            size += len(record)
+            if size >= self.batch_bytes:
+                break
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return batch, record is _STOP
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = self._next_batch()
+            records, stop = batch or ([], False)
+            try:
+                if batch is None:
+                    self._sync()
+                elif records and self._error is None:
+                    self._write(b"".join(records))
+            except OSError as err:
+                # Later writes are refused, the records already queued are dropped
+                logger.error("Failed to write output file %s: %s",
+                             self.path, err)
+                self._error = err
+            finally:
+                for _ in range(len(records) + stop):
+                    self._queue.task_done()
+
+        try:
+            if self._error is None and self.fsync != "none" and self._dirty:
+                self._sync()
+        finally:
+            self._file.close()
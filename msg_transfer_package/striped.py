@@ -0,0 +1,199 @@
+"""
+Striped file transfers: a large file is split into chunks that are sent over several parallel
+connections, so one TCP stream's window does not limit the transfer on links with a large
+bandwidth-delay product. The server writes the chunks of every connection into the same partial
+file, see chunks.py, and only the chunk that completes the file gets the completion reply
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+from .chunks import CHUNK_SIZE, file_transfer_id
+from .client import Client
+
+logger = logging.getLogger(__name__)
+
+MAX_STREAMS = 16
+# Seconds of throughput measured before deciding whether to open another stream
+PROBE_SECONDS = 0.5
+# Relative throughput gain a new stream must bring for the tuner to try one more
+MIN_GAIN = 0.1
+
+
+class StreamTuner:
+    """
+    Chooses the number of parallel streams from the observed throughput.
+    A stream is added after every probe as long as the previous one raised the throughput
+    by at least min_gain, the first probe that does not stops the tuning
+    """
+
+    def __init__(self, max_streams=MAX_STREAMS, min_gain=MIN_GAIN):
+        self.max_streams = max_streams
+        self.min_gain = min_gain
+        self.best = 0.0
+        self.done = False
+
+    def observe(self, throughput: float, streams: int) -> bool:
+        """
+        Records the throughput measured with streams connections, returns whether to add one
+        """
+
+        if self.done:
+            return False
+        if throughput < self.best * (1 + self.min_gain):
+            self.done = True
+            logger.info("Throughput %.1f MB/s with %d streams, keeping them",
+                        throughput / 1e6, streams)
+            return False
+        self.best = throughput
+        if streams >= self.max_streams:
+            self.done = True
+            return False
+        return True
+
+
+class _Stripes:
+    """
+    Chunks left to send and the progress shared by the stream threads
+    """
+
+    def __init__(self, missing: list, chunk_size: int):
+        self.chunks = collections.deque()
+        for offset, length in missing:
+            for start in range(offset, offset + length, chunk_size):
+                self.chunks.append(
+                    (start, min(chunk_size, offset + length - start)))
+        self.lock = threading.Lock()
+        self.acked_bytes = 0
+        self.completed = None
+
+    def next_chunk(self):
+        with self.lock:
+            return self.chunks.popleft() if self.chunks else None
+
+    def collect(self, acks: list, lengths: dict):
+        """
+        Counts the chunks the server has acknowledged on one connection
+        """
+
+        with self.lock:
+            for ack in acks:
+                length = lengths.pop(ack.request_id)
+                if not ack.ok:
+                    # Sent again over one connection once the stripes are done
+                    continue
+                self.acked_bytes += length
+                if ack.message == b"Received File successfully":
+                    self.completed = ack.message
+
+
+def _send_stripes(client: Client, stripes: _Stripes, input_file_path: str, transfer_id: bytes,
+                  filesize: int, encrypt: bool):
+    """
+    Sends chunks over one connection until none are left
+    """
+
+    filename = os.path.basename(input_file_path)
+    # request id -> length of the chunk
+    lengths = {}
+    try:
+        with client, open(input_file_path, "rb") as file:
+            while True:
+                chunk = stripes.next_chunk()
+                if chunk is None:
+                    break
+                offset, length = chunk
+                request_id = client.send_chunk(file, filename, transfer_id, filesize,
+                                               offset, length, encrypt)
+                lengths[request_id] = length
+                stripes.collect(client.received_acks(), lengths)
+            stripes.collect(client.flush(), lengths)
+    except OSError as err:
+        # The chunks it did not deliver are sent again after the other streams finish
+        logger.warning("Stream to %s:%s failed: %s",
+                       client.host, client.host_port, err)
+
+
+def transfer_file_striped(host: str, host_port: int, input_file_path: str, streams: int = None,
+                          encrypt=True, chunk_size=CHUNK_SIZE, window=4, max_streams=MAX_STREAMS,
+                          probe_seconds=PROBE_SECONDS) -> bytes:
+    """
+    Transfers a file in chunks over several parallel connections and returns the completion reply.
+    Chunks that were not acknowledged, because a connection failed or the server rejected them,
+    are sent again over one connection at the end
+    streams: number of connections, None to add connections while they raise the throughput
+    window: chunks each connection keeps in flight
+    max_streams: upper limit of the tuned number of connections
+    probe_seconds: throughput measurement interval of the tuning
+    """
+
+    transfer_id = file_transfer_id(input_file_path)
+    filesize = os.path.getsize(input_file_path)
+    filename = os.path.basename(input_file_path)
+
+    def connect() -> Client:
+        client = Client(host, host_port, protocol_version=2, window=window)
+        try:
+            client.connection()
+        except OSError:
+            client.close()
+            raise
+        return client
+
+    first = connect()
+    try:
+        missing = first.query_missing(
+            filename, transfer_id, filesize, encrypt)
+    except Exception:
+        first.close()
+        raise
+    if not missing:
+        first.close()
+        return b"Received File successfully"
+    stripes = _Stripes(missing, chunk_size)
+    logger.info("Sending %d missing bytes of %s to server ...",
+                sum(length for _, length in missing), filename)
+
+    threads = []
+
+    def start(client: Client):
+        thread = threading.Thread(target=_send_stripes, name="stripe-{}".format(len(threads)),
+                                  args=(client, stripes, input_file_path, transfer_id,
+                                        filesize, encrypt))
+        thread.start()
+        threads.append(thread)
+
+    start(first)
+    tuner = StreamTuner(max_streams)
+    try:
+        if streams is not None:
+            for _ in range(streams - 1):
+                start(connect())
+        else:
+            previous, previous_time = 0, time.monotonic()
+            while stripes.chunks:
+                threads[0].join(probe_seconds)
+                if not threads[0].is_alive():
+                    break
+                with stripes.lock:
+                    acked = stripes.acked_bytes
+                now = time.monotonic()
+                throughput = (acked - previous) / (now - previous_time)
+                if not tuner.observe(throughput, len(threads)) or not stripes.chunks:
+                    break
+                start(connect())
+                previous, previous_time = acked, now
+    except OSError as err:
+        logger.warning("Could not open another stream: %s", err)
+    finally:
+        for thread in threads:
+            thread.join()
+    logger.info("%s sent over %d streams", filename, len(threads))
+
+    if stripes.completed:
+        logger.info("%s transfer complete", filename)
+        return stripes.completed
+    with connect() as client:
+        return client.transfer_file_resumable(input_file_path, encrypt, chunk_size)
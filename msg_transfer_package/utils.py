@@ -1,26 +1,89 @@
 """
-Helper functions which provide support to the core functionality
+Helper functions which provide support to the core functionality.
+The codecs and the cipher are imported on first use, a short lived client that sends
+a file unencrypted never loads them
 """
 
+import functools
 import hashlib
 import logging
-import pickle
-import json
-from Crypto.Cipher import AES
-import xmltodict
+import struct
+from .compression import COMPRESSION_METHODS, COMPRESSION_NAMES
 
+logger = logging.getLogger(__name__)
 
-# The secret key is sha256 hashed and converted to bytes
-KEY = hashlib.sha256(
-    "my-secret-key-78944b2001d847aea48e246688e9bf88".encode()).digest()
+SECRET = "my-secret-key-78944b2001d847aea48e246688e9bf88"
 IV = "8e357d48b52f448f"  # IV for encrypting the message
 
+# Protocol v2 binary header: magic, version, type, flags, codec, name length, payload length.
+# A trailer follows it: the variable length name, then the optional fields enabled by flags.
+# The first magic byte is not printable ASCII, which tells v2 frames apart from the text headers of v1
+V2_MAGIC = b"\xb2M"
+V2_HEADER = struct.Struct("!2sBBBBHQ")
+FRAME_TYPES = {"object": 1, "file": 2, "reply": 3,
+               "batch": 4, "chunk": 5, "resume": 6, "probe": 7, "signature": 8, "delta": 9,
+               "manifest": 10}
+FRAME_TYPE_NAMES = {type_id: name for name, type_id in FRAME_TYPES.items()}
+CODECS = {"json": 1, "xml": 2, "binary": 3, "compact": 4, "columnar": 5}
+CODEC_NAMES = {codec: name for name, codec in CODECS.items()}
+FLAG_ENCRYPT = 0x01
+# The trailer ends with a request id, echoed back in the reply
+FLAG_REQUEST_ID = 0x02
+# The reply reports that the request failed
+FLAG_ERROR = 0x04
+# The trailer ends with the id of the method the payload was compressed with
+FLAG_COMPRESSED = 0x08
+# The server should add the payload to its content store, see dedup.py
+FLAG_STORE = 0x10
+REQUEST_ID = struct.Struct("!I")
+COMPRESSION_ID = struct.Struct("!B")
+# Length prefix of every object serialized into a batch frame
+BATCH_ITEM = struct.Struct("!I")
+# Largest possible v1 or v2 header, trailer included
+MAX_HEADER_SIZE = V2_HEADER.size + 0xFFFF + REQUEST_ID.size + COMPRESSION_ID.size
+
+
+class ProtocolError(ValueError):
+    """
+    A frame broke the protocol or a server limit. The connection cannot continue after it,
+    the error is reported to the client when the header of the frame is known
+    """
+
+    def __init__(self, message: str, metadata: dict = None):
+        super().__init__(message)
+        self.metadata = metadata
+
+
+@functools.lru_cache(maxsize=None)
+def secret_key() -> bytes:
+    """
+    The secret is sha256 hashed and converted to bytes
+    """
+    return hashlib.sha256(SECRET.encode()).digest()
+
+
+def __getattr__(name: str):
+    # KEY is hashed when first read
+    if name == "KEY":
+        return secret_key()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def new_cipher():
+    """
+    Creates an AES CFB cipher for encrypting or decrypting one message.
+    The cipher keeps its state between calls, so a message can be processed chunk by chunk
+    """
+    from Crypto.Cipher import AES
+
+    return AES.new(secret_key(), AES.MODE_CFB, IV.encode())
+
 
 def encrypt_message(message: bytes):
     """
     Encrypts message using AES CFB mode and returns the encrypted bytes
     """
-    obj = AES.new(KEY, AES.MODE_CFB, IV.encode())
+    obj = new_cipher()
     ciphertext = obj.encrypt(message)
     return ciphertext
 
@@ -28,7 +91,7 @@ def encrypt_message(message: bytes):
 def decrypt_message(ciphertext: bytes) -> bytes:
     # Decrypts the message using the same private key and IV
 
-    obj2 = AES.new(KEY, AES.MODE_CFB, IV.encode())
+    obj2 = new_cipher()
     message = obj2.decrypt(ciphertext)
     return message
 
@@ -37,28 +100,71 @@ def serialize_object(obj: any, serialization_method: str) -> bytes:
     """
     Serializes the python object
 
-    serialization_method is enum: binary, json or xml
+    serialization_method is enum: binary, json, xml, compact or columnar (lists of records only)
     """
 
     if serialization_method.lower() == "json":
         # Text serialization
-        logging.info("Converting object to json format")
+        import json
+
+        logger.debug("Converting object to json format")
         data = str.encode(json.dumps(obj))
     elif serialization_method.lower() == "xml":
         # Text serialization
-        logging.info("Converting object to xml format")
+        import xmltodict
+
+        logger.debug("Converting object to xml format")
         data = str.encode(xmltodict.unparse({"msg": obj}))
     elif serialization_method.lower() == "binary":
         # Binary serialization
-        logging.info("Converting object to binary format")
+        import pickle
+
+        logger.debug("Converting object to binary format")
         data = pickle.dumps(obj, -1)
+    elif serialization_method.lower() == "compact":
+        # Binary serialization that is safe to decode
+        from . import codec
+
+        logger.debug("Converting object to compact format")
+        data = codec.dumps(obj)
+    elif serialization_method.lower() == "columnar":
+        # Column oriented serialization of a list of records
+        from . import columnar
+
+        logger.debug("Converting records to columnar format")
+        data = columnar.encode_records(obj)
     else:
-        logging.error(
-            "Incorrect method. Please provide one of json or binary.")
+        logger.error(
+            "Incorrect method. Please provide one of json, xml, binary, compact or columnar.")
         data = None
     return data
 
 
+def pack_batch(items: list) -> bytes:
+    """
+    Joins serialized objects into the payload of a batch frame
+    """
+
+    return b"".join(BATCH_ITEM.pack(len(item)) + item for item in items)
+
+
+def unpack_batch(payload: bytes) -> list:
+    """
+    Splits the payload of a batch frame into the serialized objects
+    """
+
+    items = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = BATCH_ITEM.unpack_from(payload, offset)
+        offset += BATCH_ITEM.size
+        if offset + length > len(payload):
+            raise ValueError("Truncated batch")
+        items.append(payload[offset:offset + length])
+        offset += length
+    return items
+
+
 def create_headers(block_size: int, *args):
     """
     Creates metadata headers for differenting between file and object transfers
@@ -68,6 +174,44 @@ def create_headers(block_size: int, *args):
     return headers
 
 
+def create_headers_v2(data_type: str, encrypt: bool, param: str, length: int, flags=0,
+                      request_id: int = None, compression: str = None) -> bytes:
+    """
+    Creates a protocol v2 binary header.
+    param is the serialization method of an object or the name of a file
+    compression: method the payload was compressed with, if any
+    """
+
+    if encrypt:
+        flags |= FLAG_ENCRYPT
+    if data_type in ("object", "batch"):
+        codec, trailer = CODECS[param.lower()], b""
+    else:
+        codec, trailer = 0, param.encode()
+    name_length = len(trailer)
+    if request_id is not None:
+        flags |= FLAG_REQUEST_ID
+        trailer += REQUEST_ID.pack(request_id)
+    if compression is not None:
+        flags |= FLAG_COMPRESSED
+        trailer += COMPRESSION_ID.pack(COMPRESSION_METHODS[compression])
+    return V2_HEADER.pack(V2_MAGIC, 2, FRAME_TYPES[data_type], flags, codec, name_length,
+                          length) + trailer
+
+
+def create_reply(message: bytes, header_size: int, version=1, request_id: int = None,
+                 error=False) -> bytes:
+    """
+    Creates the reply sent back to the client in the protocol version of its request.
+    v1 replies cannot flag errors, the message has to describe them
+    """
+
+    if version == 2:
+        return create_headers_v2("reply", False, "", len(message), FLAG_ERROR if error else 0,
+                                 request_id) + message
+    return bytes(f"{len(message):<{header_size}}", "utf-8") + message
+
+
 def get_params(msg: bytes, header_size: int) -> dict:
     """
     Parses the metadata part from headers
@@ -83,6 +227,8 @@ def get_params(msg: bytes, header_size: int) -> dict:
         "encrypt": bool(int(encrypt)),
         "length": int(length),
     }
+    if metadata["length"] < 0:
+        raise ValueError("Invalid message length {}".format(metadata["length"]))
 
     if metadata["type"] == "object":
         metadata["serialize"] = param3.strip().decode()
@@ -90,3 +236,177 @@ def get_params(msg: bytes, header_size: int) -> dict:
         metadata["filename"] = param3.strip().decode()
 
     return metadata
+
+
+def get_params_v2(header: bytes) -> dict:
+    """
+    Parses the fixed size part of a protocol v2 header,
+    the trailer of "trailer_length" bytes that follows it is added with set_header_trailer
+    """
+
+    magic, version, type_id, flags, codec, name_length, length = V2_HEADER.unpack(
+        header)
+    if magic != V2_MAGIC or version != 2:
+        raise ValueError("Invalid protocol v2 header")
+    if type_id not in FRAME_TYPE_NAMES:
+        raise ValueError("Unknown frame type {}".format(type_id))
+
+    metadata = {
+        "version": 2,
+        "type": FRAME_TYPE_NAMES[type_id],
+        "encrypt": bool(flags & FLAG_ENCRYPT),
+        "flags": flags,
+        "name_length": name_length,
+        "trailer_length": name_length + (REQUEST_ID.size if flags & FLAG_REQUEST_ID else 0) +
+        (COMPRESSION_ID.size if flags & FLAG_COMPRESSED else 0),
+        "length": length,
+    }
+    if metadata["type"] in ("object", "batch"):
+        if codec not in CODEC_NAMES:
+            raise ValueError("Unknown codec {}".format(codec))
+        metadata["serialize"] = CODEC_NAMES[codec]
+    return metadata
+
+
+def set_header_trailer(metadata: dict, trailer: bytes):
+    """
+    Adds the name and optional fields of a protocol v2 header to its metadata
+    """
+
+    offset = metadata["name_length"]
+    if metadata["type"] in ("file", "chunk", "resume", "probe", "signature", "delta"):
+        metadata["filename"] = trailer[:offset].decode()
+    if metadata["flags"] & FLAG_REQUEST_ID:
+        metadata["request_id"] = REQUEST_ID.unpack_from(trailer, offset)[0]
+        offset += REQUEST_ID.size
+    metadata["compression"] = None
+    if metadata["flags"] & FLAG_COMPRESSED:
+        method_id = COMPRESSION_ID.unpack_from(trailer, offset)[0]
+        if method_id not in COMPRESSION_NAMES:
+            raise ValueError("Unknown compression method {}".format(method_id))
+        metadata["compression"] = COMPRESSION_NAMES[method_id]
+    metadata["error"] = bool(metadata["flags"] & FLAG_ERROR)
+
+
+class FrameDecoder:
+    """
+    Incremental decoder turning a stream of received bytes into complete frames.
+    Headers and payloads may be split across any number of reads and a read may
+    hold several frames, everything is collected in one growable buffer
+    """
+
+    def __init__(self, header_size: int, max_frame_size=0, streamed_types=()):
+        """
+        max_frame_size: largest payload accepted, larger frames raise ProtocolError, 0 for no limit
+        streamed_types: frame types exempt from max_frame_size because the caller streams their
+        payload with take_payload instead of buffering it
+        """
+
+        self.header_size = header_size
+        self.max_frame_size = max_frame_size
+        self.streamed_types = streamed_types
+        # metadata of the frame being received, None while waiting for a header
+        self.header = None
+        self._buffer = bytearray()
+        # offset of the first byte not consumed yet
+        self._start = 0
+
+    def feed(self, data):
+        """
+        Adds received bytes or a memoryview of them to the buffer
+        """
+
+        self._buffer += data
+
+    @property
+    def idle(self) -> bool:
+        """
+        True when no part of a frame is buffered
+        """
+
+        return self.header is None and self._start == len(self._buffer)
+
+    @property
+    def buffered(self) -> int:
+        """
+        Number of received bytes not consumed yet
+        """
+
+        return len(self._buffer) - self._start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Returns the next complete frame as (metadata, payload)
+        """
+
+        if self.header is None:
+            self.header = self._parse_header()
+            if self.header is None:
+                self._compact()
+                raise StopIteration
+            self._check_length(self.header)
+
+        end = self._start + self.header["length"]
+        if len(self._buffer) < end:
+            self._compact()
+            raise StopIteration
+        frame = self.header, self._buffer[self._start:end]
+        self.header = None
+        self._start = end
+        return frame
+
+    def _check_length(self, metadata: dict):
+        if not self.max_frame_size or metadata["length"] <= self.max_frame_size:
+            return
+        if metadata["type"] in self.streamed_types:
+            return
+        raise ProtocolError("Frame of {} bytes exceeds the limit of {} bytes".format(
+            metadata["length"], self.max_frame_size), metadata)
+
+    def _parse_header(self):
+        """
+        Parses and consumes a complete v1 or v2 header, returns None if more bytes are needed
+        """
+
+        buffer, start = self._buffer, self._start
+        if len(buffer) > start and buffer[start] == V2_MAGIC[0]:
+            end = start + V2_HEADER.size
+            if len(buffer) < end:
+                return None
+            metadata = get_params_v2(bytes(buffer[start:end]))
+            trailer_end = end + metadata["trailer_length"]
+            if len(buffer) < trailer_end:
+                return None
+            set_header_trailer(metadata, bytes(buffer[end:trailer_end]))
+            end = trailer_end
+        else:
+            end = start + 4 * self.header_size
+            if len(buffer) < end:
+                return None
+            metadata = get_params(bytes(buffer[start:end]), self.header_size)
+        self._start = end
+        return metadata
+
+    def take_payload(self) -> bytearray:
+        """
+        Removes and returns the buffered start of the current frame's payload,
+        so the caller can stream the rest of it itself
+        """
+
+        payload = self._buffer[self._start:]
+        self.header = None
+        self._buffer.clear()
+        self._start = 0
+        return payload
+
+    def _compact(self):
+        """
+        Drops consumed bytes once they make up most of the buffer
+        """
+
+        if self._start and self._start * 2 >= len(self._buffer):
+            del self._buffer[:self._start]
+            self._start = 0
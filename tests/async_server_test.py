@@ -0,0 +1,145 @@
+from msg_transfer_package.async_server import AsyncServer
+from msg_transfer_package.delta import DeltaStore
+from msg_transfer_package.limits import Limits
+from msg_transfer_package.utils import (MAX_HEADER_SIZE, create_headers, create_headers_v2,
+                                        serialize_object)
+import asyncio
+import logging
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+
+logging.disable(logging.CRITICAL)
+
+
+class TestAsyncServer(unittest.TestCase):
+    @mock.patch("msg_transfer_package.server.Server.receive_object")
+    def test_handle_connection(self, receive_object):
+        """
+        Tests that back to back objects are parsed and acknowledged in order
+        """
+
+        async def exchange():
+            server = await AsyncServer("127.0.0.1", 0, "print").start()
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                payload = serialize_object([1, 2, 3], "json")
+                frame = bytes(create_headers(
+                    16, "object", False, "json", len(payload)), "utf-8") + payload
+                writer.write(frame * 2)
+                replies = []
+                for _ in range(2):
+                    length = int(await reader.readexactly(16))
+                    replies.append(await reader.readexactly(length))
+                writer.close()
+                await writer.wait_closed()
+            return payload, replies
+
+        payload, replies = asyncio.run(exchange())
+        self.assertEqual([b"Received Object successfully"] * 2, replies)
+        self.assertEqual(receive_object.call_count, 2)
+        self.assertEqual(payload, receive_object.call_args[0][0])
+        self.assertEqual("json", receive_object.call_args[0][1]["serialize"])
+
+    @mock.patch("msg_transfer_package.server.Server.receive_object")
+    def test_limits(self, receive_object):
+        """
+        Tests that extra connections are refused and oversized frames answered with an error
+        """
+
+        async def exchange():
+            server = await AsyncServer("127.0.0.1", 0, "print", limits=Limits(
+                max_frame_size=100, connection_budget=100 + MAX_HEADER_SIZE,
+                global_budget=100 + MAX_HEADER_SIZE, max_connections=1)).start()
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                payload = serialize_object([1], "json")
+                writer.write(bytes(create_headers(
+                    16, "object", False, "json", len(payload)), "utf-8") + payload)
+                length = int(await reader.readexactly(16))
+                replies = [await reader.readexactly(length)]
+
+                extra_reader, extra_writer = await asyncio.open_connection("127.0.0.1", port)
+                refused = await extra_reader.read()
+                extra_writer.close()
+
+                writer.write(bytes(create_headers(
+                    16, "object", False, "json", 101), "utf-8"))
+                length = int(await reader.readexactly(16))
+                replies.append(await reader.readexactly(length))
+                closed = await reader.read()
+                writer.close()
+            return replies, refused, closed
+
+        replies, refused, closed = asyncio.run(exchange())
+        self.assertEqual(b"Received Object successfully", replies[0])
+        self.assertIn(b"exceeds the limit", replies[1])
+        self.assertEqual(b"", refused)
+        self.assertEqual(b"", closed)
+
+    def test_file_print(self):
+        """
+        Tests that a file over the frame limit is streamed in print mode
+        """
+
+        async def exchange():
+            server = await AsyncServer("127.0.0.1", 0, "print",
+                                       limits=Limits(max_frame_size=100)).start()
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(bytes(create_headers(16, "file", False, "name", 1000), "utf-8"))
+                writer.write(bytes(1000))
+                length = int(await reader.readexactly(16))
+                reply = await reader.readexactly(length)
+                writer.close()
+                await writer.wait_closed()
+            return reply
+
+        self.assertEqual(b"Received File successfully", asyncio.run(exchange()))
+
+    def test_delta_off_loop(self):
+        """
+        Tests that other connections are answered while a delta is being applied
+        """
+
+        applying = threading.Event()
+        answered = threading.Event()
+        waited = []
+
+        def slow_apply(*args):
+            applying.set()
+            waited.append(answered.wait(5))
+
+        async def exchange(tmp_dir):
+            server = AsyncServer("127.0.0.1", 0, "print")
+            server.deltas = DeltaStore(tmp_dir)
+            listener = await server.start()
+            port = listener.sockets[0].getsockname()[1]
+            async with listener:
+                delta_reader, delta_writer = await asyncio.open_connection("127.0.0.1", port)
+                delta_writer.write(create_headers_v2("delta", False, "name", 100) + bytes(100))
+                await asyncio.get_running_loop().run_in_executor(None, applying.wait, 5)
+
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                payload = serialize_object([1], "json")
+                writer.write(bytes(create_headers(
+                    16, "object", False, "json", len(payload)), "utf-8") + payload)
+                length = int(await reader.readexactly(16))
+                reply = await reader.readexactly(length)
+                answered.set()
+                await delta_reader.readexactly(1)
+                for stream in (writer, delta_writer):
+                    stream.close()
+                    await stream.wait_closed()
+            return reply
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch("msg_transfer_package.delta.apply_delta", side_effect=slow_apply):
+            reply = asyncio.run(exchange(tmp_dir))
+        self.assertEqual(b"Received Object successfully", reply)
+        self.assertEqual([True], waited)
@@ -0,0 +1,157 @@
+import io
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from msg_transfer_package.bulk import FileResult, expand_inputs, read_file_list, transfer_files
+from msg_transfer_package.client import Client, run_with_config
+from msg_transfer_package.manifest import (
+    pack_manifest,
+    receive_manifest,
+    received_path,
+    unpack_manifest,
+)
+from msg_transfer_package.server import Server
+from tests.helpers import ServerTestCase
+
+logging.disable(logging.CRITICAL)
+
+TREE = {"tree/a.txt": b"a" * 10, "tree/sub/b.txt": b"b" * 100000,
+        "tree/sub/deeper/c.bin": os.urandom(5000), "tree/empty.txt": b""}
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_pack(self):
+        entries = [("a.txt", 10), ("dir/é.bin", 1 << 40)]
+        self.assertEqual(entries, unpack_manifest(pack_manifest(entries)))
+        with self.assertRaises(ValueError):
+            unpack_manifest(pack_manifest(entries)[:-1])
+
+    def test_received_path(self):
+        """
+        Tests that relative paths are kept below the directory
+        """
+
+        self.assertEqual(os.path.join(self.directory, "received_dir", "sub", "a.txt"),
+                         received_path("dir/sub/a.txt", self.directory))
+        self.assertEqual("received_a.txt", received_path("a.txt"))
+        for name in ("", "../a.txt", "dir/../../a.txt", "/etc/passwd", "dir//a.txt",
+                     "dir/./a.txt", "dir/", "dir\\a.txt", "a\0.txt"):
+            with self.assertRaises(ValueError, msg=name):
+                received_path(name, self.directory)
+
+        outside = tempfile.TemporaryDirectory()
+        self.addCleanup(outside.cleanup)
+        os.symlink(outside.name, os.path.join(self.directory, "received_link"))
+        with self.assertRaises(ValueError):
+            received_path("link/a.txt", self.directory)
+
+    def test_receive_manifest(self):
+        """
+        Tests that the directories of a manifest are created only if all its paths are valid
+        """
+
+        metadata = {"encrypt": False}
+        with self.assertRaises(ValueError):
+            receive_manifest(pack_manifest([("dir/a.txt", 1), ("../b.txt", 1)]),
+                             metadata, self.directory)
+        self.assertEqual([], os.listdir(self.directory))
+
+        reply = receive_manifest(pack_manifest([("dir/sub/a.txt", 1), ("b.txt", 2)]),
+                                 metadata, self.directory)
+        self.assertEqual(b"Accepted manifest of 2 files, 3 bytes", reply)
+        self.assertTrue(os.path.isdir(os.path.join(self.directory, "received_dir", "sub")))
+
+
+class TestBulk(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, data in TREE.items():
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, "wb") as file:
+                file.write(data)
+        self.server = Server("", 7000, "file")
+
+    def test_expand_inputs(self):
+        """
+        Tests that directories and globs are expanded to files named by relative paths
+        """
+
+        self.assertEqual(sorted(TREE), sorted(name for _, name in expand_inputs(["tree"])))
+        self.assertEqual(["a.txt", "empty.txt"],
+                         [name for _, name in expand_inputs(["tree/*.txt"])])
+        self.assertEqual(["b.txt", "c.bin"],
+                         sorted(name for _, name in expand_inputs(["tree/sub/**/*.*"])))
+        self.assertEqual([("tree/a.txt", "a.txt")], expand_inputs(["tree/a.txt"]))
+        with self.assertRaises(ValueError):
+            expand_inputs(["tree/a.txt", "tree/sub/../a.txt"])
+        with self.assertRaises(FileNotFoundError):
+            expand_inputs(["missing"])
+        with self.assertRaises(FileNotFoundError):
+            expand_inputs(["tree/*.missing"])
+
+    def test_read_file_list(self):
+        self.assertEqual(["tree", "a b.txt"], read_file_list(io.StringIO("tree\n\na b.txt\r\n")))
+
+    def test_transfer(self):
+        """
+        Tests that a tree is recreated over two connections and every file is acknowledged
+        """
+
+        files = expand_inputs(["tree"])
+        with mock.patch("msg_transfer_package.bulk.Client", side_effect=self.connect):
+            results = transfer_files("", 7000, files, connections=2, window=2)
+        self.assertEqual(2, len(self.connections))
+        self.assertEqual([FileResult(name, True, b"Received File successfully")
+                          for _, name in files], results)
+        for name, data in TREE.items():
+            with open("received_" + name, "rb") as file:
+                self.assertEqual(data, file.read())
+
+    def test_missing_file(self):
+        """
+        Tests that a file removed after the manifest is reported without stopping the others
+        """
+
+        files = expand_inputs(["tree"])
+        original_send_file = Client.send_file
+
+        def remove_and_send(client, path, *args, **kwargs):
+            if path.endswith("a.txt"):
+                os.remove(path)
+            return original_send_file(client, path, *args, **kwargs)
+
+        with mock.patch("msg_transfer_package.bulk.Client", side_effect=self.connect), \
+                mock.patch.object(Client, "send_file", autospec=True,
+                                  side_effect=remove_and_send):
+            results = transfer_files("", 7000, files, connections=1)
+        failed = [result.name for result in results if not result.ok]
+        self.assertEqual(["tree/a.txt"], failed)
+        self.assertTrue(os.path.exists("received_tree/sub/b.txt"))
+
+    def test_run_with_config(self):
+        """
+        Tests that files listed on stdin are sent in bulk
+        """
+
+        with open("client.cfg", "w") as config:
+            config.write("[SERVER_OPTIONS]\nhost = 127.0.0.1\nhost_port = 7000\n"
+                         "protocol_version = 2\nconnections = 3\n")
+        with mock.patch("msg_transfer_package.bulk.transfer_files", return_value=[]) as transfer, \
+                mock.patch("sys.stdin", io.StringIO("tree/sub\ntree/a.txt\n")):
+            run_with_config("client.cfg", "-", True)
+        transfer.assert_called_once_with(
+            "127.0.0.1", 7000, expand_inputs(["tree/sub", "tree/a.txt"]), True, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
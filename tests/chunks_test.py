@@ -0,0 +1,181 @@
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+
+from msg_transfer_package.chunks import (CHUNK, RESUME, ChunkStore, PartialFile,
+                                         file_transfer_id, pack_ranges, unpack_ranges)
+from msg_transfer_package.client import Client
+from msg_transfer_package.limits import Limits
+from msg_transfer_package.server import Server
+from msg_transfer_package.utils import encrypt_message
+
+logging.disable(logging.CRITICAL)
+
+TRANSFER_ID = bytes(range(16))
+
+
+class TestChunks(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_partial_file(self):
+        """
+        Tests that written ranges are merged and survive a restart through the journal
+        """
+
+        partial = PartialFile(self.dir, "name.ext", TRANSFER_ID, 100)
+        self.assertEqual([(0, 100)], partial.missing())
+        partial.write(10, b"x" * 10)
+        partial.write(40, b"y" * 10)
+        partial.write(20, b"z" * 10)
+        self.assertEqual([(0, 10), (30, 10), (50, 50)], partial.missing())
+        with self.assertRaises(ValueError):
+            partial.write(95, b"too long")
+
+        # A record cut short by a crash is ignored
+        with open(partial.journal_path, "ab") as journal:
+            journal.write(b"\x00\x01")
+        reopened = PartialFile(self.dir, "name.ext", TRANSFER_ID, 100)
+        self.assertEqual(partial.missing(), reopened.missing())
+
+        for offset, length in reopened.missing():
+            reopened.write(offset, b"a" * length)
+        self.assertTrue(reopened.complete)
+        reopened.finish()
+        self.assertEqual(["received_name.ext"], os.listdir(self.dir))
+        with open(os.path.join(self.dir, "received_name.ext"), "rb") as file:
+            self.assertEqual(b"a" * 10 + b"x" * 10 + b"z" * 10 + b"a" * 10 + b"y" * 10 + b"a" * 50,
+                             file.read())
+
+    def test_shared_journal(self):
+        """
+        Tests that processes receiving chunks of the same file see each other's chunks
+        and only one of them moves the file into place
+        """
+
+        first = PartialFile(self.dir, "name.ext", TRANSFER_ID, 8)
+        second = PartialFile(self.dir, "name.ext", TRANSFER_ID, 8)
+        first.write(0, b"1234")
+        second.write(4, b"5678")
+        self.assertTrue(second.complete)
+        self.assertFalse(first.complete)
+        with first.lock:
+            first.refresh()
+        self.assertTrue(first.complete)
+        self.assertTrue(second.finish())
+        self.assertFalse(first.finish())
+        with open(os.path.join(self.dir, "received_name.ext"), "rb") as file:
+            self.assertEqual(b"12345678", file.read())
+
+    def test_store(self):
+        """
+        Tests resume queries and chunks, encrypted and with bad checksums
+        """
+
+        store = ChunkStore(self.dir)
+        params = {"type": "resume", "encrypt": True, "filename": "../name.ext"}
+        reply = store.handle(encrypt_message(
+            RESUME.pack(TRANSFER_ID, 8)), params)
+        self.assertEqual([(0, 8)], unpack_ranges(reply))
+
+        params["type"] = "chunk"
+        chunk = CHUNK.pack(TRANSFER_ID, 8, 4, zlib.crc32(b"5678")) + b"5678"
+        self.assertEqual(b"Received chunk", store.handle(
+            encrypt_message(chunk), params))
+        bad = CHUNK.pack(TRANSFER_ID, 8, 0, zlib.crc32(b"1234")) + b"1235"
+        with self.assertRaises(ValueError):
+            store.handle(encrypt_message(bad), params)
+        good = CHUNK.pack(TRANSFER_ID, 8, 0, zlib.crc32(b"1234")) + b"1234"
+        self.assertEqual(b"Received File successfully",
+                         store.handle(encrypt_message(good), params))
+
+        # The name cannot leave the directory
+        with open(os.path.join(self.dir, "received_name.ext"), "rb") as file:
+            self.assertEqual(b"12345678", file.read())
+        self.assertEqual(["received_name.ext"], os.listdir(self.dir))
+
+    def test_store_limits(self):
+        """
+        Tests that oversized files are refused, replaced transfers removed
+        and abandoned ones expired
+        """
+
+        store = ChunkStore(self.dir, limits=Limits(max_file_size=100, partial_ttl=60))
+        params = {"type": "resume", "encrypt": False, "filename": "name.ext"}
+        with self.assertRaises(ValueError):
+            store.handle(RESUME.pack(TRANSFER_ID, 101), params)
+        self.assertEqual([], os.listdir(self.dir))
+
+        params["type"] = "chunk"
+        store.handle(CHUNK.pack(TRANSFER_ID, 8, 0, zlib.crc32(b"1234")) + b"1234", params)
+        # The same transfer announced with another size starts over
+        params["type"] = "resume"
+        reply = store.handle(RESUME.pack(TRANSFER_ID, 10), params)
+        self.assertEqual([(0, 10)], unpack_ranges(reply))
+        self.assertEqual(1, len(os.listdir(self.dir)))
+
+        params["filename"] = "other.ext"
+        other_id = bytes(16)
+        with mock.patch("msg_transfer_package.chunks.time.time", return_value=time.time() + 61):
+            store.handle(RESUME.pack(other_id, 10), params)
+        self.assertEqual([other_id], list(store._files))
+        self.assertEqual([".received_other.ext.{}.part".format(other_id.hex())],
+                         os.listdir(self.dir))
+
+    def test_ranges(self):
+        self.assertEqual([(1, 2), (3, 4)],
+                         unpack_ranges(pack_ranges([(1, 2), (3, 4)])))
+        with self.assertRaises(ValueError):
+            unpack_ranges(b"\x00")
+
+    def test_resumable_transfer(self):
+        """
+        Tests that only the ranges the server is missing are sent
+        """
+
+        input_path = os.path.join(self.dir, "input.bin")
+        data = os.urandom(10000)
+        with open(input_path, "wb") as file:
+            file.write(data)
+        output_dir = os.path.join(self.dir, "out")
+        os.mkdir(output_dir)
+
+        server = Server("", 7000, "print")
+        server.chunks = ChunkStore(output_dir)
+        # The first 4000 bytes arrived before the connection dropped
+        PartialFile(output_dir, "input.bin", file_transfer_id(input_path), 10000).write(
+            0, data[:4000])
+
+        server_sock, client_sock = socket.socketpair()
+        thread = threading.Thread(
+            target=server.receive_data, args=(server_sock, "address"))
+        thread.start()
+        with server_sock, Client("", 7000, protocol_version=2, window=2,
+                                 fileno=client_sock.detach()) as client:
+            with mock.patch.object(PartialFile, "write", autospec=True,
+                                   side_effect=PartialFile.write) as write:
+                reply = client.transfer_file_resumable(
+                    input_path, chunk_size=1024)
+            self.assertEqual(b"Received File successfully", reply)
+            self.assertEqual([], client.flush())
+            client.shutdown(socket.SHUT_WR)
+            thread.join()
+
+        self.assertEqual(list(range(4000, 10000, 1024)),
+                         [call.args[1] for call in write.call_args_list])
+        self.assertEqual(["received_input.bin"], os.listdir(output_dir))
+        with open(os.path.join(output_dir, "received_input.bin"), "rb") as file:
+            self.assertEqual(data, file.read())
+
+        with self.assertRaises(ValueError), Client("", 7000) as client:
+            client.transfer_file_resumable(input_path)
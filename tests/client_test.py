@@ -1,9 +1,14 @@
 import logging
+import socket
+import threading
 import unittest
 import os
+import tempfile
 from unittest import mock
 
-from msg_transfer_package.client import Client
+from msg_transfer_package.client import Ack, Client
+from msg_transfer_package.server import Server
+from msg_transfer_package.utils import create_headers_v2, encrypt_message
 
 logging.disable(logging.CRITICAL)
 
@@ -73,23 +78,16 @@ class TestClient(unittest.TestCase):
         )
         self.assertEqual(receive_data.call_count, 2)
 
+    @mock.patch("msg_transfer_package.client.BUFFER_SIZE", 4)
     @mock.patch("msg_transfer_package.client.Client.receive_data")
+    @mock.patch("msg_transfer_package.client.Client.sendfile")
     @mock.patch("msg_transfer_package.client.Client.sendall")
     @mock.patch("msg_transfer_package.client.create_headers")
-    @mock.patch("msg_transfer_package.client.encrypt_message")
-    @mock.patch("msg_transfer_package.client.os.path.getsize")
-    @mock.patch("msg_transfer_package.client.os.path.basename")
-    @mock.patch("msg_transfer_package.client.open")
-    @mock.patch("msg_transfer_package.client.bytes")
     def test_transfer_file(
         self,
-        mock_bytes,
-        mock_open,
-        basename,
-        getsize,
-        encrypt_message,
         create_headers,
         sendall,
+        sendfile,
         receive_data,
     ):
         """
@@ -98,32 +96,128 @@ class TestClient(unittest.TestCase):
 
         encrypt = True
         send_type = "file"
-        getsize.return_value = 100
-        basename.return_value = "file.txt"
+        file_data = b"yabc123"
         create_headers.return_value = "metadata  "
-        file_reads = [b"y", b"abc", b"123", b""]
-        mock_open.return_value.__enter__.return_value.read.side_effect = file_reads
-        mock_bytes.return_value = b"x"
-        encrypt_message.return_value = b"encrypted text"
-
-        self.client.transfer_file("file.txt", encrypt=encrypt)
+        sent = []
+        sendall.side_effect = lambda data, *flags: sent.append(bytes(data))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "file.txt")
+            with open(path, "wb") as file:
+                file.write(file_data)
+
+            self.client.transfer_file(path, encrypt=encrypt)
+
+            create_headers.assert_called_with(
+                16, send_type, encrypt, "file.txt", len(file_data)
+            )
+            # Encrypted in BUFFER_SIZE chunks after the header
+            self.assertEqual(b"metadata  ", sent[0])
+            self.assertEqual(3, len(sent))
+            self.assertEqual(encrypt_message(file_data), b"".join(sent[1:]))
+            sendfile.assert_not_called()
+            receive_data.assert_called_once()
+
+            encrypt = False
+            sent.clear()
+            sendfile.return_value = len(file_data)
+            self.client.transfer_file(path, encrypt=encrypt)
+            self.assertEqual([b"metadata  "], sent)
+            self.assertEqual((0, len(file_data)), sendfile.call_args[0][1:])
+            self.assertEqual(receive_data.call_count, 2)
+
+            sendfile.return_value = 3
+            with self.assertRaises(OSError):
+                self.client.transfer_file(path, encrypt=encrypt)
+
+            # A file that fits in one buffer is sent in the same write as its header
+            sent.clear()
+            sendfile.reset_mock()
+            with open(path, "wb") as file:
+                file.write(b"abc")
+            for encrypt in (False, True):
+                self.client.transfer_file(path, encrypt=encrypt)
+            self.assertEqual([b"metadata  abc", b"metadata  " + encrypt_message(b"abc")], sent)
+            sendfile.assert_not_called()
 
-        mock_open.assert_called_with(basename.return_value, "rb")
+    @mock.patch("msg_transfer_package.client.Client.receive_data")
+    @mock.patch("msg_transfer_package.client.Client.sendall")
+    def test_transfer_object_v2(self, sendall, receive_data):
+        """
+        Tests that protocol v2 clients send binary headers
+        """
 
-        create_headers.assert_called_with(
-            16, send_type, encrypt, basename.return_value, getsize.return_value
-        )
-        encrypt_message.assert_called_once_with(b"".join(file_reads))
+        client = Client("", 7000, protocol_version=2)
+        with client:
+            client.transfer_object("json", [1, 2], encrypt=False)
         sendall.assert_called_once_with(
-            mock_bytes.return_value + encrypt_message.return_value
-        )
+            create_headers_v2("object", False, "json", 6) + b"[1, 2]")
         receive_data.assert_called_once()
 
-        encrypt = False
-        mock_open.return_value.__enter__.return_value.read.side_effect = file_reads
-        self.client.transfer_file("file.txt", encrypt=encrypt)
-        sendall.assert_called_with(
-            mock_bytes.return_value + b"".join(file_reads))
+    @mock.patch("msg_transfer_package.server.Server.receive_object")
+    def test_pipelined_transfers(self, receive_object):
+        """
+        Tests that pipelined messages are acknowledged by request id, including failures
+        """
+
+        receive_object.side_effect = [None, ValueError("bad object"), None]
+        server_sock, client_sock = socket.socketpair()
+        server = threading.Thread(target=Server("", 7000, "print").receive_data,
+                                  args=(server_sock, "address"))
+        server.start()
+        with server_sock, Client("", 7000, protocol_version=2, window=2,
+                                 fileno=client_sock.detach()) as client:
+            request_ids = [client.send_object("json", [i], False)
+                           for i in range(3)]
+            acks = client.flush()
+            client.shutdown(socket.SHUT_WR)
+            server.join()
+
+        self.assertEqual(request_ids, [ack.request_id for ack in acks])
+        self.assertEqual(Ack(request_ids[0], True, b"Received Object successfully"), acks[0])
+        self.assertEqual(
+            Ack(request_ids[1], False, b"Failed to process message: bad object"), acks[1])
+        self.assertTrue(acks[2].ok)
+        self.assertEqual([], client.flush())
+
+        with self.assertRaises(ValueError), Client("", 7000) as client:
+            client.send_object("json", [1])
+
+    def test_batch_object(self):
+        """
+        Tests that batched objects are sent as one message by size, linger time or flush
+        """
+
+        server_sock, client_sock = socket.socketpair()
+        server = threading.Thread(target=Server("", 7000, "print").receive_data,
+                                  args=(server_sock, "address"))
+        server.start()
+        with server_sock, Client("", 7000, protocol_version=2, batch_linger=0.05, batch_bytes=20,
+                                 fileno=client_sock.detach()) as client:
+            with mock.patch.object(Server, "parse_object", wraps=Server.parse_object) as parse_object:
+                # Four 6 byte objects fill the 20 byte budget
+                for i in range(5):
+                    client.batch_object("json", [i, i], False)
+                self.assertEqual(1, len(client._in_flight))
+                # The last object is sent once the linger time has passed
+                client._batch_timer.join()
+                self.assertEqual(2, len(client._in_flight))
+                client.batch_object("json", {"a": 1}, True)
+                acks = client.flush()
+            client.shutdown(socket.SHUT_WR)
+            server.join()
+
+        self.assertEqual(
+            [b"Received Batch of 4 objects successfully",
+             b"Received Batch of 1 objects successfully",
+             b"Received Batch of 1 objects successfully"],
+            [ack.message for ack in acks])
+        self.assertEqual(
+            [[i, i] for i in range(5)] + [{"a": 1}],
+            [Server.parse_object(call[0][0], "json") for call in parse_object.call_args_list])
+
+        with self.assertRaises(ValueError), Client("", 7000) as client:
+            client.batch_object("json", [1])
 
     @mock.patch("msg_transfer_package.client.Client.connect")
     def test__connect(self, mock_connect):
@@ -134,6 +228,7 @@ class TestClient(unittest.TestCase):
         self.client.connection()
         mock_connect.assert_called_once_with(
             (self.client.host, self.client.host_port))
+        self.assertEqual(1, self.client.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
 
     def test_receive_data(self):
         pass
@@ -0,0 +1,114 @@
+from msg_transfer_package import codec
+from msg_transfer_package.example_data.example_data import DATA
+import unittest
+from ddt import ddt, data
+
+
+@ddt
+class TestCodec(unittest.TestCase):
+    @data(
+        DATA,
+        None,
+        True,
+        False,
+        0,
+        127,
+        128,
+        -1,
+        -2 ** 70,
+        2 ** 64,
+        1.5,
+        -0.25,
+        "",
+        "Liverpool é中",
+        b"\x00\xff",
+        [],
+        {},
+        [1, [2, [3, {"a": None}]]],
+        {1: "int key", "list": [True, False, 3.0]},
+    )
+    def test_round_trip(self, obj):
+        """
+        Tests that values survive serialization
+        """
+
+        serialized = codec.dumps(obj)
+        self.assertIsInstance(serialized, bytes)
+        self.assertEqual(obj, codec.loads(serialized))
+
+    @data(
+        [0, 1, 2, 3, 4],
+        [-1, 200, 3, 4],
+        [0, 70000, 2 ** 40, -2 ** 63],
+        [2 ** 64, 1, 2, 3],
+        [0.5, -1.25, 3.0, 1e300],
+        [True, False, False, True],
+        ["a", "b", "a", "é中", ""],
+        ["x" * 300, "y", "z", "w"],
+        [[1, 2], [], [3], [4, 5, 6]],
+        [(1, "a"), (2, "b"), (3, "c"), (4, "d")],
+        [{"id": i, "name": "n{}".format(i % 3), "tags": ["t"] * i} for i in range(10)],
+        [{"a": {"b": i}} for i in range(5)],
+        [{"a": 1}, {"b": 2}, {"a": 3}, {"a": 4}],
+        [{"a": 1, "b": 2}, {"b": 3, "a": 4}, {"a": 5, "b": 6}, {"a": 7, "b": 8}],
+        [1, "a", 2.0, None, True],
+    )
+    def test_packed(self, obj):
+        """
+        Tests that lists of same-typed items survive packing
+        """
+
+        self.assertEqual([list(item) if isinstance(item, tuple) else item for item in obj],
+                         codec.loads(codec.dumps(obj)))
+
+    def test_packed_size(self):
+        """
+        Tests that records are packed as a table instead of repeating their keys
+        """
+
+        rows = [{"identifier": i, "description": "row"} for i in range(100)]
+        serialized = codec.dumps(rows)
+        self.assertEqual(codec.TABLE, serialized[0])
+        self.assertEqual(1, serialized.count(b"identifier"))
+
+    def test_compact(self):
+        """
+        Tests that small integers and tuples are encoded compactly
+        """
+
+        self.assertEqual(b"\x85", codec.dumps(5))
+        self.assertEqual(b"\x07\x02\x81\x82", codec.dumps((1, 2)))
+        self.assertLess(len(codec.dumps(DATA)), len(str(DATA)))
+
+    def test_zero_copy(self):
+        """
+        Tests that bytes values can be decoded as views into the received buffer
+        """
+
+        received = bytearray(codec.dumps({"blob": b"abc"}))
+        blob = codec.loads(received, zero_copy=True)["blob"]
+        self.assertIsInstance(blob, memoryview)
+        self.assertEqual(b"abc", blob)
+        received[-1] = ord("x")
+        self.assertEqual(b"abx", blob)
+        self.assertIsInstance(codec.loads(bytes(received))["blob"], bytes)
+
+    @data(b"", b"\x05\x05ab", b"\x03\xff", b"\x7f", b"\x85\x85", b"\x07" * 200,
+          b"\x09\x04b\x01", b"\x09\x01z\x01", b"\x0a\x02\x00", b"\x0c\x02\x01B\x05\x01a",
+          b"\x0d\x02\x07\x01\x81\x07\x01\x81", b"\x0d\x01\x07\x01\x07\x00\x07\x01\x81",
+          b"\x0e\x01B\x03\x07\x02\x81\x82")
+    def test_invalid(self, serialized):
+        """
+        Tests that malformed input raises ValueError
+        """
+
+        with self.assertRaises(ValueError):
+            codec.loads(serialized)
+
+    def test_unsupported_type(self):
+        """
+        Tests that arbitrary objects are refused instead of pickled
+        """
+
+        with self.assertRaises(TypeError):
+            codec.dumps({"set": {1, 2}})
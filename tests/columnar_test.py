@@ -0,0 +1,68 @@
+from msg_transfer_package import columnar
+from msg_transfer_package.example_data.example_data import DATA
+from array import array
+import unittest
+
+RECORDS = [
+    {"id": i, "score": i / 4, "active": i % 2 == 0, "name": "user é{}".format(i),
+     "tags": ["a"] * i, "email": DATA["data"]["email"]}
+    for i in range(5)
+]
+
+
+class TestColumnar(unittest.TestCase):
+    def test_round_trip(self):
+        """
+        Tests that records survive encoding as rows and as columns
+        """
+
+        batch = columnar.decode(columnar.encode_records(RECORDS))
+        self.assertEqual(len(RECORDS), len(batch))
+        self.assertEqual(RECORDS, batch.to_rows())
+        self.assertEqual(RECORDS, list(batch))
+        self.assertEqual(RECORDS[-1], batch[-1])
+        self.assertEqual(RECORDS[1:3], batch[1:3])
+
+        self.assertEqual(array("q", range(5)), batch.columns["id"])
+        self.assertIsInstance(batch.columns["score"], array)
+        self.assertIsInstance(batch.columns["name"], columnar.StringColumn)
+        self.assertEqual("user é3", batch.columns["name"][3])
+        self.assertEqual([True, False, True, False, True],
+                         batch.columns["active"])
+
+    def test_compact(self):
+        """
+        Tests that field names are sent once
+        """
+
+        records = [dict(DATA["data"]) for _ in range(100)]
+        encoded = columnar.encode_records(records)
+        self.assertEqual(1, encoded.count(b"first_name"))
+        self.assertEqual(records, columnar.decode(encoded).to_rows())
+
+    def test_edge_cases(self):
+        """
+        Tests empty batches and columns falling back to the compact codec
+        """
+
+        self.assertEqual([], columnar.decode(
+            columnar.encode_records([])).to_rows())
+        self.assertEqual([{}, {}], columnar.decode(
+            columnar.encode_records([{}, {}])).to_rows())
+        mixed = [{"value": 1}, {"value": None}, {"value": 2 ** 70}]
+        self.assertEqual(mixed, columnar.decode(
+            columnar.encode_records(mixed)).to_rows())
+
+    def test_invalid(self):
+        """
+        Tests that other objects and malformed input raise ValueError
+        """
+
+        for obj in ({"a": 1}, [{"a": 1}, {"b": 1}], [1, 2]):
+            with self.assertRaises(ValueError):
+                columnar.encode_records(obj)
+
+        encoded = columnar.encode_records(RECORDS)
+        for data in (encoded[:-1], encoded + b"x", encoded[:3]):
+            with self.assertRaises(ValueError):
+                columnar.decode(data)
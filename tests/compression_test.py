@@ -0,0 +1,66 @@
+from msg_transfer_package.compression import compress_payload, decompress_payload, entropy
+from msg_transfer_package.example_data.example_data import DATA
+from msg_transfer_package.utils import serialize_object
+import os
+import unittest
+from ddt import ddt, data
+
+
+@ddt
+class TestCompression(unittest.TestCase):
+    @data("zlib", "bz2", "lzma")
+    def test_round_trip(self, method):
+        """
+        Tests that compressible payloads are compressed and restored
+        """
+
+        payload = serialize_object([DATA] * 50, "json")
+        used, compressed = compress_payload(payload, method)
+        self.assertEqual(method, used)
+        self.assertLess(len(compressed), len(payload))
+        self.assertEqual(payload, decompress_payload(compressed, method))
+
+        used, compressed = compress_payload(payload, method, level=1)
+        self.assertEqual(payload, decompress_payload(compressed, method))
+
+    @data("zlib", "bz2", "lzma")
+    def test_max_size(self, method):
+        """
+        Tests that a payload expanding past max_size is refused before it is decompressed whole
+        """
+
+        payload = bytes(1000000)
+        _, compressed = compress_payload(payload, method)
+        self.assertEqual(payload, decompress_payload(compressed, method, len(payload)))
+        with self.assertRaises(ValueError):
+            decompress_payload(compressed, method, len(payload) - 1)
+        with self.assertRaises(ValueError):
+            decompress_payload(compressed[:len(compressed) // 2], method)
+        with self.assertRaises(ValueError):
+            decompress_payload(compressed, "zip")
+
+    def test_skip(self):
+        """
+        Tests that small and random payloads are left as they are
+        """
+
+        small = serialize_object(DATA, "json")
+        self.assertEqual((None, small), compress_payload(small, "zlib"))
+
+        noise = os.urandom(8192)
+        self.assertGreater(entropy(noise), 7.5)
+        self.assertEqual((None, noise), compress_payload(noise, "zlib"))
+
+        self.assertEqual((None, noise), compress_payload(noise, None))
+        with self.assertRaises(ValueError):
+            compress_payload(b"a" * 1000, "zip")
+
+    def test_entropy(self):
+        """
+        Tests the entropy estimate
+        """
+
+        self.assertEqual(0.0, entropy(b""))
+        self.assertEqual(0.0, entropy(b"aaaa"))
+        self.assertEqual(1.0, entropy(b"abab"))
+        self.assertEqual(8.0, entropy(bytes(range(256))))
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from msg_transfer_package.dedup import HAVE_IT, BlobStore, file_digest
+from msg_transfer_package.server import Server
+from tests.helpers import ServerTestCase
+
+logging.disable(logging.CRITICAL)
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.blobs = BlobStore(os.path.join(self.tmp_dir.name, "blobs"))
+        self.data = os.urandom(5000)
+        self.digest = hashlib.sha256(self.data).digest()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    def test_file_digest(self):
+        """
+        Tests that a file is hashed in buffers to the sha256 of its contents
+        """
+
+        path = self.write("file.bin", self.data)
+        with mock.patch("msg_transfer_package.dedup.HASH_BUFFER_SIZE", 1024):
+            self.assertEqual((self.digest, 5000), file_digest(path))
+
+    def test_add_and_link(self):
+        """
+        Tests that stored contents are linked to new file names
+        """
+
+        self.assertFalse(self.blobs.has(self.digest, 5000))
+        self.blobs.add_file(self.write("file.bin", self.data), self.digest)
+        self.assertTrue(self.blobs.has(self.digest, 5000))
+        self.assertFalse(self.blobs.has(self.digest, 4999))
+
+        target = os.path.join(self.tmp_dir.name, "copy.bin")
+        self.blobs.link(self.digest, target)
+        with open(target, "rb") as file:
+            self.assertEqual(self.data, file.read())
+        self.assertEqual(self.data, self.blobs.read(self.digest))
+
+    def test_add_bytes(self):
+        """
+        Tests that contents held in memory are stored under their sha256
+        """
+
+        self.blobs.add_bytes(self.data)
+        self.assertTrue(self.blobs.has(self.digest, 5000))
+        self.assertEqual(self.data, self.blobs.read(self.digest))
+
+    def test_modified_blob(self):
+        """
+        Tests that a blob changed through a file sharing its storage is not reused
+        """
+
+        path = self.write("file.bin", self.data)
+        self.blobs.add_file(path, self.digest)
+        with open(path, "r+b") as file:
+            file.write(b"changed")
+        self.assertFalse(self.blobs.has(self.digest, 5000))
+        self.assertFalse(os.path.exists(self.blobs.path(self.digest)))
+
+
+class TestDedupTransfer(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        with open("input.bin", "wb") as file:
+            file.write(os.urandom(100000))
+        self.blobs = BlobStore("blobs")
+        self.sink = mock.Mock(path="objects.txt")
+        self.server = Server("", 7000, "file",
+                             sink=self.sink, blobs=self.blobs)
+        self.client = self.connect(protocol_version=2)
+
+    def test_file(self):
+        """
+        Tests that a file is sent once and linked to its name when sent again
+        """
+
+        self.assertEqual(b"Received File successfully",
+                         self.client.transfer_file("input.bin", dedup=True))
+        self.assertTrue(self.blobs.has(*file_digest("input.bin")))
+        os.remove("received_input.bin")
+
+        with mock.patch.object(self.client, "_send_file") as send_file:
+            self.assertEqual(HAVE_IT, self.client.transfer_file(
+                "input.bin", encrypt=False, dedup=True))
+        send_file.assert_not_called()
+        with open("input.bin", "rb") as expected, open("received_input.bin", "rb") as received:
+            self.assertEqual(expected.read(), received.read())
+
+    def test_object(self):
+        """
+        Tests that a stored object is processed without being sent again
+        """
+
+        obj = {"key": "value", "list": [1, 2, 3]}
+        self.assertEqual(b"Received Object successfully",
+                         self.client.transfer_object("json", obj, dedup=True))
+        with mock.patch.object(self.client, "_send_serialized") as send_serialized:
+            self.assertEqual(
+                HAVE_IT, self.client.transfer_object("json", obj, dedup=True))
+        send_serialized.assert_not_called()
+        self.assertEqual(2, self.sink.write.call_count)
+        self.assertEqual(self.sink.write.call_args_list[0],
+                         self.sink.write.call_args_list[1])
+
+    def test_without_store(self):
+        """
+        Tests that a server without a BlobStore asks for every payload
+        """
+
+        self.server.blobs = None
+        for _ in range(2):
+            self.assertEqual(b"Received File successfully",
+                             self.client.transfer_file("input.bin", dedup=True))
+        self.assertFalse(os.path.exists("blobs/" + file_digest("input.bin")[0].hex()[:2]))
+
+    def test_protocol_v1(self):
+        """
+        Tests that deduplication is refused in protocol v1
+        """
+
+        self.client.protocol_version = 1
+        with self.assertRaises(ValueError):
+            self.client.transfer_file("input.bin", dedup=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+import io
+import logging
+import os
+import random
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from msg_transfer_package.delta import (
+    MAX_BLOCK_SIZE,
+    MIN_BLOCK_SIZE,
+    apply_delta,
+    block_size_for,
+    file_signatures,
+    parse_signatures,
+    roll,
+    write_delta,
+)
+from msg_transfer_package.limits import Limits
+from msg_transfer_package.server import Server
+from tests.helpers import ServerTestCase
+
+logging.disable(logging.CRITICAL)
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.random = random.Random(7)
+        self.basis = self.random.randbytes(200000)
+        self.basis_path = self.write("basis.bin", self.basis)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    def delta(self, data, block_size=0):
+        """
+        Delta of data against the basis file and its number of literal bytes
+        """
+
+        path = self.write("new.bin", data)
+        out = io.BytesIO()
+        literal_bytes = write_delta(
+            path, *parse_signatures(file_signatures(self.basis_path, block_size)), out)
+        return out.getvalue(), literal_bytes
+
+    def rebuild(self, delta):
+        target = os.path.join(self.tmp_dir.name, "rebuilt.bin")
+        apply_delta(self.basis_path, io.BytesIO(delta), target)
+        with open(target, "rb") as file:
+            return file.read()
+
+    def test_roll(self):
+        """
+        Tests that the rolled checksum equals the Adler-32 of the moved window
+        """
+
+        data = self.random.randbytes(1000)
+        checksum = zlib.adler32(data[:64])
+        for start in range(1, len(data) - 64):
+            checksum = roll(checksum, data[start - 1], data[start + 63], 64)
+            self.assertEqual(zlib.adler32(data[start:start + 64]), checksum)
+
+    def test_block_size(self):
+        self.assertEqual(MIN_BLOCK_SIZE, block_size_for(0))
+        self.assertEqual(4096, block_size_for(4096 * 4096))
+        self.assertEqual(MAX_BLOCK_SIZE, block_size_for(1 << 40))
+
+    def test_unchanged(self):
+        """
+        Tests that an unchanged file is sent as references to blocks and its short last block
+        """
+
+        delta, literal_bytes = self.delta(self.basis)
+        self.assertEqual(200000 % MIN_BLOCK_SIZE, literal_bytes)
+        self.assertLess(len(delta), 2 * MIN_BLOCK_SIZE)
+        self.assertEqual(self.basis, self.rebuild(delta))
+
+    def test_changed(self):
+        """
+        Tests that inserted, modified and appended data is sent as literal data
+        """
+
+        data = (self.basis[:50000] + b"inserted" + self.basis[50000:120000] + b"x" +
+                self.basis[120001:] + self.random.randbytes(3000))
+        delta, literal_bytes = self.delta(data)
+        # Each change costs at most a block around it
+        self.assertLess(literal_bytes, 3000 + 4 * MIN_BLOCK_SIZE)
+        self.assertEqual(data, self.rebuild(delta))
+
+    def test_unrelated(self):
+        """
+        Tests that a file sharing nothing with the basis is sent in full
+        """
+
+        data = self.random.randbytes(100005)
+        # The new version is read in several buffers
+        with mock.patch("msg_transfer_package.delta.READ_SIZE", 10000):
+            delta, literal_bytes = self.delta(data, 4096)
+        self.assertEqual(len(data), literal_bytes)
+        self.assertEqual(data, self.rebuild(delta))
+
+    def test_changed_basis(self):
+        """
+        Tests that a delta is refused when the basis no longer matches it
+        """
+
+        delta, _ = self.delta(self.basis[:100000] + b"changed")
+        self.write("basis.bin", self.basis + b"appended")
+        with self.assertRaises(ValueError):
+            self.rebuild(delta)
+
+        self.write("basis.bin", bytes(200000))
+        with self.assertRaises(ValueError):
+            self.rebuild(delta)
+        self.assertEqual(["basis.bin", "new.bin"], sorted(os.listdir(self.tmp_dir.name)))
+
+
+class TestDeltaTransfer(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = random.Random(7).randbytes(300000)
+        self.write(self.data)
+        # Deltas are streamed, so they are not limited by max_frame_size
+        self.server = Server("", 7000, "file", limits=Limits(max_frame_size=4096))
+        self.client = self.connect(protocol_version=2)
+
+    def write(self, data):
+        with open("input.bin", "wb") as file:
+            file.write(data)
+
+    def assert_received(self, data):
+        with open("received_input.bin", "rb") as file:
+            self.assertEqual(data, file.read())
+
+    def test_transfer(self):
+        """
+        Tests that the first transfer sends the whole file and the next ones only the changes
+        """
+
+        self.assertEqual(b"Received File successfully",
+                         self.client.transfer_file_delta("input.bin"))
+        self.assert_received(self.data)
+
+        data = self.data + b"appended line\n"
+        self.write(data)
+        with mock.patch.object(self.client, "_send_file") as send_file, \
+                mock.patch.object(self.client, "_send_stream",
+                                  wraps=self.client._send_stream) as send_stream:
+            self.assertEqual(b"Received File successfully",
+                             self.client.transfer_file_delta("input.bin", encrypt=False))
+        send_file.assert_not_called()
+        # The count of bytes sent
+        self.assertLess(send_stream.call_args[0][2], 5000)
+        self.assert_received(data)
+
+        data = data[:1000] + data[2000:]
+        self.write(data)
+        self.assertEqual(b"Received File successfully",
+                         self.client.transfer_file_delta("input.bin"))
+        self.assert_received(data)
+
+    def test_large_delta(self):
+        """
+        Tests that a delta over max_frame_size is applied, and a failed one reported
+        without closing the connection
+        """
+
+        self.client.transfer_file_delta("input.bin")
+        data = self.data[:100000] + random.Random(8).randbytes(20000) + self.data[100000:]
+        self.write(data)
+        self.assertEqual(b"Received File successfully",
+                         self.client.transfer_file_delta("input.bin", encrypt=False))
+        self.assert_received(data)
+
+        original_write_delta = write_delta
+
+        def change_basis(*args):
+            with open("received_input.bin", "ab") as file:
+                file.write(b"changed")
+            return original_write_delta(*args)
+
+        self.write(self.data)
+        with mock.patch("msg_transfer_package.client.write_delta", side_effect=change_basis):
+            self.assertIn(b"changed since its signatures were sent",
+                          self.client.transfer_file_delta("input.bin"))
+        self.assertEqual(b"Received File successfully",
+                         self.client.transfer_file_delta("input.bin"))
+        self.assert_received(self.data)
+
+    def test_protocol_v1(self):
+        self.client.protocol_version = 1
+        with self.assertRaises(ValueError):
+            self.client.transfer_file_delta("input.bin")
+
+
+if __name__ == "__main__":
+    unittest.main()
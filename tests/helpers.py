@@ -0,0 +1,44 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from msg_transfer_package.client import Client
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Runs every test in a temporary working directory and connects clients to self.server,
+    which the subclass creates in its setUp, each through a socket pair served by a thread
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.connections = []
+
+    def tearDown(self):
+        for client, thread, server_sock in self.connections:
+            client.close()
+            thread.join()
+            server_sock.close()
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def connect(self, host="", host_port=7000, **kwargs) -> Client:
+        """
+        Client connected to the test server through a socket pair
+        """
+
+        server_sock, client_sock = socket.socketpair()
+        thread = threading.Thread(
+            target=self.server.receive_data, args=(server_sock, "address"))
+        thread.start()
+        client = Client(host, host_port, fileno=client_sock.detach(), **kwargs)
+        # The socket is connected already
+        client.connection = mock.Mock()
+        self.connections.append((client, thread, server_sock))
+        return client
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from msg_transfer_package import utils
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules importing the client may add to those of a bare interpreter. Counts do not vary
+# between runs the way import times do. The client adds about 56, importing the cipher,
+# xmltodict, json and pickle eagerly brings in about 120 more
+IMPORT_BUDGET = 80
+# Modules only needed once an object is serialized, a payload encrypted or a config file read
+LAZY_MODULES = ("Crypto", "xmltodict", "pickle", "json",
+                "configparser", "tempfile", "bz2", "lzma")
+
+
+def import_times(code: str) -> dict:
+    """
+    Runs code in a new interpreter with -X importtime and returns the self import time
+    in microseconds of every module it imported
+    """
+
+    # No bytecode is written into the source tree
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR, PYTHONDONTWRITEBYTECODE="1")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code], cwd=tmp_dir, env=env,
+            check=True, capture_output=True, text=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(self_time)
+    return times
+
+
+class TestImports(unittest.TestCase):
+    def test_lazy_modules(self):
+        """
+        Tests that importing the client leaves the codecs, the cipher and the key for later
+        """
+
+        code = ("from msg_transfer_package import client, utils\n"
+                "assert utils.secret_key.cache_info().currsize == 0")
+        times = import_times(code)
+        self.assertIn("msg_transfer_package.client", times)
+        imported = [name for name in times if name.split(".")[0] in LAZY_MODULES]
+        self.assertEqual([], imported)
+
+    def test_import_budget(self):
+        """
+        Tests that importing the client stays within its budget of imported modules
+        """
+
+        baseline = import_times("pass")
+        added = sorted(set(import_times("import msg_transfer_package.client")) - set(baseline))
+        self.assertLessEqual(len(added), IMPORT_BUDGET, added)
+
+    def test_key(self):
+        """
+        Tests that the key is hashed from the secret when first used
+        """
+
+        self.assertEqual(hashlib.sha256(utils.SECRET.encode()).digest(), utils.KEY)
+        self.assertEqual(utils.KEY, utils.secret_key())
+        with self.assertRaises(AttributeError):
+            utils.MISSING
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest
+
+from msg_transfer_package.limits import ByteBudget, Limits
+from msg_transfer_package.utils import MAX_HEADER_SIZE, FrameDecoder, ProtocolError, create_headers
+
+
+class TestLimits(unittest.TestCase):
+    def test_validation(self):
+        """
+        Tests that limits a connection could never satisfy are refused
+        """
+
+        Limits(max_frame_size=100, connection_budget=100 + MAX_HEADER_SIZE,
+               global_budget=100 + MAX_HEADER_SIZE)
+        with self.assertRaises(ValueError):
+            Limits(max_frame_size=100, connection_budget=100)
+        with self.assertRaises(ValueError):
+            Limits(connection_budget=2 ** 26, global_budget=2 ** 25)
+        with self.assertRaises(ValueError):
+            Limits(read_timeout=0)
+        with self.assertRaises(ValueError):
+            Limits(max_frame_size=0)
+        with self.assertRaises(ValueError):
+            Limits(max_file_size=0)
+        with self.assertRaises(ValueError):
+            Limits(partial_ttl=0)
+
+    def test_budget(self):
+        """
+        Tests partial and exact acquisition and that a release wakes up a waiting thread
+        """
+
+        budget = ByteBudget(100)
+        self.assertEqual(60, budget.acquire(60))
+        self.assertEqual(40, budget.acquire(60))
+        self.assertEqual(0, budget.acquire(1, timeout=0.01))
+        self.assertFalse(budget.try_acquire(1))
+
+        taken = []
+        thread = threading.Thread(target=lambda: taken.append(budget.acquire(50)))
+        thread.start()
+        time.sleep(0.01)
+        budget.release(30)
+        thread.join()
+        self.assertEqual([30], taken)
+        budget.release(100)
+        self.assertTrue(budget.try_acquire(100))
+        self.assertEqual(0, budget.available)
+
+    def test_frame_limit(self):
+        """
+        Tests that the decoder refuses frames over the limit, except files streamed to disk
+        """
+
+        decoder = FrameDecoder(16, max_frame_size=10)
+        decoder.feed(bytes(create_headers(16, "object", False, "json", 11), "utf-8"))
+        with self.assertRaises(ProtocolError) as context:
+            next(decoder)
+        self.assertEqual(11, context.exception.metadata["length"])
+
+        decoder = FrameDecoder(16, max_frame_size=10, streamed_types=("file",))
+        decoder.feed(bytes(create_headers(16, "file", False, "name", 11), "utf-8"))
+        with self.assertRaises(StopIteration):
+            next(decoder)
+        self.assertEqual(11, decoder.header["length"])
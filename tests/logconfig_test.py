@@ -0,0 +1,90 @@
+import io
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from msg_transfer_package.logconfig import PAYLOAD_LOGGER, setup_logging
+from msg_transfer_package.server import Server
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Payload(bytes):
+    """
+    Received data that fails the test if it is ever formatted
+    """
+
+    def __str__(self):
+        raise AssertionError("Payload was formatted")
+
+    __repr__ = __str__
+
+
+class TestLogConfig(unittest.TestCase):
+    def setUp(self):
+        root = logging.getLogger()
+        self.previous = (root.handlers[:], root.level,
+                         logging.root.manager.disable)
+        logging.disable(logging.NOTSET)
+
+    def tearDown(self):
+        root = logging.getLogger()
+        root.handlers[:], level, disable = self.previous
+        root.setLevel(level)
+        logging.disable(disable)
+        logging.getLogger(PAYLOAD_LOGGER).setLevel(logging.NOTSET)
+
+    def test_import(self):
+        """
+        Tests that importing the package adds no handlers and creates no log files
+        """
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            subprocess.run(
+                [sys.executable, "-c",
+                 "import logging, msg_transfer_package.client, msg_transfer_package.server\n"
+                 "assert not logging.getLogger().handlers"],
+                cwd=tmp_dir, env=dict(os.environ, PYTHONPATH=PACKAGE_DIR), check=True)
+            self.assertEqual([], os.listdir(tmp_dir))
+
+    def test_setup_logging(self):
+        """
+        Tests that records reach the log file through the listener and payloads are left out
+        """
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "server_log.log")
+            with mock.patch("sys.stderr", io.StringIO()) as stderr:
+                listener = setup_logging("SERVER", log_file)
+                logging.getLogger("msg_transfer_package.server").info(
+                    "hello %s", "world")
+                logging.getLogger("msg_transfer_package.server").debug(
+                    "hidden")
+                Server.receive_file(Payload(b"file data"), {
+                                    "encrypt": False, "filename": "name.ext"}, "print")
+                listener.stop()
+
+            with open(log_file) as file:
+                logged = file.read()
+            self.assertEqual(logged, stderr.getvalue())
+            self.assertIn("SERVER: ", logged)
+            self.assertIn("hello world", logged)
+            self.assertIn("Received file: name.ext, 9 bytes", logged)
+            self.assertNotIn("hidden", logged)
+            self.assertNotIn("file data", logged)
+
+    def test_log_payloads(self):
+        """
+        Tests that payloads are logged when explicitly enabled
+        """
+
+        with mock.patch("sys.stderr", io.StringIO()) as stderr:
+            listener = setup_logging("SERVER", log_payloads=True)
+            Server.receive_file(b"file data", {
+                                "encrypt": False, "filename": "name.ext"}, "print")
+            listener.stop()
+        self.assertIn("file data", stderr.getvalue())
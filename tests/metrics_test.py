@@ -0,0 +1,145 @@
+import json
+import logging
+import socket
+import unittest
+import urllib.request
+
+from msg_transfer_package.metrics import Histogram, MetricsAggregate, MetricsRegistry
+from msg_transfer_package.server import Server
+from msg_transfer_package.utils import create_headers_v2, serialize_object
+
+logging.disable(logging.CRITICAL)
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentile(self):
+        """
+        Tests that percentiles stay within the bucket precision
+        """
+
+        histogram = Histogram()
+        for micros in range(1, 100001):
+            histogram.record(micros / 1e6)
+        self.assertEqual(100000, histogram.count)
+        for quantile in (0.5, 0.9, 0.99):
+            self.assertAlmostEqual(quantile * 0.1, histogram.percentile(quantile),
+                                   delta=quantile * 0.1 / 16)
+        self.assertEqual(0.1, histogram.percentile(1.0))
+
+        # Out of range values are clamped instead of growing the histogram
+        size = len(histogram.counts)
+        histogram.record(1e9)
+        histogram.record(-1)
+        self.assertEqual(size, len(histogram.counts))
+
+    def test_since(self):
+        """
+        Tests that a histogram can be narrowed to the values recorded after a copy
+        """
+
+        histogram = Histogram()
+        histogram.record(0.001)
+        previous = histogram.copy()
+        histogram.record(0.5)
+        recent = histogram.since(previous)
+        self.assertEqual(1, recent.count)
+        self.assertAlmostEqual(0.5, recent.percentile(0.5), delta=0.5 / 16)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_server_metrics(self):
+        """
+        Tests that the server counts connections, messages and latencies
+        """
+
+        metrics = MetricsRegistry()
+        server = Server("", 7000, "print", metrics=metrics)
+        payload = serialize_object({"a": 1}, "json")
+        server_sock, client_sock = socket.socketpair()
+        with client_sock:
+            client_sock.sendall(create_headers_v2(
+                "object", False, "json", len(payload)) + payload)
+            client_sock.sendall(create_headers_v2(
+                "object", False, "xml", 3) + b"bad")
+            client_sock.shutdown(socket.SHUT_WR)
+            server.handle_connection(server_sock, "address")
+
+        stats = metrics.to_json()
+        self.assertEqual(1, stats["connections"])
+        self.assertEqual(0, stats["active_connections"])
+        self.assertEqual(1, stats["errors"])
+        self.assertEqual(2, stats["latency_seconds"]["count"])
+        self.assertEqual(1, stats["decode_seconds"]["count"])
+        self.assertIn({"type": "object", "codec": "json", "encrypt": "false",
+                       "count": 1, "bytes": len(payload)}, stats["messages"])
+
+        text = metrics.prometheus_text()
+        self.assertIn(
+            'msg_transfer_messages_total{type="object",codec="json",encrypt="false"} 1', text)
+        self.assertIn("msg_transfer_latency_seconds_count 2", text)
+
+    def test_unknown_codec(self):
+        """
+        Tests that serialization names sent by clients do not create new labels
+        """
+
+        metrics = MetricsRegistry()
+        metrics.message_received(
+            {"type": "object", "serialize": 'x"}', "encrypt": True, "length": 1})
+        self.assertIn('codec="other"', metrics.prometheus_text())
+
+    def test_serve(self):
+        """
+        Tests the http endpoints
+        """
+
+        metrics = MetricsRegistry()
+        metrics.connection_opened()
+        http_server = metrics.serve("127.0.0.1", 0)
+        try:
+            url = "http://127.0.0.1:{}".format(http_server.server_address[1])
+            with urllib.request.urlopen(url + "/metrics") as response:
+                self.assertIn(b"msg_transfer_active_connections 1",
+                              response.read())
+            with urllib.request.urlopen(url + "/stats") as response:
+                self.assertEqual(
+                    1, json.loads(response.read())["active_connections"])
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+    def test_aggregate(self):
+        """
+        Tests that worker exports are combined and the counters of exited workers kept
+        """
+
+        metadata = {"type": "object", "serialize": "json",
+                    "encrypt": False, "length": 10}
+        first, second = MetricsRegistry(), MetricsRegistry()
+        first.connection_opened()
+        first.message_received(metadata, 0.001)
+        first.reply_sent(0.002)
+        second.connection_opened()
+        second.message_received(metadata, 0.003, error=True)
+        second.limit_violation()
+
+        aggregate = MetricsAggregate()
+        # Exports travel between processes as json
+        aggregate.update(1, json.loads(json.dumps(first.export())))
+        aggregate.update(2, json.loads(json.dumps(second.export())))
+        stats = aggregate.to_json()
+        self.assertEqual(2, stats["messages"][0]["count"])
+        self.assertEqual(20, stats["messages"][0]["bytes"])
+        self.assertEqual(2, stats["active_connections"])
+        self.assertEqual(1, stats["limit_violations"])
+        self.assertEqual(2, stats["decode_seconds"]["count"])
+        self.assertAlmostEqual(0.003, stats["decode_seconds"]["max"])
+        self.assertEqual([1, 2], [worker["pid"] for worker in stats["workers"]])
+
+        aggregate.worker_exited(2)
+        aggregate.update(3, MetricsRegistry().export())
+        stats = aggregate.to_json()
+        self.assertEqual(2, stats["messages"][0]["count"])
+        self.assertEqual(1, stats["active_connections"])
+        self.assertEqual(1, stats["errors"])
+        self.assertIn("msg_transfer_messages_total", aggregate.prometheus_text())
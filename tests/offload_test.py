@@ -0,0 +1,68 @@
+import logging
+import unittest
+import zlib
+from unittest import mock
+
+from msg_transfer_package.example_data.example_data import DATA
+from msg_transfer_package.offload import DecodePool
+from msg_transfer_package.server import Server
+from msg_transfer_package.utils import encrypt_message, pack_batch, serialize_object
+
+logging.disable(logging.CRITICAL)
+
+
+class TestDecodePool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = DecodePool(processes=2, min_size=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_decode(self):
+        """
+        Tests that objects are decoded in the worker processes like on the calling thread
+        """
+
+        for method in ("json", "xml", "binary", "compact"):
+            serialized = serialize_object(DATA, method)
+            expected = Server.decode_object(
+                serialized, {"type": "object", "encrypt": False, "serialize": method})
+            metadata = {"type": "object", "encrypt": True,
+                        "serialize": method}
+            self.assertEqual(expected, self.pool.decode(
+                encrypt_message(serialized), metadata))
+            metadata["encrypt"] = False
+            self.assertEqual(expected, self.pool.decode(
+                bytearray(serialized), metadata))
+
+        batch = pack_batch([serialize_object(DATA, "json")] * 3)
+        metadata = {"type": "batch", "encrypt": False, "serialize": "json"}
+        self.assertEqual([DATA] * 3, self.pool.decode(batch, metadata))
+
+    def test_errors(self):
+        """
+        Tests that decoding errors are raised in the calling thread
+        """
+
+        metadata = {"type": "object", "encrypt": False, "serialize": "json"}
+        with self.assertRaises(ValueError):
+            self.pool.decode(b"{not json", metadata)
+
+        metadata["compression"] = "zlib"
+        with self.assertRaises(ValueError):
+            self.pool.decode(zlib.compress(b"[" + b" " * 100000 + b"]"), metadata, 1000)
+
+    @mock.patch("msg_transfer_package.offload.Server.decode_object")
+    def test_small_inline(self, decode_object):
+        """
+        Tests that payloads under min_size are decoded on the calling thread
+        """
+
+        pool = DecodePool(processes=1, min_size=1024)
+        metadata = {"type": "object", "encrypt": False, "serialize": "json"}
+        self.assertEqual(decode_object.return_value,
+                         pool.decode(b"{}", metadata))
+        decode_object.assert_called_once_with(b"{}", metadata, 0)
+        pool.close()
@@ -0,0 +1,100 @@
+import logging
+import unittest
+from unittest import mock
+
+from msg_transfer_package.pool import ClientPool
+
+logging.disable(logging.CRITICAL)
+
+
+class TestClientPool(unittest.TestCase):
+    @mock.patch("msg_transfer_package.pool.Client")
+    def test_reuse(self, mock_client):
+        """
+        Tests that connections are reused while healthy and replaced when dead
+        """
+
+        mock_client.return_value.host = "host"
+        mock_client.return_value.host_port = 7000
+        pool = ClientPool()
+        first = pool.transfer_object("host", 7000, "json", {"a": 1})
+        second = pool.transfer_object("host", 7000, "json", {"a": 1})
+        self.assertEqual(mock_client.call_count, 1)
+        client = mock_client.return_value
+        self.assertEqual(client.transfer_object.return_value, first)
+        self.assertEqual(first, second)
+
+        client.is_alive.return_value = False
+        pool.transfer_file("host", 7000, "file.txt", False)
+        self.assertEqual(mock_client.call_count, 2)
+        client.transfer_file.assert_called_once_with("file.txt", False)
+
+    @mock.patch("msg_transfer_package.pool.Client")
+    def test_reconnect(self, mock_client):
+        """
+        Tests that a failure on a reused connection is retried on a new one,
+        and a failure on a new connection is raised
+        """
+
+        stale, fresh = mock.MagicMock(), mock.MagicMock()
+        stale.host, stale.host_port = "host", 7000
+        stale.is_alive.return_value = True
+        stale.transfer_object.side_effect = ConnectionResetError
+        fresh.host, fresh.host_port = "host", 7000
+        mock_client.side_effect = [fresh]
+
+        pool = ClientPool()
+        pool.release(stale)
+        reply = pool.transfer_object("host", 7000, "json", [1])
+        self.assertEqual(fresh.transfer_object.return_value, reply)
+        stale.close.assert_called_once()
+
+        fresh.is_alive.return_value = False
+        mock_client.side_effect = None
+        mock_client.return_value.transfer_object.side_effect = ConnectionResetError
+        with self.assertRaises(ConnectionResetError):
+            pool.transfer_object("host", 7000, "json", [1])
+
+    @mock.patch("msg_transfer_package.pool.Client")
+    def test_no_retry_after_send(self, mock_client):
+        """
+        Tests that a reused connection failing after the request was sent is not retried
+        """
+
+        sent = mock.MagicMock(writes=0)
+        sent.host, sent.host_port = "host", 7000
+        sent.is_alive.return_value = True
+
+        def send_then_fail(*args):
+            sent.writes += 1
+            raise ConnectionResetError
+
+        sent.transfer_object.side_effect = send_then_fail
+        pool = ClientPool()
+        pool.release(sent)
+        with self.assertRaises(ConnectionResetError):
+            pool.transfer_object("host", 7000, "json", [1])
+        mock_client.assert_not_called()
+        sent.close.assert_called_once()
+
+    @mock.patch("msg_transfer_package.pool.time.monotonic")
+    @mock.patch("msg_transfer_package.pool.Client")
+    def test_evict_idle(self, mock_client, monotonic):
+        """
+        Tests that connections idle for longer than the ttl are closed
+        """
+
+        monotonic.return_value = 100.0
+        mock_client.return_value.host = "host"
+        mock_client.return_value.host_port = 7000
+        pool = ClientPool(idle_ttl=10)
+        pool.transfer_object("host", 7000, "json", [1])
+        client = mock_client.return_value
+
+        monotonic.return_value = 105.0
+        pool.evict_idle()
+        client.close.assert_not_called()
+
+        monotonic.return_value = 111.0
+        pool.evict_idle()
+        client.close.assert_called_once()
@@ -0,0 +1,62 @@
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from msg_transfer_package.metrics import MetricsAggregate
+from msg_transfer_package.prefork import Supervisor
+
+logging.disable(logging.CRITICAL)
+
+
+class TestSupervisor(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_restart(self):
+        """
+        Tests that a worker that exits is restarted, its counters are kept
+        and the workers are stopped with the supervisor
+        """
+
+        marker = tempfile.NamedTemporaryFile(delete=False)
+        marker.close()
+        os.remove(marker.name)
+        metadata = {"type": "object", "serialize": "json",
+                    "encrypt": False, "length": 10}
+
+        def target(index, metrics):
+            metrics.message_received(metadata)
+            if index == 0 and not os.path.exists(marker.name):
+                open(marker.name, "w").close()
+                sys.exit(3)
+            while True:
+                time.sleep(1)
+
+        metrics = MetricsAggregate()
+        supervisor = Supervisor(target, 2, metrics, restart_delay=0.01,
+                                shutdown_timeout=5, report_interval=0.01)
+
+        def stop_when_restarted():
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                stats = metrics.to_json()
+                if stats["messages"] and stats["messages"][0]["count"] == 3 and \
+                        len(stats["workers"]) == 2:
+                    break
+                time.sleep(0.01)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        threading.Thread(target=stop_when_restarted).start()
+        try:
+            supervisor.run()
+        finally:
+            os.remove(marker.name)
+
+        self.assertEqual([1, 0], [worker.restarts for worker in supervisor.workers])
+        self.assertEqual([None, None], [worker.pid for worker in supervisor.workers])
+        stats = metrics.to_json()
+        self.assertEqual(3, stats["messages"][0]["count"])
+        self.assertEqual([], stats["workers"])
@@ -1,5 +1,11 @@
+from msg_transfer_package.limits import Limits
 from msg_transfer_package.server import Server
+from msg_transfer_package.utils import (FLAG_ERROR, MAX_HEADER_SIZE, V2_HEADER, create_headers,
+                                        create_headers_v2, encrypt_message, get_params_v2,
+                                        pack_batch)
 import logging
+import socket
+import tempfile
 import unittest
 from unittest import mock
 import os
@@ -43,23 +49,28 @@ class TestServer(unittest.TestCase):
         output_option = "file"
         metadata["serialize"] = "json"
 
-        ret = self.server.receive_object("", metadata, output_option)
-        mock_json.assert_called_with(mock_decrypt.return_value)
-        self.assertEqual(mock_json.return_value, ret)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "received_file.txt")
+            with mock.patch("msg_transfer_package.server.OBJECT_FILENAME", output_path):
+                ret = self.server.receive_object("", metadata, output_option)
+                mock_json.assert_called_with(mock_decrypt.return_value)
+                self.assertEqual(mock_json.return_value, ret)
 
-        metadata["encrypt"] = True
-        metadata["serialize"] = "xml"
+                metadata["encrypt"] = True
+                metadata["serialize"] = "xml"
 
-        ret = self.server.receive_object("", metadata, output_option)
-        mock_xml.assert_called_with(mock_decrypt.return_value)
-        self.assertEqual(mock_xml.return_value, ret)
+                ret = self.server.receive_object("", metadata, output_option)
+                mock_xml.assert_called_with(mock_decrypt.return_value)
+                self.assertEqual(mock_xml.return_value, ret)
 
-        metadata["encrypt"] = False
-        metadata["serialize"] = "binary"
+                metadata["encrypt"] = False
+                metadata["serialize"] = "binary"
 
-        ret = self.server.receive_object("", metadata, output_option)
-        mock_pickle.assert_called_with("")
-        self.assertEqual(mock_pickle.return_value, ret)
+                ret = self.server.receive_object("", metadata, output_option)
+                mock_pickle.assert_called_with("")
+                self.assertEqual(mock_pickle.return_value, ret)
+            with open(output_path, "rb") as file:
+                self.assertEqual(3, len(file.read().splitlines()))
 
     @mock.patch("msg_transfer_package.server.open")
     @mock.patch("msg_transfer_package.server.decrypt_message")
@@ -90,3 +101,166 @@ class TestServer(unittest.TestCase):
 
     def test_receive_data(self):
         pass
+
+    @mock.patch("msg_transfer_package.server.BUFFER_SIZE", 5)
+    def test_receive_data_file_to_disk(self):
+        """
+        Tests that an encrypted file is streamed to disk and acknowledged
+        """
+
+        file_data = b"streamed file contents"
+        payload = encrypt_message(file_data)
+        header = create_headers(16, "file", True, "name.ext", len(payload))
+        server = Server("", 7000, "file")
+        server_sock, client_sock = socket.socketpair()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir, server_sock, client_sock:
+            os.chdir(tmp_dir)
+            try:
+                client_sock.sendall(bytes(header, "utf-8") + payload)
+                client_sock.shutdown(socket.SHUT_WR)
+                server.receive_data(server_sock, "address")
+                self.assertEqual(["received_name.ext"], os.listdir(tmp_dir))
+                with open("received_name.ext", "rb") as file:
+                    self.assertEqual(file_data, file.read())
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(b"26              Received File successfully",
+                             client_sock.recv(64))
+
+    @mock.patch("msg_transfer_package.server.BUFFER_SIZE", 5)
+    def test_receive_data_file_print(self):
+        """
+        Tests that a file over the frame limit is streamed and counted in print mode
+        """
+
+        payload = encrypt_message(b"streamed file contents")
+        header = create_headers(16, "file", True, "name.ext", len(payload))
+        server = Server("", 7000, "print", limits=Limits(max_frame_size=10))
+        server_sock, client_sock = socket.socketpair()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir, server_sock, client_sock:
+            os.chdir(tmp_dir)
+            try:
+                client_sock.sendall(bytes(header, "utf-8") + payload)
+                client_sock.shutdown(socket.SHUT_WR)
+                server.receive_data(server_sock, "address")
+                self.assertEqual([], os.listdir(tmp_dir))
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(b"26              Received File successfully",
+                             client_sock.recv(64))
+
+    @mock.patch("msg_transfer_package.server.POLL_INTERVAL", 0.01)
+    def test_handle_connection_shutdown(self):
+        """
+        Tests that an idle connection is closed once shutdown is requested
+        """
+
+        server = Server("", 7000)
+        server_sock, client_sock = socket.socketpair()
+        server.shutdown_event.set()
+        with client_sock:
+            server.handle_connection(server_sock, "address")
+            self.assertEqual(server_sock.fileno(), -1)
+            self.assertEqual(client_sock.recv(16), b"")
+
+    def test_process_message_decode_pool(self):
+        """
+        Tests that objects are decoded by the decode pool when the server has one
+        """
+
+        decode_pool = mock.MagicMock()
+        decode_pool.decode.return_value = [1, 2]
+        server = Server("", 7000, "print", decode_pool=decode_pool)
+        metadata = {"type": "batch", "encrypt": True, "serialize": "json"}
+        self.assertEqual(b"Received Batch of 2 objects successfully",
+                         server.process_message(b"payload", metadata))
+        decode_pool.decode.assert_called_once_with(
+            b"payload", metadata, server.limits.max_frame_size)
+
+    def test_receive_object_sink(self):
+        """
+        Tests that objects are handed to the output sink as json lines
+        """
+
+        sink = mock.MagicMock()
+        metadata = {"type": "batch", "encrypt": False, "serialize": "json"}
+        payload = pack_batch([b'{"a": 1}', b"[2]"])
+        self.server.receive_object(payload, metadata, "file", sink=sink)
+        sink.write.assert_called_once_with(b'{"a": 1}\n[2]\n')
+
+    def test_receive_data_frame_limit(self):
+        """
+        Tests that a frame over the size limit is answered with an error and the connection closed
+        """
+
+        server = Server("", 7000, "print", limits=Limits(
+            max_frame_size=100, connection_budget=100 + MAX_HEADER_SIZE,
+            global_budget=100 + MAX_HEADER_SIZE))
+        server_sock, client_sock = socket.socketpair()
+        with server_sock, client_sock:
+            client_sock.sendall(create_headers_v2(
+                "object", False, "json", 2 ** 40, request_id=7))
+            server.receive_data(server_sock, "address")
+            reply = get_params_v2(client_sock.recv(V2_HEADER.size))
+            self.assertTrue(reply["flags"] & FLAG_ERROR)
+            self.assertIn(b"exceeds the limit", client_sock.recv(reply["length"] + 5))
+        self.assertEqual(server.limits.global_budget, server.budget.available)
+
+    def test_receive_data_timeouts(self):
+        """
+        Tests that idle and stalled clients are disconnected
+        """
+
+        server = Server("", 7000, "print", limits=Limits(
+            idle_timeout=0.05, read_timeout=0.05))
+        server_sock, client_sock = socket.socketpair()
+        server_sock.settimeout(0.01)
+        with server_sock, client_sock:
+            server.receive_data(server_sock, "address")
+
+            # Half a header is never answered
+            client_sock.sendall(b"object")
+            server.receive_data(server_sock, "address")
+
+        server_sock, client_sock = socket.socketpair()
+        server_sock.settimeout(0.01)
+        with server_sock, client_sock:
+            client_sock.sendall(bytes(create_headers(
+                16, "object", False, "json", 10), "utf-8") + b"[1")
+            server.receive_data(server_sock, "address")
+            length = int(client_sock.recv(16))
+            self.assertIn(b"Timed out", client_sock.recv(length))
+        self.assertEqual(server.limits.global_budget, server.budget.available)
+
+    @mock.patch("msg_transfer_package.server.POLL_INTERVAL", 0.01)
+    def test_receive_data_budget(self):
+        """
+        Tests that a connection stops reading while the global budget is used up and gives up
+        its bytes after read_timeout
+        """
+
+        server = Server("", 7000, "print", limits=Limits(read_timeout=0.05))
+        # Other connections hold all but the header and 6 payload bytes of a frame
+        other = server.budget.acquire(server.limits.global_budget - 70)
+        server_sock, client_sock = socket.socketpair()
+        with server_sock, client_sock:
+            client_sock.sendall(bytes(create_headers(
+                16, "object", False, "json", 100), "utf-8") + b"[" * 100)
+            server.receive_data(server_sock, "address")
+            length = int(client_sock.recv(16))
+            self.assertIn(b"out of receive buffer space",
+                          client_sock.recv(length))
+        self.assertEqual(70, server.budget.available)
+
+        server.budget.release(other)
+        server_sock, client_sock = socket.socketpair()
+        with server_sock, client_sock:
+            client_sock.sendall(bytes(create_headers(
+                16, "object", False, "json", 5), "utf-8") + b"[1,2]")
+            client_sock.shutdown(socket.SHUT_WR)
+            server.receive_data(server_sock, "address")
+            length = int(client_sock.recv(16))
+            self.assertEqual(b"Received Object successfully", client_sock.recv(length))
+        self.assertEqual(server.limits.global_budget, server.budget.available)
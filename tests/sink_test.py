@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from msg_transfer_package import columnar
+from msg_transfer_package.sink import WriteBehindSink, encode_record
+
+logging.disable(logging.CRITICAL)
+
+
+class TestWriteBehindSink(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "received_file.txt")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_encode_record(self):
+        """
+        Tests that objects json cannot serialize directly are converted
+        """
+
+        batch = columnar.decode(columnar.encode_records([{"a": 1, "b": "x"}]))
+        self.assertEqual(b'[{"a": 1, "b": "x"}]\n', encode_record(batch))
+        self.assertEqual({"raw": "AAE=", "items": [1, 2]}, json.loads(
+            encode_record({"raw": b"\x00\x01", "items": (1, 2)})))
+
+    def test_write(self):
+        """
+        Tests that records are appended in order and kept across sinks
+        """
+
+        with WriteBehindSink(self.path, queue_size=2, batch_bytes=8) as sink:
+            for i in range(10):
+                sink.write(encode_record(i))
+            sink.flush()
+            with open(self.path, "rb") as file:
+                self.assertEqual(10, len(file.readlines()))
+        with WriteBehindSink(self.path) as sink:
+            sink.write(encode_record(10))
+
+        with open(self.path, "rb") as file:
+            self.assertEqual(list(range(11)), [json.loads(line) for line in file])
+        with self.assertRaises(ValueError):
+            sink.write(b"closed\n")
+
+    @mock.patch("msg_transfer_package.sink.os.fsync")
+    def test_fsync(self, mock_fsync):
+        """
+        Tests the fsync policies
+        """
+
+        with WriteBehindSink(self.path, fsync="none") as sink:
+            sink.write(b"record\n")
+        mock_fsync.assert_not_called()
+
+        with WriteBehindSink(self.path, fsync="batch") as sink:
+            sink.write(b"record\n")
+            sink.flush()
+            mock_fsync.assert_called_once()
+
+        mock_fsync.reset_mock()
+        with WriteBehindSink(self.path, fsync="interval", fsync_interval=60) as sink:
+            sink.write(b"record\n")
+            sink.flush()
+            mock_fsync.assert_not_called()
+        # Synced when the sink is closed at the latest
+        mock_fsync.assert_called_once()
+
+        with self.assertRaises(ValueError):
+            WriteBehindSink(self.path, fsync="always")
+
+    def test_rotate(self):
+        """
+        Tests that the file is rotated before it grows past rotate_bytes
+        """
+
+        with WriteBehindSink(self.path, batch_bytes=1, rotate_bytes=16) as sink:
+            for _ in range(4):
+                sink.write(b"0123456789\n")
+
+        files = sorted(os.listdir(self.tmp_dir.name))
+        self.assertEqual(4, len(files))
+        self.assertEqual("received_file.txt", files[0])
+        for name in files:
+            with open(os.path.join(self.tmp_dir.name, name), "rb") as file:
+                self.assertEqual(b"0123456789\n", file.read())
+
+    def test_write_error(self):
+        """
+        Tests that a failed write is reported to the next writer
+        """
+
+        sink = WriteBehindSink(self.path)
+        sink._file.close()
+        sink._file = mock.MagicMock()
+        sink._file.write.side_effect = OSError(28, "No space left on device")
+        sink.write(b"record\n")
+        sink.flush()
+        with self.assertRaises(OSError):
+            sink.write(b"record\n")
+        sink.close()
@@ -0,0 +1,89 @@
+import logging
+import os
+import unittest
+from unittest import mock
+
+from msg_transfer_package.chunks import ChunkStore
+from msg_transfer_package.client import Client
+from msg_transfer_package.server import Server
+from msg_transfer_package.striped import StreamTuner, transfer_file_striped
+from tests.helpers import ServerTestCase
+
+logging.disable(logging.CRITICAL)
+
+
+class TestStriped(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_path = os.path.join(self.tmp_dir.name, "input.bin")
+        self.data = os.urandom(100000)
+        with open(self.input_path, "wb") as file:
+            file.write(self.data)
+        self.output_dir = os.path.join(self.tmp_dir.name, "out")
+        os.mkdir(self.output_dir)
+        self.server = Server("", 7000, "print")
+        self.server.chunks = ChunkStore(self.output_dir)
+
+    def assert_received(self):
+        self.assertEqual(["received_input.bin"], os.listdir(self.output_dir))
+        with open(os.path.join(self.output_dir, "received_input.bin"), "rb") as file:
+            self.assertEqual(self.data, file.read())
+
+    def test_streams(self):
+        """
+        Tests that the chunks of all streams are reassembled into one file with one completion
+        """
+
+        handle = ChunkStore.handle
+        replies = []
+
+        def record_reply(store, *args):
+            replies.append(handle(store, *args))
+            return replies[-1]
+
+        with mock.patch("msg_transfer_package.striped.Client", side_effect=self.connect), \
+                mock.patch.object(ChunkStore, "handle", autospec=True, side_effect=record_reply):
+            reply = transfer_file_striped("", 7000, self.input_path, streams=3,
+                                          chunk_size=4096)
+        self.assertEqual(b"Received File successfully", reply)
+        self.assertEqual(3, len(self.connections))
+        self.assertEqual(1, replies.count(b"Received File successfully"))
+        self.assert_received()
+
+    def test_failed_stream(self):
+        """
+        Tests that the chunks of a failed stream are sent again over a new connection
+        """
+
+        send_chunk = Client.send_chunk
+        calls = []
+
+        def fail_third(client, *args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise ConnectionResetError
+            return send_chunk(client, *args)
+
+        with mock.patch("msg_transfer_package.striped.Client", side_effect=self.connect), \
+                mock.patch.object(Client, "send_chunk", autospec=True, side_effect=fail_third):
+            reply = transfer_file_striped("", 7000, self.input_path, streams=2,
+                                          chunk_size=4096, encrypt=False)
+        self.assertEqual(b"Received File successfully", reply)
+        self.assertEqual(3, len(self.connections))
+        self.assert_received()
+
+    def test_tuner(self):
+        """
+        Tests that streams are added while they raise the throughput
+        """
+
+        tuner = StreamTuner(max_streams=4)
+        self.assertTrue(tuner.observe(100, 1))
+        self.assertTrue(tuner.observe(190, 2))
+        self.assertFalse(tuner.observe(200, 3))
+        self.assertTrue(tuner.done)
+        self.assertFalse(tuner.observe(1000, 3))
+
+        tuner = StreamTuner(max_streams=2)
+        self.assertTrue(tuner.observe(100, 1))
+        self.assertFalse(tuner.observe(200, 2))
@@ -1,10 +1,19 @@
 from msg_transfer_package.example_data.example_data import DATA
+from msg_transfer_package import codec
 from msg_transfer_package.utils import (
     encrypt_message,
     decrypt_message,
     serialize_object,
     create_headers,
     get_params,
+    create_headers_v2,
+    get_params_v2,
+    create_reply,
+    FrameDecoder,
+    V2_HEADER,
+    pack_batch,
+    unpack_batch,
+    set_header_trailer,
 )
 import logging
 import unittest
@@ -62,6 +71,10 @@ class TestUtils(unittest.TestCase):
             serialize_object(obj, "json"), serialize_object(obj, "binary")
         )
 
+        serialized = serialize_object(obj, "compact")
+        self.assertIsInstance(serialized, bytes)
+        self.assertEqual(obj, codec.loads(serialized))
+
     def test_create_headers(self):
         """
         Tests metadata header creation
@@ -121,3 +134,92 @@ class TestUtils(unittest.TestCase):
         }
 
         self.assertEqual(return_value, get_params(msg, 10))
+
+    def test_headers_v2(self):
+        """
+        Tests binary header creation and parsing
+        """
+
+        header = create_headers_v2("object", True, "xml", 2 ** 40)
+        self.assertEqual(V2_HEADER.size, len(header))
+        self.assertEqual(
+            {
+                "version": 2,
+                "type": "object",
+                "encrypt": True,
+                "flags": 1,
+                "serialize": "xml",
+                "name_length": 0,
+                "trailer_length": 0,
+                "length": 2 ** 40,
+            },
+            get_params_v2(header),
+        )
+
+        header = create_headers_v2("file", False, "a long file name.txt", 5)
+        params = get_params_v2(header[:V2_HEADER.size])
+        self.assertEqual("file", params["type"])
+        self.assertEqual(20, params["name_length"])
+        self.assertEqual(b"a long file name.txt", header[V2_HEADER.size:])
+
+        header = create_headers_v2(
+            "batch", False, "json", 9, request_id=7, compression="lzma")
+        params = get_params_v2(header[:V2_HEADER.size])
+        self.assertEqual(5, params["trailer_length"])
+        set_header_trailer(params, header[V2_HEADER.size:])
+        self.assertEqual((7, "lzma"), (params["request_id"], params["compression"]))
+
+        with self.assertRaises(ValueError):
+            get_params_v2(b"object    1     ")
+
+        self.assertEqual(b"2               ok", create_reply(b"ok", 16))
+        self.assertEqual(create_headers_v2("reply", False, "", 2) + b"ok",
+                         create_reply(b"ok", 16, 2))
+
+    def test_batch(self):
+        """
+        Tests packing and unpacking the objects of a batch
+        """
+
+        items = [b"[1, 2]", b"", b"{}"]
+        payload = pack_batch(items)
+        self.assertEqual(items, unpack_batch(payload))
+        with self.assertRaises(ValueError):
+            unpack_batch(payload[:-1])
+
+    def test_frame_decoder(self):
+        """
+        Tests decoding frames split across reads and coalesced into one read
+        """
+
+        first = b"object    1         json      3         abc"
+        second = b"file      0         a.txt     0         "
+        third = b"object    0         xml       4         wxyz"
+
+        decoder = FrameDecoder(10)
+        frames = []
+        for i in range(len(first)):
+            decoder.feed(memoryview(first)[i:i + 1])
+            frames.extend(decoder)
+            self.assertEqual(i == len(first) - 1, decoder.idle)
+        decoder.feed(second + third)
+        frames.extend(decoder)
+        # v1 and v2 frames can follow each other on one connection
+        fourth = create_headers_v2("file", True, "name.txt", 2) + b"hi"
+        decoder.feed(fourth[:V2_HEADER.size + 3])
+        frames.extend(decoder)
+        decoder.feed(fourth[V2_HEADER.size + 3:])
+        frames.extend(decoder)
+
+        self.assertEqual("name.txt", frames[-1][0]["filename"])
+        self.assertEqual(
+            [("object", b"abc"), ("file", b""), ("object", b"wxyz"), ("file", b"hi")],
+            [(params["type"], bytes(payload)) for params, payload in frames],
+        )
+        self.assertTrue(decoder.idle)
+
+        decoder.feed(b"file      0         big.bin   100       start")
+        self.assertEqual([], list(decoder))
+        self.assertEqual("big.bin", decoder.header["filename"])
+        self.assertEqual(b"start", decoder.take_payload())
+        self.assertTrue(decoder.idle)